@@ -0,0 +1,60 @@
+"""Time `geometry.AggregatePointsViaGraph` as the number of points grows, and
+check it against the original quadratic algorithm for small inputs.
+
+Usage: python benchmarks/aggregate_points.py [max_power_of_ten]
+"""
+
+import sys, os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+import numpy as np
+import open_cp.network
+import opencrimedata.geometry as geometry
+
+def quadratic_aggregate(points, tolerance):
+    all_nodes = np.asarray(sorted(set((x,y) for x,y in points)))
+    builder = open_cp.network.GraphBuilder()
+    idx = np.arange(all_nodes.shape[0])
+    for i, pt in enumerate(all_nodes):
+        builder.vertices.add(i)
+        distsq = np.sum((all_nodes[i+1:] - pt)**2, axis=1)
+        for j in idx[i+1:][distsq <= tolerance**2]:
+            builder.add_edge(i, j)
+    merged = dict()
+    for com in open_cp.network.connected_components(builder.build()):
+        com = sorted(com)
+        p = all_nodes[com]
+        i = np.argmin(np.sum((p - np.mean(p, axis=0))**2, axis=1))
+        for j in com:
+            merged[tuple(all_nodes[j])] = tuple(p[i])
+    return merged
+
+def make_points(size, seed=1):
+    """Points clustered around "addresses" in a square whose area grows
+    with `size`, so the density is roughly constant."""
+    rng = np.random.RandomState(seed)
+    side = np.sqrt(size) * 10
+    centres = rng.random_sample(size=(size // 4 + 1, 2)) * side
+    points = centres[rng.randint(len(centres), size=size)]
+    return points + rng.standard_normal(size=points.shape) * 0.5
+
+def main(max_power=7, check_power=4, tolerance=1):
+    for power in range(3, max_power + 1):
+        points = make_points(10 ** power)
+        start = time.perf_counter()
+        agg = geometry.AggregatePointsViaGraph(points, tolerance)
+        took = time.perf_counter() - start
+        print("{:>9} points -> {:>9} merged: {:.2f}s".format(len(points),
+            len(agg.merged_points), took))
+        if power <= check_power:
+            start = time.perf_counter()
+            expected = quadratic_aggregate(points, tolerance)
+            took = time.perf_counter() - start
+            assert set(tuple(pt) for pt in agg.merged_points) == set(expected.values())
+            for pt in points:
+                assert tuple(agg[pt]) == expected[tuple(pt)]
+            print("    quadratic algorithm agrees: {:.2f}s".format(took))
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
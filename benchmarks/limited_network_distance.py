@@ -0,0 +1,70 @@
+"""Compare `network.LimitedNetworkDistance` with the original unordered
+search, on a square grid graph with random edge lengths."""
+
+import sys, os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+import numpy as np
+import open_cp.network
+import opencrimedata.network as network
+
+def grid_graph(size, seed=1):
+    b = open_cp.network.GraphBuilder()
+    for x in range(size):
+        for y in range(size):
+            if x + 1 < size:
+                b.add_edge((x,y), (x+1,y))
+            if y + 1 < size:
+                b.add_edge((x,y), (x,y+1))
+    b.lengths = np.random.RandomState(seed).random_sample(len(b.edges)) * 100 + 50
+    return b.build()
+
+def unordered_walk(graph, edge, t, maximum_distance):
+    distances = dict()
+    v1, v2 = graph.edges[edge]
+    edge_length = graph.lengths[edge]
+    distances[v1] = t * edge_length
+    distances[v2] = (1 - t) * edge_length
+    paths = {v1:v1, v2:v2}
+    vertices_to_visit = {v1, v2}
+    while len(vertices_to_visit) > 0:
+        v = vertices_to_visit.pop()
+        for u in graph.neighbours(v):
+            e, _ = graph.find_edge(v, u)
+            d = distances[v] + graph.lengths[e]
+            if u not in distances or d < distances[u]:
+                distances[u] = d
+                if d <= maximum_distance:
+                    vertices_to_visit.add(u)
+                paths[u] = v
+    return distances, paths
+
+def main(size=200, searches=200, maximum_distance=1000):
+    graph = grid_graph(size)
+    rng = np.random.RandomState(2)
+    starts = [(e, t) for e, t in zip(rng.randint(graph.number_edges, size=searches),
+        rng.random_sample(searches))]
+    print("Grid of {} vertices and {} edges; {} searches to distance {}".format(
+        len(graph.vertices), graph.number_edges, searches, maximum_distance))
+
+    # Build the adjacency structure outside of the timings
+    network.LimitedNetworkDistance(graph, 0, 0, 0)
+
+    start = time.perf_counter()
+    expected = [unordered_walk(graph, e, t, maximum_distance) for e, t in starts]
+    old_time = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    results = [network.LimitedNetworkDistance(graph, e, t, maximum_distance) for e, t in starts]
+    new_time = time.perf_counter() - start
+
+    # The random edge lengths never tie, so the paths are also the same
+    for (distances, paths), dist in zip(expected, results):
+        assert dist.paths == paths
+        assert dist.vertex_distances == distances
+    print("Unordered search: {:.3f}s".format(old_time))
+    print("Priority queue:   {:.3f}s".format(new_time))
+
+if __name__ == "__main__":
+    main()
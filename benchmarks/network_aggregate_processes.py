@@ -0,0 +1,47 @@
+"""Time `network.NetworkProjectAggregate` as the number of worker processes
+grows, on a grid graph, and check that every run gives the same result as
+the single process run.
+
+Usage: python benchmarks/network_aggregate_processes.py [number_of_points] [max_processes]
+
+With near-linear scaling, the speedup is close to the number of processes,
+up to the number of CPUs, less the serial projection and indexing steps.
+"""
+
+import sys, os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+import numpy as np
+import open_cp.network
+import opencrimedata.network as network
+
+def make_graph(size):
+    b = open_cp.network.PlanarGraphBuilder()
+    for x in range(size):
+        for y in range(size):
+            b.set_vertex((x, y), x * 10, y * 10)
+            if x + 1 < size:
+                b.add_edge((x, y), (x + 1, y))
+            if y + 1 < size:
+                b.add_edge((x, y), (x, y + 1))
+    return b.build()
+
+def main(size=100000, max_processes=None, tolerance=2):
+    graph = make_graph(100)
+    points = np.random.RandomState(1).random_sample(size=(size, 2)) * 990
+    if max_processes is None:
+        max_processes = os.cpu_count() or 1
+    counts = [1] + [p for p in [2, 4, 8, 16] if p <= max_processes]
+    base, expected = None, None
+    for processes in counts:
+        start = time.perf_counter()
+        agg = network.NetworkProjectAggregate(graph, points, tolerance, processes=processes)
+        took = time.perf_counter() - start
+        if expected is None:
+            base, expected = took, agg.to_projected_lookup
+        assert agg.to_projected_lookup == expected
+        print("{} processes: {:.2f}s, speedup {:.2f}".format(processes, took, base / took))
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:3]])
@@ -0,0 +1,89 @@
+"""Time `tiger_lines.all_names_to_frame` and the "reduced" name mask on a
+synthetic grid with as many edges as a large TIGER/Lines county, and check
+them against the original row by row implementations.
+
+Usage: python benchmarks/tiger_lines_frame.py [number_of_edges]
+"""
+
+import sys, os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+import numpy as np
+import geopandas as gpd
+import shapely.geometry
+import open_cp.network
+import opencrimedata.tiger_lines as tiger_lines
+
+def original_frame(edges_graph, all_names):
+    all_names = list(all_names)
+    frame = gpd.GeoDataFrame({"left_add_from" : [e.left_address_from for e, _ in all_names],
+        "left_add_to" : [e.left_address_to for e, _ in all_names],
+        "right_add_from" : [e.right_address_from for e, _ in all_names],
+        "right_add_to" : [e.right_address_to for e, _ in all_names],
+        "edge_number" : [i for i,_ in enumerate(all_names)],
+        })
+    all_name_options = [list(names) for _, names in all_names]
+    maxlen = max(len(names) for names in all_name_options)
+    for i in range(maxlen):
+        frame["name{}".format(i)] = [names[i] if len(names) > i else None
+            for names in all_name_options]
+    frame.geometry = [shapely.geometry.LineString([edges_graph.vertices[x] for x in edge])
+        for edge in edges_graph.edges]
+    return frame
+
+def original_mask(frame):
+    maxlen = len([x for x in frame.columns if x.startswith("name")])
+    mask = []
+    for _, row in frame.iterrows():
+        names = [row["name{}".format(i)] for i in range(maxlen)]
+        mask.append(any(tiger_lines.filter_names(n) for n in names if isinstance(n, str)))
+    return np.asarray(mask)
+
+def make_data(size, seed=1):
+    rng = np.random.RandomState(seed)
+    side = int(np.sqrt(size / 2)) + 1
+    vertices = [(y * side + x, x * 100.0, y * 100.0) for x in range(side) for y in range(side)]
+    edges = []
+    for x in range(side):
+        for y in range(side):
+            if x + 1 < side:
+                edges.append((y * side + x, y * side + x + 1))
+            if y + 1 < side:
+                edges.append((y * side + x, (y + 1) * side + x))
+    graph = open_cp.network.PlanarGraph(vertices, edges)
+    choices = ["MAIN ST", "ALLEY", "CA RR", "ELM AVE", "OAK DR", None]
+    all_names = []
+    for i in range(len(edges)):
+        name = choices[rng.randint(len(choices))]
+        edge = tiger_lines.EdgeNoLine(name, str(i), str(i + 10), str(i + 1), str(i + 11))
+        names = {name} | set(choices[j] for j in rng.randint(len(choices), size=rng.randint(3)))
+        all_names.append((edge, names))
+    return graph, all_names
+
+def main(size=200000):
+    graph, all_names = make_data(size)
+    print("{} edges".format(len(graph.edges)))
+    start = time.perf_counter()
+    frame = tiger_lines.all_names_to_frame(graph, all_names)
+    mask = np.zeros(len(frame), dtype=bool)
+    for column in frame.columns:
+        if column.startswith("name"):
+            mask |= tiger_lines.filter_names_many(frame[column].to_numpy(dtype=object))
+    print("    vectorised: {:.2f}s".format(time.perf_counter() - start))
+
+    start = time.perf_counter()
+    expected = original_frame(graph, all_names)
+    expected_mask = original_mask(expected)
+    print("    original:   {:.2f}s".format(time.perf_counter() - start))
+
+    for column in expected.columns:
+        if column == "geometry":
+            assert all(a.equals(b) for a, b in zip(frame.geometry, expected.geometry))
+        else:
+            a, b = frame[column].to_numpy(dtype=object), expected[column].to_numpy(dtype=object)
+            assert all(x == y or (x is None or x != x) and (y is None or y != y) for x, y in zip(a, b))
+    assert np.array_equal(mask, expected_mask)
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
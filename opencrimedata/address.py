@@ -10,6 +10,7 @@ import zipfile as _zipfile
 import collections as _collections
 import csv as _csv
 import io as _io
+import os as _os
 import geopandas as _gpd
 import pandas as _pd
 import numpy as _np
@@ -100,6 +101,72 @@ def read_to_geo_frame(zipfilename, state, filename):
     return frame
 
 
+class _StringTable():
+    """Read-only table of pairs of strings, stored as UTF-8 in one byte array
+    with an array of offsets, so that it can be memory mapped.  Supports the
+    same indexing as a numpy array of shape `(n,2)`, for a single
+    (non-negative) index, an array of indices, or a slice.  Strings are
+    decoded only when indexed; converting to a numpy array, or iterating,
+    decodes the whole table.
+
+    :param offsets: Array of shape `(2n+1,)`; string `k` is
+      `blob[offsets[k] : offsets[k+1]]`.
+    :param blob: Array of bytes.
+    """
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    @staticmethod
+    def encode(pairs):
+        """Encode an array of shape `(n,2)` of strings.
+
+        :return: Pair `(offsets, blob)` of arrays.
+        """
+        encoded = [str(x).encode("utf8") for x in _np.asarray(pairs).ravel()]
+        lengths = _np.fromiter(map(len, encoded), dtype=_np.int64, count=len(encoded))
+        offsets = _np.concatenate([[0], _np.cumsum(lengths)]).astype(_np.int64)
+        blob = _np.frombuffer(b"".join(encoded), dtype=_np.uint8)
+        return offsets, blob
+
+    def __len__(self):
+        return (len(self._offsets) - 1) // 2
+
+    @property
+    def shape(self):
+        return (len(self), 2)
+
+    @property
+    def offsets(self):
+        return self._offsets
+
+    @property
+    def blob(self):
+        return self._blob
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+    def _decode(self, k):
+        return bytes(self._blob[self._offsets[k] : self._offsets[k+1]]).decode("utf8")
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indices = _np.arange(*index.indices(len(self)))
+        else:
+            indices = _np.asarray(index, dtype=_np.int64)
+        out = [[self._decode(2*i), self._decode(2*i+1)] for i in _np.atleast_1d(indices)]
+        out = _np.asarray(out, dtype=str).reshape(-1, 2)
+        if _np.ndim(indices) == 0:
+            return out[0]
+        return out
+
+
 class AddressMatch():
     """Load an address database, and use it to match points.
 
@@ -117,6 +184,43 @@ class AddressMatch():
         address_points = _np.vstack(proj(*address_points.T)).T
         self._matcher = geometry.ClosestPoint(address_points)
 
+    _INDEX_FILES = {"points" : "points.npy", "offsets" : "address_offsets.npy",
+        "blob" : "address_strings.npy"}
+
+    def save(self, dirname):
+        """Save a compact index to a directory, which can be quickly read back
+        with :meth:`load`.  Writes the projected coordinates, and the address
+        strings as UTF-8 bytes with offsets, as `.npy` files.
+
+        :param dirname: Name of the directory, which will be created if needed.
+        """
+        _os.makedirs(dirname, exist_ok=True)
+        if isinstance(self._addresses, _StringTable):
+            offsets, blob = self._addresses.offsets, self._addresses.blob
+        else:
+            offsets, blob = _StringTable.encode(self._addresses)
+        arrays = {"points" : _np.asarray(self.address_points, dtype=_np.float64),
+            "offsets" : offsets, "blob" : blob}
+        for key, filename in self._INDEX_FILES.items():
+            _np.save(_os.path.join(dirname, filename), arrays[key])
+
+    @staticmethod
+    def load(dirname):
+        """Construct an instance from an index saved by :meth:`save`.  The
+        files are memory mapped, so several processes loading the same index
+        share the pages, and addresses are only decoded when needed.  The
+        `cKDTree` is rebuilt over the memory mapped points, which does not
+        copy them.
+
+        :param dirname: Name of the directory.
+        """
+        arrays = {key : _np.load(_os.path.join(dirname, filename), mmap_mode="r")
+            for key, filename in AddressMatch._INDEX_FILES.items()}
+        match = AddressMatch.__new__(AddressMatch)
+        match._addresses = _StringTable(arrays["offsets"], arrays["blob"])
+        match._matcher = geometry.ClosestPoint(arrays["points"])
+        return match
+
     @staticmethod
     def from_zip(zipfile, state, filename, proj):
         """Construct an instance from a zip file; see
@@ -158,6 +262,10 @@ class AddressMatch():
 
     @property
     def addresses(self):
-        """The addresses, in the same order as :attr:`address_points`."""
+        """The addresses, in the same order as :attr:`address_points`.  An
+        array of shape `(n,2)` of pairs `(number, street)`, or, for an index
+        read with :meth:`load`, a read-only view which supports the same
+        indexing and decodes the addresses only when they are indexed.  Use
+        `numpy.asarray` to decode every address at once."""
         return self._addresses
     
\ No newline at end of file
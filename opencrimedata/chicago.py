@@ -9,12 +9,12 @@ https://data.cityofchicago.org/Public-Safety/Crimes-2001-to-present/ijzp-q8t2
 
 import csv as _csv
 import collections as _collections
-import datetime as _datetime
 import geopandas as _gpd
+import pandas as _pd
 import fiona as _fiona
 import numpy as _np
-import shapely.geometry as _geometry
 import pyproj as _pyproj
+from . import timestamps as _timestamps
 
 _HEADER = ["ID", 'Primary Type', 'Description', 'Location Description',
            'Block', "Date", 'Longitude', 'Latitude']
@@ -27,6 +27,9 @@ def projector():
     suitable for Chicago."""
     return _pyproj.Proj({"init":"epsg:2790"})
 
+_COLUMNS = ["id", "crime_type", "crime_subtype", "location", "address",
+            "datetime", "lon", "lat"]
+
 def load(filename):
     """Load the data.
     
@@ -34,26 +37,86 @@ def load(filename):
     
     :return: Iterable of typed rows of the data.
     """
-    toclose = False
-    if isinstance(filename, str):
-        filename = open(filename, "rt")
-        toclose = True
-    try:
-        reader = _csv.reader(filename)
-        header = [x.strip().upper() for x in next(reader)]
-        lookup = [header.index(x.upper()) for x in _HEADER]
-        for row in reader:
-            data = [row[x] for x in lookup]
-            data[5] = _datetime.datetime.strptime(data[5], _DT_FMT)
-            if data[6] == "":
-                data[6] = None
-            else:
-                data[6] = float(data[6]), float(data[7])
-            del data[7]
-            yield Row(*data)
-    finally:
-        if toclose:
-            filename.close()
+    for frame in _load_chunks(filename, 10000):
+        yield from _frame_to_rows(frame)
+
+def _frame_to_rows(frame):
+    """Convert a frame, as returned by :func:`load_columns`, to `Row`s."""
+    columns = [frame[key].tolist() for key in _COLUMNS[:5]]
+    columns.append(list(frame["datetime"].dt.to_pydatetime()))
+    for *data, lon, lat in zip(*columns, frame["lon"].tolist(), frame["lat"].tolist()):
+        point = None if _np.isnan(lon) else (lon, lat)
+        yield Row(*data, point)
+
+def _load_chunks(filename, chunk_size, filter=None):
+    """Read the CSV file in chunks with `pandas`, parsing dates in bulk.
+
+    :param filter: If not `None`, a function which takes a chunk, with all
+      columns still strings, and returns a boolean mask of rows to keep.
+      Dates are only parsed for rows which are kept.
+
+    :return: Iterable of data frames with columns given by `_COLUMNS`.
+    """
+    names = {x.upper() : name for x, name in zip(_HEADER, _COLUMNS)}
+    reader = _pd.read_csv(filename, usecols=lambda c : c.strip().upper() in names,
+        dtype=str, keep_default_na=False, chunksize=chunk_size)
+    with reader:
+        for chunk in reader:
+            chunk.columns = [names[c.strip().upper()] for c in chunk.columns]
+            missing = set(_COLUMNS) - set(chunk.columns)
+            if len(missing) > 0:
+                raise ValueError("Columns {} missing from file".format(missing))
+            if filter is not None:
+                chunk = chunk[filter(chunk)]
+            frame = _pd.DataFrame({key : chunk[key] for key in _COLUMNS[:5]})
+            frame["datetime"] = _timestamps.parser(_DT_FMT).parse_many(chunk["datetime"].values)
+            for key in ["lon", "lat"]:
+                frame[key] = chunk[key].replace("", "nan").astype(_np.float64)
+            yield frame.reset_index(drop=True)
+
+def load_columns(filename, crime_type=None, start=None, end=None,
+        only_with_point=False, chunk_size=100000):
+    """Load the data into columns.  Much faster than :func:`load` for large
+    files, as the file is parsed in chunks, and dates are parsed in bulk.
+
+    :param filename: Filename or a file-like object opened in text mode.
+    :param crime_type: If not `None`, a crime type, or a list of crime types,
+      to load.
+    :param start: If not `None`, only load crimes at or after this time.
+    :param end: If not `None`, only load crimes before this time.
+    :param only_with_point: If `True`, skip entries which have no geo-coding
+      point, or an obviously wrong point, as :func:`load_only_with_point`.
+    :param chunk_size: Number of rows of the file to parse at once.
+
+    :return: `pandas.DataFrame` with columns "id", "crime_type",
+      "crime_subtype", "location", "address" (all strings), "datetime" (as
+      `datetime64`), "lon" and "lat" (floats, which are `nan` if there is no
+      geo-coding).
+    """
+    types = None
+    if crime_type is not None:
+        types = [crime_type] if isinstance(crime_type, str) else list(crime_type)
+    def filter(chunk):
+        mask = _np.ones(len(chunk), dtype=bool)
+        if types is not None:
+            mask &= chunk["crime_type"].isin(types).values
+        if only_with_point:
+            mask &= (chunk["lon"] != "").values
+        return mask
+
+    frames = []
+    for frame in _load_chunks(filename, chunk_size, filter):
+        mask = _np.ones(len(frame), dtype=bool)
+        if start is not None:
+            mask &= (frame["datetime"] >= _pd.Timestamp(start)).values
+        if end is not None:
+            mask &= (frame["datetime"] < _pd.Timestamp(end)).values
+        if only_with_point:
+            mask &= ~((frame["lon"] < -91) & (frame["lat"] < 37)).values
+        frames.append(frame[mask])
+    if len(frames) == 0:
+        return _pd.DataFrame({key : [] for key in _COLUMNS})
+    return _pd.concat(frames, ignore_index=True)
             
 try:
     import open_cp.data as _ocpd
@@ -66,26 +129,15 @@ def load_to_open_cp(filename, crime_type=None):
     :param filename: Filename or a file-like object opened in text mode.
     :param crime_type: String of the crime type to load, or `None` to load all.
     """
-    proj = projector()
-    times = []
-    points = []
-    for row in load_only_with_point(filename):
-        if crime_type is None or row.crime_type == crime_type:
-            times.append(row.datetime)
-            points.append(proj(*row.point))
-    
-    if len(times) == 0:
+    frame = load_columns(filename, crime_type=crime_type, only_with_point=True)
+    if len(frame) == 0:
         return None
-    
-    times = _np.asarray(times)
-    points = _np.asarray(points)
-    if len(points.shape) == 1:
-        points = points[None,:]
-    i = _np.argsort(times)
-    times = times[i]
-    points = points[i,:]
-    
-    return _ocpd.TimedPoints(times, points.T)
+
+    proj = projector()
+    points = _np.asarray(proj(frame["lon"].values, frame["lat"].values))
+    times = frame["datetime"].values
+    i = _np.argsort(times, kind="stable")
+    return _ocpd.TimedPoints(times[i], points[:,i])
             
 def write(filename, rows):
     """Save a minimal version of the CSV file: includes all information to
@@ -122,23 +174,26 @@ def load_only_with_point(filename):
             continue
         yield row
 
-def to_geoframe(filename, filter=None):
+def to_geoframe(filename, filter=None, **kwargs):
     """Load the data to a GeoPandas dataframe.  Note that typically we have a
-    _lot_ of data, so use of `filter` is encouraged.
+    _lot_ of data, so use of `filter`, or the faster column filters, is
+    encouraged.  Skips entries with no geo-coding.
     
     :param filename: Filename or a file-like object opended in text mode.
     :param filter: If not null, a function object which takes a `Row` object
       and returns `True` if and only if we want this row.
+    :param kwargs: Passed to :func:`load_columns`, e.g. `crime_type`,
+      `start` and `end`.
     
     :return: GeoDataFrame
     """
-    if filter is None:
-        filter = lambda r : True
-    frame = _gpd.GeoDataFrame([row for row in load(filename) if filter(row) and row.point is not None])
-    def pt_to_point(pt):
-        return _geometry.Point(*pt)
-    frame.geometry = frame.point.map(pt_to_point)
-    frame = frame.drop(["point"], axis=1)
+    frame = load_columns(filename, **kwargs)
+    frame = frame[~_np.isnan(frame["lon"].values)]
+    if filter is not None:
+        frame = frame[[filter(row) for row in _frame_to_rows(frame)]]
+    geometry = _gpd.points_from_xy(frame["lon"].values, frame["lat"].values)
+    frame = _gpd.GeoDataFrame(frame.drop(["lon", "lat"], axis=1).reset_index(drop=True),
+        geometry=geometry)
     frame.crs = {"init":"epsg:4326"}
     return frame
     
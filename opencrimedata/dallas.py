@@ -9,13 +9,15 @@ https://data.cityofchicago.org/Public-Safety/Crimes-2001-to-present/ijzp-q8t2
 
 import csv as _csv
 import collections as _collections
-import datetime as _datetime
+import pickle as _pickle
+import tempfile as _tempfile
 import geopandas as _gpd
 import pandas as _pd
 import numpy as _np
 import shapely.geometry as _geometry
 import pyproj as _pyproj
 import fiona as _fiona
+from . import timestamps as _timestamps
 
 _HEADER = ["Service Number ID", "UCR Offense Description", "UCR Offense Name",
            "Starting  Date/Time", "Ending Date/Time", "Call Date Time",
@@ -108,11 +110,25 @@ def row_with_new_position(row, x, y):
     t = tuple(row)[:-2] + (None, (x,y))
     return Row(*t)
 
-def load_full(filename):
+def load_full(filename, max_pending=10000):
     """Load the data.  We try to find the record for each crime which contains
-    the most amount of information.  This costs memory and time.
+    the most amount of information.  Crimes are returned in the order in which
+    they first appear in the file.
+
+    A crime is only known to be complete once the whole file has been read,
+    so if the file can be read twice (a filename, or a seekable file object)
+    we first scan the file.  The scan finds the (rare) crimes whose records
+    are not next to each other, and keeps the records which come after the
+    first run of records of each such crime.  At most `max_pending` of these
+    crimes are kept in memory; the records of the oldest are written to a
+    temporary file.  We then read the file a second time, returning each crime
+    once its run of records has been read, so memory use is small.  Nothing is
+    returned until the scan has finished.  Otherwise, the whole file is read
+    into memory first.
     
     :param filename: Filename or a file-like object opened in text mode.
+    :param max_pending: The maximum number of out-of-order crimes to hold in
+      memory.
     
     :return: Iterable of typed rows of the data.
     """
@@ -121,21 +137,187 @@ def load_full(filename):
         filename = open(filename, "rt")
         toclose = True
     try:
-        reader = _csv.reader(filename)
-        header = [x.strip().upper() for x in next(reader)]
-        lookup = [header.index(x.upper()) for x in _HEADER]
-        data = _collections.defaultdict(list)
-        for row in reader:
-            s, detail = _process_row([row[x] for x in lookup])
-            data[detail.code].append((s,detail))
-        for choices in data.values():
-            ses = [x for x,_ in choices]
-            ses.sort()
-            assert ses == list(range(1,len(ses)+1))
-            yield Row(*_best(choices))
+        if not filename.seekable():
+            yield from _load_full_in_memory(_read_rows(filename))
+            return
+        start = filename.tell()
+        groups = _GroupStore(max_pending)
+        try:
+            captured = _collect_split_groups(_read_rows(filename), groups)
+            filename.seek(start)
+            yield from _load_full_streaming(_read_rows(filename), captured, groups)
+        finally:
+            groups.close()
     finally:
         if toclose:
             filename.close()
+
+def _read_rows(file):
+    """Yield the fields we use from each row of the csv file."""
+    reader = _csv.reader(file)
+    header = [x.strip().upper() for x in next(reader)]
+    lookup = [header.index(x.upper()) for x in _HEADER]
+    for row in reader:
+        yield [row[x] for x in lookup]
+
+def _load_full_in_memory(rows):
+    data = _collections.defaultdict(list)
+    for row in rows:
+        s, detail = _process_row(row)
+        data[detail.code].append((s,detail))
+    for choices in data.values():
+        yield _combine(choices)
+
+def _combine(choices):
+    """Combine the records, pairs `(subid, row)`, for one crime."""
+    ses = [x for x,_ in choices]
+    ses.sort()
+    assert ses == list(range(1,len(ses)+1))
+    return Row(*_best(choices))
+
+def _collect_split_groups(rows, groups):
+    """Find the crimes whose records are not all next to each other, and add
+    the records in every run after the first, for each such crime, to the
+    :class:`_GroupStore`.  Only the records added are fully parsed.
+
+    :return: List of pairs `[first, last]` of the (0-based) numbers of the
+      first and last rows of each run of records which was added.
+    """
+    seen = _HashSet()
+    captured = []
+    previous, capturing = None, False
+    for i, row in enumerate(rows):
+        code = _split_id(row[0])[0]
+        if code != previous:
+            previous = code
+            capturing = hash(code) in seen
+            if capturing:
+                captured.append([i, i])
+            else:
+                seen.add(hash(code))
+        if capturing:
+            groups.add(*_process_row(row))
+            captured[-1][1] = i
+    return captured
+
+def _finish(records, groups):
+    """Combine the records for one crime with any records in `groups`."""
+    code = records[0][1].code
+    if code in groups:
+        records = records + groups.pop(code)
+    return _combine(records)
+
+def _load_full_streaming(rows, captured, groups):
+    """Combine the records for each crime, and yield in order of first
+    appearance.  The runs of records in `captured` are skipped, as these are
+    already in `groups`.
+
+    :param captured: As returned by :func:`_collect_split_groups`.
+    :param groups: The :class:`_GroupStore` passed to
+      :func:`_collect_split_groups`.
+    """
+    runs = iter(captured)
+    run = next(runs, None)
+    current = []
+    for i, row in enumerate(rows):
+        if run is not None and i >= run[0]:
+            if len(current) > 0:
+                yield _finish(current, groups)
+                current = []
+            # Usually the crime has appeared before, but (if hashes collide)
+            # this may be the first appearance
+            code = _split_id(row[0])[0]
+            if i == run[0] and code in groups:
+                yield _combine(groups.pop(code))
+            if i == run[1]:
+                run = next(runs, None)
+            continue
+        subid, record = _process_row(row)
+        if len(current) > 0 and current[0][1].code != record.code:
+            yield _finish(current, groups)
+            current = []
+        current.append((subid, record))
+    if len(current) > 0:
+        yield _finish(current, groups)
+    assert len(groups) == 0
+
+
+class _HashSet():
+    """A set of integers, such as hashes, held compactly as a sorted array.
+    Recent additions are kept in a small set, and merged into the array once
+    there are `batch_size` of them."""
+    def __init__(self, batch_size=100000):
+        self._sorted = _np.empty(0, dtype=_np.int64)
+        self._recent = set()
+        self._batch_size = batch_size
+
+    def __contains__(self, value):
+        if value in self._recent:
+            return True
+        i = _np.searchsorted(self._sorted, value)
+        return i < len(self._sorted) and self._sorted[i] == value
+
+    def add(self, value):
+        self._recent.add(value)
+        if len(self._recent) >= self._batch_size:
+            recent = _np.fromiter(self._recent, dtype=_np.int64, count=len(self._recent))
+            self._sorted = _np.union1d(self._sorted, recent)
+            self._recent = set()
+
+
+class _GroupStore():
+    """Holds lists of records, keyed by crime code.  At most `max_memory`
+    codes have records held in memory; when a new code is added beyond this,
+    the records of the code added longest ago are written to a temporary
+    file.  Records must be picklable."""
+    def __init__(self, max_memory):
+        self._groups = _collections.OrderedDict()
+        self._max_memory = max(1, max_memory)
+        self._on_disk = dict()
+        self._file = None
+
+    def __len__(self):
+        return len(set(self._groups) | set(self._on_disk))
+
+    def __contains__(self, code):
+        return code in self._groups or code in self._on_disk
+
+    @property
+    def codes_in_memory(self):
+        return len(self._groups)
+
+    def add(self, subid, record):
+        """Add the pair `(subid, record)` to the group for `record.code`."""
+        code = record.code
+        if code in self._groups:
+            self._groups[code].append((subid, record))
+            return
+        self._groups[code] = [(subid, record)]
+        while len(self._groups) > self._max_memory:
+            self._spill(*self._groups.popitem(last=False))
+
+    def _spill(self, code, records):
+        if self._file is None:
+            self._file = _tempfile.TemporaryFile()
+        self._file.seek(0, 2)
+        self._on_disk.setdefault(code, []).append(self._file.tell())
+        _pickle.dump(records, self._file)
+
+    def pop(self, code):
+        """Remove and return the list of records for `code`."""
+        records = []
+        for position in self._on_disk.pop(code, []):
+            self._file.seek(position)
+            records.extend(_pickle.load(self._file))
+        records.extend(self._groups.pop(code, []))
+        if len(self._on_disk) == 0:
+            self.close()
+        return records
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
     
 def _best(choices):
     choices = {s:d for (s,d) in choices}
@@ -176,7 +358,7 @@ def _all_agree_up_to_none(choices):
 def _to_dt(x):
     if x == "":
         return None
-    return _datetime.datetime.strptime(x, _DT_FMT)
+    return _timestamps.parser(_DT_FMT)(x)
             
 def _to_lon_lat(x):
     x = x.splitlines()
@@ -192,11 +374,14 @@ def _to_lon_lat(x):
         return None
     return lon, lat
 
+def _split_id(x):
+    """Split the "service number" into the crime code and the sub-record
+    number."""
+    parts = x.replace(" ", "").split("-")
+    return "-".join(parts[:2]), int(parts[2])
+
 def _process_row(row):
-    parts = row[0].replace(" ", "").split("-")
-    subid = int(parts[2])
-    
-    code = "-".join(parts[:2])
+    code, subid = _split_id(row[0])
     start = _to_dt(row[3])
     end = _to_dt(row[4])
     call = _to_dt(row[5])
@@ -0,0 +1,134 @@
+"""
+disjoint_set
+~~~~~~~~~~~~
+
+Array backed "union-find" data structure, used to find connected components
+when merging points, without building a graph.
+"""
+
+import numpy as _np
+
+class DisjointSet():
+    """Disjoint set forest on the elements `0, ..., size-1`, with path
+    compression and union by rank.  Pairs can be joined one at a time, with
+    :meth:`union`, or as an array, with :meth:`union_pairs`.
+
+    :param size: The number of elements.
+    """
+    def __init__(self, size):
+        self._parent = _np.arange(size, dtype=_np.int64)
+        self._rank = _np.zeros(size, dtype=_np.int64)
+
+    @property
+    def size(self):
+        """The number of elements."""
+        return len(self._parent)
+
+    def find(self, i):
+        """Find the representative element of the set containing `i`."""
+        parent = self._parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return int(root)
+
+    def union(self, i, j):
+        """Join the sets containing `i` and `j`.
+
+        :return: `True` if the sets were distinct, `False` otherwise.
+        """
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return False
+        if self._rank[i] < self._rank[j]:
+            i, j = j, i
+        self._parent[j] = i
+        if self._rank[i] == self._rank[j]:
+            self._rank[i] += 1
+        return True
+
+    def _compress(self):
+        """Point every element directly at its representative."""
+        parent = self._parent
+        while True:
+            grandparent = parent[parent]
+            if _np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        self._parent = parent
+
+    def _jump(self, elements):
+        """Pointer jumping on `elements`, which must be closed under taking
+        the parent, until each points directly at its representative.  Takes
+        a number of steps logarithmic in the length of the longest path."""
+        parent = self._parent
+        while True:
+            parents = parent[elements]
+            grandparents = parent[parents]
+            if _np.array_equal(grandparents, parents):
+                break
+            parent[elements] = grandparents
+
+    def _find_many(self, elements):
+        """Vectorised :meth:`find`, compressing the paths of `elements`
+        only, so the cost does not depend on the total number of elements."""
+        parent = self._parent
+        roots = parent[elements]
+        while True:
+            next_roots = parent[roots]
+            if _np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        parent[elements] = roots
+        return roots
+
+    def union_pairs(self, pairs):
+        """Join the sets containing `i` and `j` for each row `(i,j)` of
+        `pairs`.  Proceeds in rounds: in each round every representative
+        which needs to be joined is attached to a representative of higher
+        (rank, lower index).  The work done is proportional to the number of
+        pairs (times the small number of rounds), not the number of elements,
+        so calling this repeatedly with small arrays is efficient.
+
+        :param pairs: Array of shape `(m,2)` of elements.
+        """
+        pairs = _np.asarray(pairs, dtype=_np.int64).reshape(-1, 2)
+        n = self.size
+        while len(pairs) > 0:
+            a, b = self._find_many(pairs[:,0]), self._find_many(pairs[:,1])
+            keep = a != b
+            pairs, a, b = pairs[keep], a[keep], b[keep]
+            if len(pairs) == 0:
+                break
+            # Order the representatives strictly, so no cycles can form
+            key_a = self._rank[a] * n + (n - 1 - a)
+            key_b = self._rank[b] * n + (n - 1 - b)
+            swap = key_a > key_b
+            a, key_b = _np.where(swap, b, a), _np.maximum(key_a, key_b)
+            # For each representative to attach, the largest possible target
+            order = _np.lexsort((key_b, a))
+            a, key_b = a[order], key_b[order]
+            last = _np.append(a[1:] != a[:-1], True)
+            roots = a[last]
+            targets = n - 1 - key_b[last] % n
+            self._parent[roots] = targets
+            equal_rank = self._rank[roots] == self._rank[targets]
+            self._rank[targets[equal_rank]] += 1
+            # A chain of pairs, such as `(i, i+1)`, hooks a chain of roots, so
+            # compress the new paths before the next call to `_find_many`
+            self._jump(_np.union1d(roots, targets))
+
+    def roots(self):
+        """Array giving the representative element of each element."""
+        self._compress()
+        return self._parent.copy()
+
+    def labels(self):
+        """Array giving, for each element, the number of its set.  The sets
+        are numbered `0, 1, ...` in order of their smallest element."""
+        _, first, inverse = _np.unique(self.roots(), return_index=True, return_inverse=True)
+        rank = _np.empty(len(first), dtype=_np.int64)
+        rank[_np.argsort(first)] = _np.arange(len(first))
+        return rank[inverse.ravel()]
@@ -8,12 +8,60 @@ Some simple geometry routines.
 import numpy as _np
 import scipy.spatial as _spatial
 import open_cp.network as _network
+import shapely as _shapely
 import shapely.geometry as _shapelygeometry
+import shapely.ops as _shapelyops
+import shapely.prepared as _shapelyprepared
 import collections as _collections
+import itertools as _itertools
+from . import disjoint_set as _disjoint_set
 import logging as _logging
 
 _logger = _logging.getLogger(__name__)
 
+class PointLookup():
+    """Find the index of points in a fixed collection of points, for many
+    points at once.  Each point `(x,y)` is viewed as the complex number
+    `x + iy`, and these are sorted (lexicographically) so that lookups are a
+    binary search.  Points match exactly, as for a dictionary keyed by tuples.
+
+    :param points: Array of shape `(n,2)`.
+    """
+    def __init__(self, points):
+        keys = self._to_keys(points)
+        self._order = _np.argsort(keys, kind="stable")
+        self._keys = keys[self._order]
+
+    @staticmethod
+    def _to_keys(points):
+        # Adding zero turns -0.0 into 0.0, which should compare equal
+        points = _np.asarray(points, dtype=_np.float64).reshape(-1, 2) + 0.0
+        return _np.ascontiguousarray(points).view(_np.complex128).ravel()
+
+    def indices(self, points):
+        """Find the indices of the points.
+
+        :param points: Array of shape `(m,2)`.
+
+        :return: Array of shape `(m,)` of indices into the original points,
+          or `-1` if the point was not found.
+        """
+        keys = self._to_keys(points)
+        if len(self._keys) == 0:
+            return _np.full(len(keys), -1, dtype=_np.int64)
+        locations = _np.minimum(_np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        found = self._keys[locations] == keys
+        return _np.where(found, self._order[locations], -1)
+
+    def index(self, pt):
+        """Find the index of a single point.  Raises `KeyError` if the point
+        was not found."""
+        i = self.indices([pt])[0]
+        if i < 0:
+            raise KeyError(tuple(pt))
+        return int(i)
+
+
 class AggregatePoints():
     """Merge very close points together.  Does not try to find an optimal
     solution, but instead uses a greedy algorithm.
@@ -22,7 +70,7 @@ class AggregatePoints():
     :param tolerance: The cut-off distance at which points will be merged.
     """
     def __init__(self, points, tolerance = 0.1):
-        all_nodes = list(set(((x,y) for x,y in points)))
+        all_nodes = _unique_points(points)
         tree = _spatial.cKDTree(all_nodes)
         
         self._nodes = []
@@ -32,25 +80,76 @@ class AggregatePoints():
             if i in allnodes_to_nodes_lookup:
                 continue
             index = len(self._nodes)
-            self._nodes.append(pt)
+            self._nodes.append(tuple(pt.tolist()))
             for x in tree.query_ball_point(pt, tolerance):
                 if x not in allnodes_to_nodes_lookup:
                     allnodes_to_nodes_lookup[x] = index
                     
-        self._lookup = {pt:allnodes_to_nodes_lookup[i] for i, pt in enumerate(all_nodes)}
+        self._point_lookup = PointLookup(all_nodes)
+        self._lookup = _np.asarray([allnodes_to_nodes_lookup[i]
+            for i in range(len(all_nodes))], dtype=_np.int64)
 
     @property
     def merged_points(self):
         return self._nodes
+
+    def indices(self, points):
+        """For each point, which must have been in the input, find the index
+        into :attr:`merged_points`.
+
+        :param points: Array of shape `(m,2)`.
+
+        :return: Array of shape `(m,)`.
+        """
+        return _lookup_indices(self._point_lookup, self._lookup, points)
     
     def index(self, pt):
-        pt = tuple(pt)
-        return self._lookup[pt]
+        return int(self.indices([pt])[0])
     
     def __getitem__(self, pt):
         return self._nodes[self.index(pt)]
 
 
+def _lookup_indices(point_lookup, lookup, points):
+    """Find the points with the :class:`PointLookup` and map through the
+    array `lookup`.  Raises `KeyError` for any missing point."""
+    indices = point_lookup.indices(points)
+    missing = _np.nonzero(indices < 0)[0]
+    if len(missing) > 0:
+        points = _np.asarray(points).reshape(-1, 2)
+        raise KeyError(tuple(points[missing[0]]))
+    return lookup[indices]
+
+def _unique_points(points):
+    """Array of shape `(n,2)` of the distinct points, in sorted order."""
+    points = _np.asarray(list(points) if not hasattr(points, "__len__") else points,
+        dtype=_np.float64).reshape(-1, 2)
+    return _np.unique(points, axis=0)
+
+def closest_to_centroids(points, labels):
+    """For each group of points, find the point closest to the centroid of
+    the group.  In case of ties, the first such point is chosen.
+
+    :param points: Array of shape `(n,2)`
+    :param labels: Array of shape `(n,)` giving the group of each point; the
+      groups should be numbered `0, ..., k-1`.
+
+    :return: Array of shape `(k,)` of indices into `points`.
+    """
+    labels = _np.asarray(labels, dtype=_np.int64)
+    if len(labels) == 0:
+        return _np.empty(0, dtype=_np.int64)
+    order = _np.argsort(labels, kind="stable")
+    counts = _np.bincount(labels)
+    starts = _np.concatenate([[0], _np.cumsum(counts)[:-1]])
+    pts = points[order]
+    centroids = _np.add.reduceat(pts, starts, axis=0) / counts[:,None]
+    distsq = _np.sum((pts - centroids[labels[order]])**2, axis=1)
+    # Sort each group by distance; as the sort is stable, ties keep the
+    # original order, as `numpy.argmin` would.
+    by_distance = _np.lexsort((distsq, labels[order]))
+    return order[by_distance[starts]]
+
 class AggregatePointsViaGraph():
     """Merge very close points together.  Proceeds by forming a graph whose
     vertices are the points, and where vertices are joined by an edge if they
@@ -62,45 +161,42 @@ class AggregatePointsViaGraph():
     :param tolerance: The cut-off distance at which points will be merged.
     """
     def __init__(self, points, tolerance = 0.1):
-        all_nodes = list(set(((x,y) for x,y in points)))
-        all_nodes.sort()
-        all_nodes = _np.asarray(all_nodes)
-        builder = _network.GraphBuilder()
-        idx = _np.arange(all_nodes.shape[0])
-        tsq = tolerance ** 2
+        all_nodes = _unique_points(points)
         _logger.debug("Merging %s points", len(all_nodes))
-        for i, pt in enumerate(all_nodes):
-            builder.vertices.add(i)
-            distsq = _np.sum((all_nodes[i+1:] - pt)**2, axis=1)
-            for j in idx[i+1:][distsq <= tsq]:
-                builder.add_edge(i, j)
-            if i % 1000 == 0:
-                _logger.debug("Done %s / %s points", i, len(all_nodes))
-        graph = builder.build()
-        
-        self._make_data(graph, all_nodes)
+        pairs = _spatial.cKDTree(all_nodes).query_pairs(tolerance, output_type="ndarray")
+        _logger.debug("Found %s pairs of close points", len(pairs))
+        components = _disjoint_set.DisjointSet(len(all_nodes))
+        components.union_pairs(pairs)
+        self._make_data(components.labels(), all_nodes)
 
-    def _make_data(self, graph, all_nodes):
-        self._nodes = []
-        self._lookup = dict()
-        for com in _network.connected_components(graph):
-            pts = all_nodes[list(com)]
-            centroid = _np.mean(pts, axis=0)
-            assert centroid.shape == (2,)
-            i = _np.argmin( _np.sum((pts - centroid)**2, axis=1) )
-            self._nodes.append(pts[i])
-            for j in com:
-                ptj = tuple(all_nodes[j])
-                self._lookup[ptj] = len(self._nodes) - 1
-        self._nodes = _np.asarray(self._nodes)
+    def _make_data(self, labels, all_nodes):
+        """Find the merged points.
+
+        :param labels: Array giving, for each point, the number of the
+          connected component it is in, as from
+          :meth:`disjoint_set.DisjointSet.labels`.
+        :param all_nodes: Array of shape `(n,2)` of the points.
+        """
+        self._point_lookup = PointLookup(all_nodes)
+        self._nodes = all_nodes[closest_to_centroids(all_nodes, labels)]
+        self._lookup = _np.asarray(labels, dtype=_np.int64)
 
     @property
     def merged_points(self):
         return self._nodes
+
+    def indices(self, points):
+        """For each point, which must have been in the input, find the index
+        into :attr:`merged_points`.
+
+        :param points: Array of shape `(m,2)`.
+
+        :return: Array of shape `(m,)`.
+        """
+        return _lookup_indices(self._point_lookup, self._lookup, points)
     
     def index(self, pt):
-        pt = tuple(pt)
-        return self._lookup[pt]
+        return int(self.indices([pt])[0])
     
     def __getitem__(self, pt):
         return self._nodes[self.index(pt)]
@@ -117,21 +213,18 @@ class AggregatePointsViaGraphFast(AggregatePointsViaGraph):
     """As :class:`AggregatePointsViaGraph` but using `rtree` to accelerate
     the initial grouping of points."""
     def __init__(self, points, tolerance = 0.1):
-        all_nodes = list(set(((x,y) for x,y in points)))
-        all_nodes = _np.asarray(all_nodes)
-        builder = _network.GraphBuilder()
+        all_nodes = _unique_points(points)
         index = self._make_index(all_nodes, tolerance)
         
         d = tolerance / 20
+        pairs = []
         for i, pt in enumerate(all_nodes):
-            builder.vertices.add(i)
             x, y = pt
-            for j in index.intersection((x-d, y-d, x+d, y+d)):
-                if i < j:
-                    builder.add_edge(i, j)
-        graph = builder.build()
+            pairs.extend((i, j) for j in index.intersection((x-d, y-d, x+d, y+d)) if i < j)
+        components = _disjoint_set.DisjointSet(len(all_nodes))
+        components.union_pairs(pairs)
         
-        self._make_data(graph, all_nodes)
+        self._make_data(components.labels(), all_nodes)
 
     @staticmethod
     def _make_index(all_nodes, tolerance):
@@ -143,13 +236,98 @@ class AggregatePointsViaGraphFast(AggregatePointsViaGraph):
         return _rtree.index.Index(index_gen())
 
 
+def _polygon_parts(geometry):
+    """Yield the non-empty polygons making up a geometry."""
+    for geom in getattr(geometry, "geoms", [geometry]):
+        if geom.geom_type == "Polygon" and not geom.is_empty:
+            yield geom
+        elif hasattr(geom, "geoms"):
+            yield from _polygon_parts(geom)
+
+def triangulate(polygon):
+    """Decompose a polygon (which may have holes, or be a multi-polygon)
+    into triangles.  We form the Delaunay triangulation of the vertices, and
+    intersect each triangle with the polygon.  As no vertex lies inside a
+    triangle, each intersection is convex, and so is easily split into
+    triangles.
+
+    :param polygon: A `shapely` polygon object.
+
+    :return: Array of shape `(k,3,2)` of triangles.
+    """
+    prepared = _shapelyprepared.prep(polygon)
+    triangles = []
+    for triangle in _shapelyops.triangulate(polygon):
+        if prepared.contains(triangle):
+            pieces = [triangle]
+        else:
+            pieces = _polygon_parts(triangle.intersection(polygon))
+        for piece in pieces:
+            coords = _np.asarray(piece.exterior.coords)[:-1]
+            for i in range(1, len(coords) - 1):
+                triangles.append((coords[0], coords[i], coords[i+1]))
+    return _np.asarray(triangles, dtype=_np.float64).reshape(-1, 3, 2)
+
+
+class PolygonSampler():
+    """Sample points uniformly at random from a polygon, without rejection.
+    The polygon is decomposed into triangles once, see :func:`triangulate`;
+    to sample, triangles are chosen according to area, and then a point is
+    chosen uniformly in each triangle.
+
+    :param polygon: A `shapely` polygon object.
+    """
+    def __init__(self, polygon):
+        self._triangles = triangulate(polygon)
+        a, b, c = self._triangles[:,0], self._triangles[:,1], self._triangles[:,2]
+        self._origins = a
+        self._sides1, self._sides2 = b - a, c - a
+        areas = _np.abs(self._sides1[:,0] * self._sides2[:,1]
+            - self._sides1[:,1] * self._sides2[:,0]) / 2
+        self._cumulative = _np.cumsum(areas)
+
+    @property
+    def triangles(self):
+        """Array of shape `(k,3,2)` of triangles."""
+        return self._triangles
+
+    @property
+    def area(self):
+        """The total area of the triangles."""
+        return self._cumulative[-1] if len(self._cumulative) > 0 else 0.0
+
+    def sample(self, size=1):
+        """Sample points uniformly at random.  Uses :mod:`numpy.random`.
+
+        :param size: The number of points.
+
+        :return: Array of shape `(size,2)`.
+        """
+        if not self.area > 0:
+            raise ValueError("Polygon has zero area.")
+        targets = _np.random.random(size) * self._cumulative[-1]
+        choices = _np.searchsorted(self._cumulative, targets, side="right")
+        choices = _np.minimum(choices, len(self._cumulative) - 1)
+        r = _np.random.random(size=(size, 2))
+        # Reflect points in the far half of the parallelogram into the triangle
+        flip = r[:,0] + r[:,1] > 1
+        r[flip] = 1 - r[flip]
+        return (self._origins[choices] + r[:,0,None] * self._sides1[choices]
+            + r[:,1,None] * self._sides2[choices])
+
+
 class Redistributor():
-    """Allow sampling points uniformly at random from polygons.
+    """Allow sampling points uniformly at random from polygons.  Each polygon
+    is triangulated the first time it is sampled from, see
+    :class:`PolygonSampler`.
     
     :param polygons: List of `shapely` polygon objects.
     """
     def __init__(self, polygons):
         self._polygons = polygons
+        self._samplers = dict()
+        self._strtree = None
+        self._prepared = None
         self._make_index()
         
     @property
@@ -167,29 +345,61 @@ class Redistributor():
         return [i for i in self._index.intersection((x-.1,y-.1,x+.1,y+.1))
                 if self._polygons[i].intersects(pt)]
 
+    def find_containing_polygons(self, points):
+        """Find a containing polygon for many points at once.  If a point is
+        in more than one polygon, the lowest index is returned.  With
+        `shapely` 2, uses a bulk query of an `STRtree`; otherwise tests each
+        point against prepared geometries.
+
+        :param points: Array of shape `(n,2)`.
+
+        :return: Array of shape `(n,)` of indices into `self.polygons`, or
+          `-1` if the point is in no polygon.
+        """
+        points = _np.asarray(points, dtype=_np.float64).reshape(-1, 2)
+        if hasattr(_shapely, "points"):
+            if self._strtree is None:
+                self._strtree = _shapely.STRtree(self._polygons)
+            point_indices, polygon_indices = self._strtree.query(
+                _shapely.points(points), predicate="intersects")
+            out = _np.full(len(points), len(self._polygons), dtype=_np.int64)
+            _np.minimum.at(out, point_indices, polygon_indices)
+            out[out == len(self._polygons)] = -1
+            return out
+        return _np.asarray([self._find_prepared(x, y) for x, y in points],
+            dtype=_np.int64).reshape(-1)
+
+    def _find_prepared(self, x, y):
+        if self._prepared is None:
+            self._prepared = [_shapelyprepared.prep(p) for p in self._polygons]
+        pt = _shapelygeometry.Point(x, y)
+        if self._index is None:
+            candidates = range(len(self._polygons))
+        else:
+            candidates = sorted(self._index.intersection((x, y, x, y)))
+        for i in candidates:
+            if self._prepared[i].intersects(pt):
+                return i
+        return -1
+
     def redistribute_from_poly(self, index, size=1):
         """Return a number of points in the polygon.
         
         :param index: Index into `self.polygons`.
-        :param size: The _minimum_ number of points to return.
+        :param size: The number of points to return.
         
-        :return: Array of points, empty if no polygon.
+        :return: Array of points, of shape `(size,2)`.
         """
-        polygon = self._polygons[index]
-        xmin, ymin, xmax, ymax = polygon.bounds
-        xd, yd = xmax - xmin, ymax - ymin
-        ratio = xd * yd / polygon.area
-        out = []
-        while len(out) < size:
-            need = int((size - len(out) + 1) * ratio)
-            pts = _np.random.random(size=(need, 2))
-            pts = pts * _np.asarray([xd, yd])[None,:] + _np.asarray([xmin, ymin])[None,:]
-            pts = _shapelygeometry.MultiPoint(pts)
-            pts = _np.asarray(pts.intersection(polygon))
-            if len(pts) == 0:
-                continue
-            out.extend( _np.atleast_2d(pts) )
-        return out
+        return self.sampler(index).sample(size)
+
+    def sampler(self, index):
+        """The (cached) :class:`PolygonSampler` for a polygon.
+
+        :param index: Index into `self.polygons`.
+        """
+        if index not in self._samplers:
+            self._samplers[index] = PolygonSampler(self._polygons[index])
+        return self._samplers[index]
 
     def redistribute(self, x, y, size=1):
         """Return a number of points in the polygon containing the points.
@@ -202,6 +412,26 @@ class Redistributor():
         if len(choices) == 0:
             return []
         return self.redistribute_from_poly(choices[0], size)
+
+    def redistribute_many(self, points):
+        """For each point, return a new point chosen uniformly at random from
+        the polygon containing it.  Points are grouped by polygon, so each
+        polygon is sampled from once.
+
+        :param points: Array of shape `(n,2)`.
+
+        :return: Array of shape `(n,2)`; rows are `nan` for points not in
+          any polygon.
+        """
+        indices = self.find_containing_polygons(points)
+        out = _np.full((len(indices), 2), _np.nan)
+        order = _np.argsort(indices, kind="stable")
+        polygons, starts = _np.unique(indices[order], return_index=True)
+        ends = _np.append(starts[1:], len(order))
+        for index, start, end in zip(polygons.tolist(), starts.tolist(), ends.tolist()):
+            if index >= 0:
+                out[order[start:end]] = self.redistribute_from_poly(index, end - start)
+        return out
     
     def _make_index(self):
         if _rtree is None:
@@ -214,49 +444,216 @@ class Redistributor():
         self._index = _rtree.index.Index(index_gen())
 
 
+CacheInfo = _collections.namedtuple("CacheInfo", "hits misses evictions polygons points")
+
+
 class CachingRedistributor(Redistributor):
-    """As :class:`Redistributor` but caching lists of points for polygons,
-    to support faster and richer operations, at the expense of space."""
-    def __init__(self, polygons):
+    """As :class:`Redistributor` but caching arrays of points for polygons,
+    to support faster and richer operations, at the expense of space.
+
+    The cache holds at most (about) `max_points` points in total, which take
+    16 bytes each.  When this is exceeded, the polygons used least recently
+    are evicted from the cache.
+
+    :param polygons: List of `shapely` polygon objects.
+    :param max_points: The memory budget of the cache, in points.
+    :param block_size: The largest number of points to sample at once for a
+      polygon, unless more are requested.  For each polygon, we start by
+      sampling 2 points, and then double the number each time.
+    :param max_discs: The number of intersections of polygons with discs
+      to cache, see :meth:`redistribute_within_radius`.
+    :param min_acceptance: If the area of the disc is at least this fraction
+      of the area of the polygon, :meth:`redistribute_within_radius` uses
+      rejection sampling from the cached points of the polygon.
+    """
+    def __init__(self, polygons, max_points=1000000, block_size=128, max_discs=10000,
+            min_acceptance=0.1):
         super().__init__(polygons)
-        self._cache = dict()
-        self._maxsize = 128
-        self._maxsize_cache = dict()
-        
-    def _populate(self, index, size):
-        if index not in self._cache:
-            self._cache[index] = []
-            self._maxsize_cache[index] = 1
-        if len(self._cache[index]) < size:
-            s = max(size, min(self._maxsize_cache[index] * 2, self._maxsize))
-            self._maxsize_cache[index] = s
-            self._cache[index].extend( super().redistribute_from_poly(index, s) )
-        return self._cache[index]
-        
+        self._min_acceptance = min_acceptance
+        self._cache = _collections.OrderedDict()
+        self._max_points = max_points
+        self._block_size = block_size
+        self._disc_samplers = _collections.OrderedDict()
+        self._max_discs = max_discs
+        self._cached_points = 0
+        self._hits, self._misses, self._evictions = 0, 0, 0
+
+    def cache_info(self):
+        """Statistics about the cache.
+
+        :return: Named tuple with fields `hits` and `misses`, counting
+          requests served from the cache and requests which needed new
+          samples; `evictions`, the number of polygons removed from the
+          cache; `polygons` and `points`, the current size of the cache.
+        """
+        return CacheInfo(self._hits, self._misses, self._evictions,
+            len(self._cache), self._cached_points)
+
+    def _take(self, index, size):
+        """Remove and return `size` points for polygon `index` from the
+        cache, sampling more if needed."""
+        entry = self._cache.get(index)
+        if entry is not None and entry[1] >= size:
+            self._hits += 1
+            self._cache.move_to_end(index)
+        else:
+            self._misses += 1
+            entry = self._refill(index, entry, size)
+        points, count, _ = entry
+        entry[1] = count - size
+        return points[count - size : count].copy()
+
+    def _refill(self, index, entry, size):
+        """Replace the cache entry by one with at least `size` points.  Entries
+        are lists `[points, count, block]` where the first `count` rows of the
+        array `points` are unused samples, and `block` is the number of points
+        last sampled."""
+        if entry is None:
+            remaining, block = _np.empty((0, 2)), 1
+        else:
+            points, count, block = entry
+            remaining = points[:count]
+            self._cached_points -= len(points)
+            del self._cache[index]
+        block = max(size, min(block * 2, self._block_size))
+        points = _np.empty((len(remaining) + block, 2))
+        points[:len(remaining)] = remaining
+        points[len(remaining):] = super().redistribute_from_poly(index, block)
+        entry = [points, len(points), block]
+        self._cache[index] = entry
+        self._cached_points += len(points)
+        self._evict()
+        return entry
+
+    def _evict(self):
+        """Remove least recently used entries, but never the most recent, until
+        within the memory budget."""
+        while self._cached_points > self._max_points and len(self._cache) > 1:
+            _, (points, _, _) = self._cache.popitem(last=False)
+            self._cached_points -= len(points)
+            self._evictions += 1
+
     def redistribute_from_poly(self, index, size=1):
-        out = self._populate(index, size)
-        toret = out[-size:]
-        del out[-size:]
-        return toret
+        return self._take(index, size)
     
-    def redistribute_within_radius(self, x, y, radius):
-        """Return a single point in the polygon containing that point, and
-        within a disc of the given radius.
+    def redistribute_within_radius(self, x, y, radius, size=None):
+        """Return points in the polygon containing that point, and within a
+        disc of the given radius.
+
+        If the disc is large compared to the polygon, we use rejection
+        sampling from the cached points of the polygon.  Otherwise, we
+        intersect the polygon with a slightly larger disc, centred on a grid
+        of spacing `radius / 8`, so that nearby centres with the same radius
+        share a (cached) :class:`PolygonSampler`, and use rejection sampling
+        from that.  Either way, points are uniformly distributed in the
+        intersection of the polygon with the true disc.
+
+        If `radius` is zero, or the polygon has zero area, then the
+        intersection has zero area, and we return copies of the centre
+        `(x,y)`.  If the intersection is too small to compute or sample from,
+        for example if `radius` is close to the floating point resolution of
+        the coordinates, then we fall back to (bounded) rejection sampling
+        from the whole polygon, and raise a `ValueError` if this fails.
         
-        :return: A point `(x,y)` or `None` if no containing polygon
+        :param size: The number of points to return, or `None` to return a
+          single point.
+
+        :return: A point `(x,y)`, or array of shape `(size,2)`, or `None` if
+          no containing polygon
         """
         choices = self.find_containing_polygon(x, y)
         if len(choices) == 0:
             return None
         index = choices[0]
-        out = self._populate(index, 1)
-        rs = radius * radius
-        while True:
-            xx, yy = out.pop()
-            if (x-xx)*(x-xx) + (y-yy)*(y-yy) <= rs:
-                return xx, yy
-            if len(out) == 0:
-                out = self._populate(index, 1)
+        count = 1 if size is None else size
+        area = self._polygons[index].area
+        disc_area = _np.pi * radius * radius
+        points = None
+        if not (disc_area > 0 and area > 0):
+            points = _np.tile(_np.asarray([x, y], dtype=_np.float64), (count, 1))
+        elif disc_area >= self._min_acceptance * area:
+            points = _sample_in_disc(lambda n : self._take(index, n), x, y, radius,
+                count, min(disc_area / area, 1))
+        if points is None:
+            sampler, acceptance = self._disc_sampler(index, x, y, radius)
+            if sampler.area > 0:
+                points = _sample_in_disc(sampler.sample, x, y, radius, count, acceptance)
+        if points is None:
+            # Very low acceptance; sample from this disc alone
+            region = self._polygons[index].intersection(_disc_polygon(x, y, radius))
+            sampler = PolygonSampler(region)
+            if sampler.area > 0:
+                points = _sample_in_disc(sampler.sample, x, y, radius, count,
+                    1, max_rounds=1000)
+        if points is None:
+            # The intersection is too small for `shapely` to compute; try
+            # rejection sampling from the whole polygon, with a bounded effort
+            points = _sample_in_disc(lambda n : self._take(index, n), x, y, radius,
+                count, max(disc_area / area, 1e-9), max_batch=100000)
+        if points is None:
+            raise ValueError("Cannot sample from the intersection of polygon {} "
+                "and the disc of radius {} about ({}, {}), which is too "
+                "small.".format(index, radius, x, y))
+        if size is None:
+            return tuple(points[0])
+        return points
+
+    def _disc_sampler(self, index, x, y, radius):
+        """The sampler for the intersection of polygon `index` with a disc
+        centred at the grid point closest to `(x,y)`, which contains the disc
+        about `(x,y)`, together with the estimated acceptance rate."""
+        spacing = radius / _DISC_GRID
+        i, j = int(_np.round(x / spacing)), int(_np.round(y / spacing))
+        key = (index, radius, i, j)
+        if key in self._disc_samplers:
+            self._disc_samplers.move_to_end(key)
+            return self._disc_samplers[key]
+        outer_radius = radius + spacing * _np.sqrt(0.5)
+        region = self._polygons[index].intersection(
+            _disc_polygon(i * spacing, j * spacing, outer_radius))
+        entry = (PolygonSampler(region), (radius / outer_radius) ** 2)
+        self._disc_samplers[key] = entry
+        while len(self._disc_samplers) > self._max_discs:
+            self._disc_samplers.popitem(last=False)
+        return entry
+
+
+_DISC_GRID = 8
+
+def _disc_polygon(x, y, radius, quad_segs=16):
+    """A polygon containing the disc, with `4 * quad_segs` sides."""
+    return _shapelygeometry.Point(x, y).buffer(radius / _np.cos(_np.pi / (4 * quad_segs)),
+        quad_segs)
+
+def _sample_in_disc(sample, x, y, radius, size, acceptance, max_rounds=20,
+        max_batch=None):
+    """Rejection sampling of points in the disc.
+
+    :param sample: Callable which takes `n` and returns an array of `n`
+      points.
+    :param acceptance: The estimated fraction of points inside the disc, used
+      to choose how many points to draw.
+    :param max_rounds: Give up after this many rounds of sampling.
+    :param max_batch: If not `None`, the most points to draw in one round.
+
+    :return: Array of shape `(size,2)` or `None` if we gave up.
+    """
+    out = _np.empty((size, 2))
+    found = 0
+    for _ in range(max_rounds):
+        if found == size:
+            break
+        needed = size - found
+        batch = int(_np.ceil(needed / acceptance * 1.2)) + 1
+        if max_batch is not None:
+            batch = min(batch, max_batch)
+        pts = _np.asarray(sample(batch))
+        inside = pts[_np.sum((pts - [x, y])**2, axis=1) <= radius * radius][:needed]
+        out[found : found + len(inside)] = inside
+        found += len(inside)
+    if found < size:
+        return None
+    return out
 
 
 try:
@@ -267,22 +664,19 @@ except:
 
 class ClosestPoint():
     """Find the closest point in an input collection, or match to a closest
-    point in disc.  Useful for working with the address database.
+    point in disc.  Useful for working with the address database.  Uses a
+    `scipy.spatial.cKDTree`, and offers batch queries which run in parallel.
 
     :param points: The input points we'll match to; array of shape `(n,2)`
-    :param scale: Defaults to 1; should be "small" compared to the input
-      scale.
+    :param scale: Unused, and kept for compatibility.
+    :param workers: Number of threads to use for batch queries, passed to
+      `cKDTree`; `-1` means to use all processors.
     """
-    def __init__(self, points, scale=1):
+    def __init__(self, points, scale=1, workers=-1):
         self._points = _np.asarray(points)
         self._scale = scale
-        self._index = _rtree.index.Index(self._index_gen(self._scale))
-
-    def _index_gen(self, e):
-        for i, (x, y) in enumerate(self._points):
-            xmin, xmax = x-e, x+e
-            ymin, ymax = y-e, y+e
-            yield i, (xmin, ymin, xmax, ymax), None
+        self._workers = workers
+        self._tree = _spatial.cKDTree(self._points)
 
     @property
     def points(self):
@@ -298,75 +692,414 @@ class ClosestPoint():
         :return: Pair `(index, point)` where point is the closest point,
           and `index` is into :attr:`points`.
         """
-        pt = _np.asarray(pt)
-        d = 10 * self._scale
-        choices = []
-        while len(choices) == 0:
-            d += d
-            xmin, xmax = pt[0] - d, pt[0] + d
-            ymin, ymax = pt[1] - d, pt[1] + d
-            choices = list(self._index.intersection((xmin, ymin, xmax, ymax)))
-        diffs = pt - self._points[choices]
-        distsqs = _np.sum(diffs**2, axis=1)
-        i = _np.argmin(distsqs)
-        i = choices[i]
-        return i, self._points[i]
+        _, i = self._tree.query(_np.asarray(pt))
+        return int(i), self._points[i]
+
+    def closest_many(self, points, k=1, max_distance=None):
+        """Find the closest input point(s) to each of many points.
+
+        :param points: Array of shape `(m,2)`.
+        :param k: The number of closest points to find.
+        :param max_distance: If not `None`, only match input points within
+          this distance.
+
+        :return: Array of indices into :attr:`points`, of shape `(m,)` if
+          `k==1` and otherwise of shape `(m,k)`, ordered closest first.  If
+          there is no match (within `max_distance`) then the index is `-1`.
+        """
+        points = _np.asarray(points, dtype=_np.float64).reshape(-1, 2)
+        upper_bound = _np.inf if max_distance is None else max_distance
+        _, indices = self._tree.query(points, k=k, distance_upper_bound=upper_bound,
+            workers=self._workers)
+        indices = _np.asarray(indices, dtype=_np.int64)
+        indices[indices == len(self._points)] = -1
+        return indices
 
     def all_in_disc(self, pt, radius):
         """Find all points which are within `radius` of `pt`.
 
         :return: `(indices, points)`
         """
-        pt = _np.asarray(pt)
-        xmin, xmax = pt[0] - radius, pt[0] + radius
-        ymin, ymax = pt[1] - radius, pt[1] + radius
-        choices = list(self._index.intersection((xmin, ymin, xmax, ymax)))
-        if len(choices) == 0:
-            return [], []
-        distsq = _np.sum((pt - self._points[choices])**2, axis=1)
-        mask = distsq <= radius**2
-        choices = _np.asarray(choices, dtype=_np.int)[mask]
-        return choices, self._points[choices]
+        indices = self._tree.query_ball_point(_np.asarray(pt), radius, return_sorted=True)
+        indices = _np.asarray(indices, dtype=_np.int64)
+        return indices, self._points[indices]
+
+    def all_in_disc_many(self, points, radius):
+        """Find all input points within `radius` of each of many points.  The
+        result is in "compressed sparse row" format: the input points within
+        the disc about `points[i]` are
+        `indices[offsets[i] : offsets[i+1]]`, in increasing order.
+
+        :param points: Array of shape `(m,2)`.
+        :param radius: The radius of the disc.
+
+        :return: Pair `(offsets, indices)` of arrays, of shape `(m+1,)` and
+          `(offsets[-1],)`.
+        """
+        points = _np.asarray(points, dtype=_np.float64).reshape(-1, 2)
+        matches = self._tree.query_ball_point(points, radius, return_sorted=True,
+            workers=self._workers)
+        counts = _np.fromiter(map(len, matches), dtype=_np.int64, count=len(matches))
+        offsets = _np.concatenate([[0], _np.cumsum(counts)]).astype(_np.int64)
+        indices = _np.fromiter(_itertools.chain.from_iterable(matches),
+            dtype=_np.int64, count=offsets[-1])
+        return offsets, indices
+
+
+class LineProjector():
+    """Project points to the closest of a collection of line segments.  Long
+    segments are split into "pieces", and a `cKDTree` of the mid-points of the
+    pieces is used to find candidate segments, so that many points can be
+    projected at once.
+
+    :param starts: Array of shape `(m,2)` of the start points of the segments.
+    :param ends: Array of shape `(m,2)` of the end points of the segments.
+    :param neighbours: The number of pieces to check for each point, before
+      falling back to a (slower) exact search.
+    """
+    def __init__(self, starts, ends, neighbours=8):
+        self._starts = _np.asarray(starts, dtype=_np.float64).reshape(-1, 2)
+        self._ends = _np.asarray(ends, dtype=_np.float64).reshape(-1, 2)
+        if self._starts.shape != self._ends.shape:
+            raise ValueError("Need the same number of start and end points.")
+        if self._starts.shape[0] == 0:
+            raise ValueError("Need at least one segment.")
+        self._k = neighbours
+        lengths = _np.sqrt(_np.sum((self._ends - self._starts)**2, axis=1))
+        self._piece_length = max(_np.mean(lengths), 1e-12)
+        counts = _np.maximum(_np.ceil(lengths / self._piece_length), 1).astype(_np.int64)
+        self._piece_segments = _np.repeat(_np.arange(len(lengths)), counts)
+        offsets = _np.concatenate([[0], _np.cumsum(counts)[:-1]])
+        position = _np.arange(len(self._piece_segments)) - _np.repeat(offsets, counts)
+        ts = (position + 0.5) / _np.repeat(counts, counts)
+        s = self._starts[self._piece_segments]
+        e = self._ends[self._piece_segments]
+        self._tree = _spatial.cKDTree(s + (e - s) * ts[:,None])
+
+    @property
+    def starts(self):
+        """The start points of the segments."""
+        return self._starts
+
+    @property
+    def ends(self):
+        """The end points of the segments."""
+        return self._ends
+
+    def _to_segments(self, points, segments):
+        """Project each point to the segment given, returning `(ts, distsq)`."""
+        s = self._starts[segments]
+        d = self._ends[segments] - s
+        normsq = _np.sum(d * d, axis=-1)
+        dot = _np.sum((points - s) * d, axis=-1)
+        with _np.errstate(divide="ignore", invalid="ignore"):
+            ts = _np.where(normsq > 0, dot / normsq, 0)
+        ts = _np.clip(ts, 0, 1)
+        diff = s + d * ts[...,None] - points
+        return ts, _np.sum(diff * diff, axis=-1)
+
+    def project(self, points, chunk_size=100000):
+        """Project each point to the closest segment.
+
+        :param points: Array of shape `(n,2)`.
+        :param chunk_size: Work with this many points at once, to bound memory
+          usage.
+
+        :return: Triple `(segments, ts, projected)` where `segments` is an
+          array of shape `(n,)` of indices into the segments, `ts` is the
+          distance (between 0 and 1) along the segment from the start to the
+          end point, and `projected` is an array of shape `(n,2)` of the
+          projected points.
+        """
+        points = _np.asarray(points, dtype=_np.float64).reshape(-1, 2)
+        segments = _np.empty(points.shape[0], dtype=_np.int64)
+        ts = _np.empty(points.shape[0], dtype=_np.float64)
+        for start in range(0, points.shape[0], chunk_size):
+            sl = slice(start, start + chunk_size)
+            segments[sl], ts[sl] = self._project_chunk(points[sl])
+        s = self._starts[segments]
+        projected = s + (self._ends[segments] - s) * ts[:,None]
+        return segments, ts, projected
+
+    def _project_chunk(self, points):
+        k = min(self._k, self._tree.n)
+        dists, pieces = self._tree.query(points, k=k)
+        dists, pieces = dists.reshape(len(points), k), pieces.reshape(len(points), k)
+        candidates = self._piece_segments[pieces]
+        cand_ts, distsq = self._to_segments(points[:,None,:], candidates)
+        # Prefer the lowest segment index in case of a tie
+        order = _np.lexsort((candidates, distsq), axis=-1)
+        best = order[:,0]
+        rows = _np.arange(len(points))
+        segments = candidates[rows, best]
+        ts = cand_ts[rows, best]
+
+        # The closest segment has a piece whose mid-point is within
+        # `distance + piece_length / 2`; if this is not certainly amongst
+        # the pieces we have looked at, do an exact search.
+        bound = _np.sqrt(distsq[rows, best]) + self._piece_length / 2
+        if k < self._tree.n:
+            for i in _np.nonzero(dists[:,-1] <= bound)[0]:
+                choices = _np.unique(self._piece_segments[
+                    self._tree.query_ball_point(points[i], bound[i])])
+                t, dsq = self._to_segments(points[i], choices)
+                j = _np.argmin(dsq)
+                segments[i], ts[i] = choices[j], t[j]
+        return segments, ts
+
+    def project_point(self, x, y):
+        """Project a single point.
+
+        :return: Pair `(segment, t)`.
+        """
+        segments, ts, _ = self.project([[x, y]])
+        return segments[0], ts[0]
+
+
+def project_lines(lines, proj):
+    """Project many lines with a single (vectorised) call to `proj`.  The
+    vertices of all lines are joined into one array, projected, and split up
+    again.
 
+    :param lines: Iterable of lines, each an array of shape `(k,2)` of
+      `(long, lat)` coordinates.
+    :param proj: A `pyproj.Proj` instance, or similar callable object which
+      takes arrays of longitudes and latitudes and returns `(xs, ys)`.
 
-def graph_from_streets(streets, to_projected_line):
-    """Constructs a graph from a generic collection of "streets".
+    :return: List of arrays, each of shape `(k,2)`.
+    """
+    lines = [_np.asarray(line, dtype=_np.float64).reshape(-1, 2) for line in lines]
+    if len(lines) == 0:
+        return []
+    points = _np.concatenate(lines)
+    if len(points) == 0:
+        return lines
+    xs, ys = proj(points[:,0], points[:,1])
+    projected = _np.empty_like(points)
+    projected[:,0], projected[:,1] = xs, ys
+    offsets = _np.cumsum([len(line) for line in lines])[:-1]
+    return _np.split(projected, offsets)
+
+def project_streets(streets, proj, batch_size=10000):
+    """Project the `line` field of each of a stream of objects, for example
+    the "Street" objects from the city street loaders, or TIGER/Lines
+    "edges".  Works in batches, see :func:`project_lines`.  For example, use
+    `graph_from_streets(project_streets(streets, proj), lambda s : s.line,
+    keep_lines=False)`
+
+    :param streets: Iterable of `namedtuple` objects with a field `line`.
+    :param proj: As for :func:`project_lines`.
+    :param batch_size: The number of objects to project at once.
+
+    :return: Iterable of objects with `line` replaced by the projected line.
+    """
+    streets = iter(streets)
+    while True:
+        batch = list(_itertools.islice(streets, batch_size))
+        if len(batch) == 0:
+            return
+        lines = project_lines([street.line for street in batch], proj)
+        for street, line in zip(batch, lines):
+            yield street._replace(line=line)
+
+class _GrowableArray():
+    """Array of shape `(n, columns)` which can be appended to, doubling the
+    underlying storage when full."""
+    def __init__(self, columns, dtype, capacity=1024):
+        self._data = _np.empty((capacity, columns), dtype=dtype)
+        self._length = 0
+
+    def extend(self, rows):
+        rows = _np.asarray(rows, dtype=self._data.dtype).reshape(-1, self._data.shape[1])
+        end = self._length + len(rows)
+        if end > len(self._data):
+            data = _np.empty((max(end, 2 * len(self._data)), self._data.shape[1]),
+                dtype=self._data.dtype)
+            data[:self._length] = self._data[:self._length]
+            self._data = data
+        self._data[self._length:end] = rows
+        self._length = end
+
+    def __len__(self):
+        return self._length
+
+    def to_array(self):
+        """Copy of the data, trimmed to length."""
+        return self._data[:self._length].copy()
+
+
+class StreamingGraphBuilder():
+    """Builds a planar graph from lines, in two passes.  First, add each line
+    with :meth:`add_line`; only the coordinates are stored, in one `float64`
+    array, together with the offset of each line.  Then :meth:`build` merges
+    close points and forms the edges.
+
+    This differs from building with `open_cp.network.PlanarGraphNodeOneShot`
+    in these ways:
+
+    - Points are merged as for :class:`AggregatePointsViaGraph`: points
+      closer than `tolerance` are joined, and merging is transitive, so a
+      chain of points each close to the next becomes one vertex, even if the
+      ends of the chain are far apart.  (The greedy merge of `open_cp` can
+      give more than one vertex.)
+    - The position of a vertex is the point of the group closest to the
+      centroid of the group, not the first point seen.
+    - Vertices are numbered `0, 1, ...` in the order they first occur in the
+      lines.
+    - Segments whose ends merge to the same vertex are dropped, and segments
+      which repeat an earlier edge, in either direction, are mapped to that
+      edge; the `orientations` returned by :meth:`build` allow callers to
+      detect such repeats.
+
+    :param tolerance: The cut-off distance at which points will be merged.
+    """
+    def __init__(self, tolerance=0.1):
+        self._tolerance = tolerance
+        self._coords = _GrowableArray(2, _np.float64)
+        self._offsets = _GrowableArray(1, _np.int64)
+        self._offsets.extend([0])
+
+    @property
+    def number_lines(self):
+        return len(self._offsets) - 1
+
+    def add_line(self, line):
+        """Add a line.
+
+        :param line: Iterable of points `(x,y)`, or an array of shape `(k,2)`.
+
+        :return: The index of the line.
+        """
+        self._coords.extend(_np.asarray(line, dtype=_np.float64))
+        self._offsets.extend([len(self._coords)])
+        return self.number_lines - 1
+
+    def build(self):
+        """Merge the points and form the graph.  The vertices are numbered
+        `0, 1, ...` in the order they first occur in the lines.
+
+        :return: Tuple `(graph, edges, lines, orientations)` where `edges`,
+          `lines` and `orientations` are arrays with one entry for each
+          segment of each line which became an edge (in order), giving the
+          edge index in `graph`, the index of the line, and `1` if the segment
+          runs in the same direction as the edge, or `-1` if reversed.
+        """
+        coords = self._coords.to_array()
+        offsets = self._offsets.to_array().ravel()
+        unique, inverse = _np.unique(coords, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        pairs = _spatial.cKDTree(unique).query_pairs(self._tolerance, output_type="ndarray")
+        components = _disjoint_set.DisjointSet(len(unique))
+        components.union_pairs(pairs)
+        labels = components.labels()
+        merged = unique[closest_to_centroids(unique, labels)]
+        labels = labels[inverse]
+
+        # Renumber the merged points in order of first occurrence
+        _, first = _np.unique(labels, return_index=True)
+        order = _np.argsort(first, kind="stable")
+        rank = _np.empty(len(order), dtype=_np.int64)
+        rank[order] = _np.arange(len(order))
+        vertices = merged[order]
+        labels = rank[labels]
+
+        # Segments join consecutive points of the same line
+        line_of_point = _np.repeat(_np.arange(len(offsets) - 1), _np.diff(offsets))
+        starts = _np.arange(max(len(coords) - 1, 0))
+        starts = starts[line_of_point[starts] == line_of_point[starts + 1]]
+        ends = _np.stack([labels[starts], labels[starts + 1]], axis=1)
+        keep = ends[:,0] != ends[:,1]
+        starts, ends = starts[keep], ends[keep]
+
+        # Identify repeated edges, in either direction, keeping the first
+        n = len(vertices)
+        codes = _np.min(ends, axis=1) * n + _np.max(ends, axis=1)
+        _, first, segment_edges = _np.unique(codes, return_index=True, return_inverse=True)
+        order = _np.argsort(first, kind="stable")
+        rank = _np.empty(len(order), dtype=_np.int64)
+        rank[order] = _np.arange(len(order))
+        segment_edges = rank[segment_edges.ravel()]
+        edges = ends[first[order]]
+        orientations = _np.where(ends[:,0] == edges[segment_edges, 0], 1, -1)
+
+        xs, ys = vertices.T.tolist()
+        graph = _network.PlanarGraph(list(zip(range(n), xs, ys)),
+            [tuple(e) for e in edges.tolist()])
+        return graph, segment_edges, line_of_point[starts], orientations
+
+
+def graph_from_streets(streets, to_projected_line, keep_lines=True):
+    """Constructs a graph from a generic collection of "streets".  Uses a
+    :class:`StreamingGraphBuilder`, so the coordinates of each street are
+    held compactly.  To save memory, set `keep_lines=False`, so that only
+    the coordinates, and each street without its geometry, are kept.
     
     :param streets: Iterator of "street" objects
     :param to_projected_line: Callable object which takes a "street" object
       as from the iterable `streets`, and returns a "line" which is
       suitable projected (if necessary).  A "line" is an iterable of points,
       where each point is a pair `(x,y)`.
+    :param keep_lines: If `True` (the default) then `names` holds the
+      original "street" objects.  If `False` then "street" objects which are
+      `namedtuple` instances with a field `line` are stored with `line` set
+      to `None`.
       
     :return: Pair `(graph, names)` where `graph` is a graph object, and
       `names` is a dictionary from edge index (in graph) to a list of
       "street" instances which are the street(s) associated with that
       edge.
     """
-    all_streets, projected_lines = [], []
+    builder = StreamingGraphBuilder()
+    all_streets = []
     for street in streets:
+        builder.add_line(to_projected_line(street))
+        if not keep_lines and "line" in getattr(street, "_fields", ()):
+            street = street._replace(line=None)
         all_streets.append(street)
-        projected_lines.append(to_projected_line(street))
-    
-    all_nodes = []    
-    for line in projected_lines:
-        for pt in line:
-            all_nodes.append(pt)
-
-    b = _network.PlanarGraphNodeOneShot(all_nodes)
-    name_lookup = _collections.defaultdict(list)
-    for street, line in zip(all_streets, projected_lines):
-        for e in b.add_path(line):
-            name_lookup[e].append(street)
-            
-    b.remove_duplicate_edges()
-    graph = b.build()
+    graph, edges, lines, _ = builder.build()
     names = _collections.defaultdict(list)
-    for e, ns in name_lookup.items():
-        if e[0] == e[1]:
-            # These have been removed
-            continue
-        index, _ = graph.find_edge(*e)
-        names[index].extend(ns)
-        
+    for index, line in zip(edges.tolist(), lines.tolist()):
+        names[index].append(all_streets[line])
     return graph, names
+
+def flatten_lists(lists):
+    """Flatten a sequence of sequences into arrays, for vectorised
+    processing of, for example, the names associated with each edge.
+
+    :param lists: Sequence of sequences (each is iterated once).
+
+    :return: Triple `(flat, rows, positions)` of arrays, each with one entry
+      for each entry of each sequence: the entry itself (as an `object`
+      array), the index of the sequence it came from, and its position in
+      that sequence.
+    """
+    lists = [list(entries) for entries in lists]
+    counts = _np.fromiter((len(entries) for entries in lists), dtype=_np.int64, count=len(lists))
+    total = int(_np.sum(counts))
+    flat = _np.fromiter(_itertools.chain.from_iterable(lists), dtype=object, count=total)
+    rows = _np.repeat(_np.arange(len(lists)), counts)
+    positions = _np.arange(total) - _np.repeat(_np.cumsum(counts) - counts, counts)
+    return flat, rows, positions
+
+def street_edge_mask(graph, names, accept):
+    """Decide which edges of a graph built by :func:`graph_from_streets` to
+    keep, for use with :func:`network.edge_subgraph`.
+
+    :param graph: The graph.
+    :param names: The dictionary from edge index to list of "street" objects.
+    :param accept: Callable object which takes a "street" object and returns
+      `True` if we want it, for example `dallas.street_clazz_accept`.  Called
+      once for each distinct street.
+
+    :return: Boolean array, for each edge, which is `True` if some street
+      associated with the edge is accepted.
+    """
+    indices = _np.fromiter(names.keys(), dtype=_np.int64, count=len(names))
+    flat, rows, _ = flatten_lists(names.values())
+    ids = _np.fromiter(map(id, flat), dtype=_np.int64, count=len(flat))
+    _, first, inverse = _np.unique(ids, return_index=True, return_inverse=True)
+    accepted = _np.fromiter((bool(accept(street)) for street in flat[first]),
+        dtype=bool, count=len(first))[inverse.ravel()]
+    mask = _np.zeros(len(graph.edges), dtype=bool)
+    mask[indices[rows[accepted]]] = True
+    return mask
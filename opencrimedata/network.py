@@ -7,52 +7,408 @@ Some explicitly graph/network based methods.
 
 import open_cp.network as _network
 from . import geometry as _geometry
+from . import disjoint_set as _disjoint_set
 import numpy as _np
 import rtree as _rtree
 import datetime as _datetime
 import collections as _collections
+import heapq as _heapq
+import concurrent.futures as _futures
 import open_cp.logger as _ocp_logger
 import logging as _logging
 _logger = _logging.getLogger(__name__)
 
+class CompiledGraph():
+    """An array based, read-only, view of a graph, to speed up traversals.
+    Can be used in place of the original graph by every class in this module,
+    and supports the common parts of the graph interface of
+    :mod:`open_cp.network`.
+
+    The vertices are indexed `0, ..., n-1`, with :attr:`keys` giving the
+    vertex key of each index.  The neighbours of vertex `i` are
+    `csr_neighbours[csr_offsets[i] : csr_offsets[i+1]]`, and for each such
+    "slot", `csr_edges` gives the edge index, and `csr_orientations` is `1`
+    if the edge is stored as `(i, neighbour)` and `-1` if stored as
+    `(neighbour, i)` (the same convention as `find_edge`).
+
+    When pickled, for example to send to a worker process, only the arrays
+    are kept.  The unpickled copy supports the methods which work with
+    vertex and edge indices, but not the original graph or the vertex keys.
+
+    :param graph: Graph, conforming to interface of :mod:`open_cp.network`
+    """
+    def __init__(self, graph):
+        self._graph = graph
+        keys = list(graph.vertices)
+        try:
+            keys.sort()
+        except TypeError:
+            pass
+        self._keys = keys
+        self._index = {k : i for i, k in enumerate(keys)}
+        self._edge_vertices = _np.asarray([(self._index[a], self._index[b])
+            for a, b in graph.edges], dtype=_np.int64).reshape(-1, 2)
+        self._lengths = _np.asarray(graph.lengths, dtype=_np.float64)
+        self._coords = None
+        if hasattr(graph.vertices, "items"):
+            self._coords = _np.asarray([graph.vertices[k] for k in keys],
+                dtype=_np.float64).reshape(-1, 2)
+        self._slot_codes = None
+        self._make_csr()
+        self._projector = None
+
+    def _make_csr(self):
+        edges = self._edge_vertices
+        edge_ids = _np.arange(edges.shape[0])
+        sources = _np.concatenate([edges[:,0], edges[:,1]])
+        targets = _np.concatenate([edges[:,1], edges[:,0]])
+        slot_edges = _np.concatenate([edge_ids, edge_ids])
+        orients = _np.concatenate([_np.ones_like(edge_ids), -_np.ones_like(edge_ids)])
+        order = _np.argsort(sources, kind="stable")
+        counts = _np.bincount(sources, minlength=len(self._keys))
+        self._offsets = _np.concatenate([[0], _np.cumsum(counts)]).astype(_np.int64)
+        self._neighbours = targets[order]
+        self._slot_edges = slot_edges[order]
+        self._orientations = orients[order]
+        self._make_lists()
+
+    def _make_lists(self):
+        # Python lists are faster than arrays for scalar access in tight loops
+        self._offsets_list = self._offsets.tolist()
+        self._neighbours_list = self._neighbours.tolist()
+        self._slot_edges_list = self._slot_edges.tolist()
+        self._orientations_list = self._orientations.tolist()
+        self._slot_lengths_list = self._lengths[self._slot_edges[self._first_slots()]].tolist()
+        self._edge_vertices_list = self._edge_vertices.tolist()
+        self._lengths_list = self._lengths.tolist()
+
+    def _sorted_slot_codes(self):
+        if self._slot_codes is None:
+            n = len(self._offsets) - 1
+            sources = _np.repeat(_np.arange(n), _np.diff(self._offsets))
+            codes = sources * n + self._neighbours
+            order = _np.argsort(codes, kind="stable")
+            self._slot_codes = (codes[order], order)
+        return self._slot_codes
+
+    def _first_slots(self):
+        # For each slot, the first slot joining the same pair of vertices, which
+        # is the slot `find_edge_by_index` returns.  Differs only for multigraphs.
+        codes, order = self._sorted_slot_codes()
+        first = _np.empty(len(codes), dtype=_np.int64)
+        if len(codes) > 0:
+            starts = _np.concatenate([[True], codes[1:] != codes[:-1]])
+            first[order] = order[starts][_np.cumsum(starts) - 1]
+        return first
+
+    _PICKLED = ["_edge_vertices", "_lengths", "_coords", "_offsets", "_neighbours",
+        "_slot_edges", "_orientations"]
+
+    def __getstate__(self):
+        # Send only the arrays when pickling, e.g. to a worker process.
+        return {k : self.__dict__[k] for k in self._PICKLED}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._graph, self._keys, self._index = None, None, None
+        self._slot_codes = None
+        self._projector = None
+        self._make_lists()
+
+    @property
+    def graph(self):
+        """The original graph."""
+        return self._graph
+
+    @property
+    def keys(self):
+        """List of vertex keys, in index order."""
+        return self._keys
+
+    @property
+    def key_to_index(self):
+        """Dictionary from vertex key to vertex index."""
+        return self._index
+
+    @property
+    def coords(self):
+        """Array of shape `(n,2)` of the vertex coordinates, or `None` if the
+        graph is not a planar graph."""
+        return self._coords
+
+    @property
+    def edge_vertices(self):
+        """Array of shape `(m,2)` giving the vertex indices of each edge."""
+        return self._edge_vertices
+
+    @property
+    def csr_offsets(self):
+        """Array of shape `(n+1,)` of offsets into the "slot" arrays."""
+        return self._offsets
+
+    @property
+    def csr_neighbours(self):
+        """The vertex index of the neighbour, for each slot."""
+        return self._neighbours
+
+    @property
+    def csr_edges(self):
+        """The edge index, for each slot."""
+        return self._slot_edges
+
+    @property
+    def csr_orientations(self):
+        """The orientation of the edge, `1` or `-1`, for each slot."""
+        return self._orientations
+
+    @property
+    def vertices(self):
+        """As for the original graph."""
+        return self._graph.vertices
+
+    @property
+    def edges(self):
+        """As for the original graph."""
+        return self._graph.edges
+
+    @property
+    def lengths(self):
+        """Array of edge lengths."""
+        return self._lengths
+
+    @property
+    def number_edges(self):
+        return self._edge_vertices.shape[0]
+
+    def neighbours(self, vertex_key):
+        """List of the keys of the neighbours of the vertex."""
+        i = self._index[vertex_key]
+        return [self._keys[j] for j in self._neighbours_list[
+            self._offsets_list[i] : self._offsets_list[i+1]]]
+
+    def find_edge_by_index(self, i, j):
+        """As :meth:`find_edge` but for vertex indices."""
+        for slot in range(self._offsets_list[i], self._offsets_list[i+1]):
+            if self._neighbours_list[slot] == j:
+                return self._slot_edges_list[slot], self._orientations_list[slot]
+        raise KeyError((i, j))
+
+    def find_edge(self, key1, key2):
+        """Find the edge joining the vertices.
+
+        :return: `(index, orientation)` where `orientation` is `1` if the edge
+          is `(key1, key2)` and `-1` if the edge is `(key2, key1)`.  Raises
+          `KeyError` if there is no such edge.
+        """
+        try:
+            return self.find_edge_by_index(self._index[key1], self._index[key2])
+        except KeyError:
+            raise KeyError((key1, key2))
+
+    def find_edges(self, indices1, indices2):
+        """Vectorised version of :meth:`find_edge_by_index`.
+
+        :param indices1: Array of vertex indices
+        :param indices2: Array of vertex indices, same shape as `indices1`.
+
+        :return: Pair `(edges, orientations)` of arrays, where missing edges
+          are marked with an edge index of `-1`.
+        """
+        indices1 = _np.asarray(indices1, dtype=_np.int64)
+        indices2 = _np.asarray(indices2, dtype=_np.int64)
+        edges = _np.full(indices1.shape, -1, dtype=_np.int64)
+        orientations = _np.zeros(indices1.shape, dtype=_np.int64)
+        if len(self._neighbours) == 0:
+            return edges, orientations
+        n = len(self._offsets) - 1
+        codes, order = self._sorted_slot_codes()
+        wanted = indices1 * n + indices2
+        locations = _np.minimum(_np.searchsorted(codes, wanted), len(codes) - 1)
+        found = codes[locations] == wanted
+        slots = order[locations[found]]
+        edges[found] = self._slot_edges[slots]
+        orientations[found] = self._orientations[slots]
+        return edges, orientations
+
+    def edge_to_coords(self, key1, key2, t):
+        """Convert the point `t` between 0 and 1 along the line from `key1` to
+        `key2` to coordinates."""
+        x1, y1 = self._coords[self._index[key1]]
+        x2, y2 = self._coords[self._index[key2]]
+        return (x1 * (1 - t) + x2 * t, y1 * (1 - t) + y2 * t)
+
+    def edges_to_coords(self, edges, ts):
+        """As :meth:`edge_to_coords` but for arrays of edge indices and
+        positions along each edge.  Only supported for planar graphs.
+
+        :param edges: Array of shape `(n,)` of edge indices.
+        :param ts: Array of shape `(n,)` of values between 0 and 1.
+
+        :return: Array of shape `(n,2)`.
+        """
+        if self._coords is None:
+            raise ValueError("Graph has no vertex coordinates.")
+        vertices = self._edge_vertices[_np.asarray(edges, dtype=_np.int64)]
+        ts = _np.asarray(ts, dtype=_np.float64)[:,None]
+        return self._coords[vertices[:,0]] * (1 - ts) + self._coords[vertices[:,1]] * ts
+
+    def project_point_to_graph(self, x, y):
+        """As for the original graph."""
+        return self._graph.project_point_to_graph(x, y)
+
+    def project_points(self, points):
+        """Project many points to the closest edge in the graph at once.  Only
+        supported for planar graphs.
+
+        :param points: Array of shape `(n,2)`
+
+        :return: Triple `(edges, ts, projected)` where `edges` is an array of
+          edge indices, `ts` an array of the distance (between 0 and 1) along
+          each edge, in the orientation the edge is stored in, and `projected`
+          is an array of shape `(n,2)` of the projected points.
+        """
+        if self._coords is None:
+            raise ValueError("Graph has no vertex coordinates.")
+        if self._projector is None:
+            self._projector = _geometry.LineProjector(
+                self._coords[self._edge_vertices[:,0]],
+                self._coords[self._edge_vertices[:,1]])
+        return self._projector.project(points)
+
+    def as_lines(self):
+        """As for the original graph."""
+        return self._graph.as_lines()
+
+
+def compile_graph(graph):
+    """Return a :class:`CompiledGraph` for `graph`, or `graph` itself if it
+    is already compiled.  As typically much work is done with the same graph,
+    the compiled graph is cached as an attribute of `graph`, and so lives
+    exactly as long as `graph` does.  Graphs should not be changed once
+    compiled.  If `graph` does not support attributes, nothing is cached.
+    """
+    if isinstance(graph, CompiledGraph):
+        return graph
+    compiled = getattr(graph, "_compiled_graph", None)
+    # A copied or unpickled graph carries the compiled graph of the original
+    if compiled is None or compiled.graph is not graph:
+        compiled = CompiledGraph(graph)
+        try:
+            graph._compiled_graph = compiled
+        except AttributeError:
+            pass
+    return compiled
+
+Subgraph = _collections.namedtuple("Subgraph", "graph vertex_to_new vertex_to_old edge_to_new edge_to_old")
+
+def edge_subgraph(graph, edge_mask):
+    """Extract the sub-graph made up of the edges selected by `edge_mask`,
+    and the vertices which these edges use.  Vertex keys are unchanged, and
+    vertices and edges keep their relative order.  Vertex indices are as for
+    :class:`CompiledGraph`.
+
+    :param graph: Graph, conforming to interface of :mod:`open_cp.network`
+    :param edge_mask: Boolean array, one entry for each edge of `graph`,
+      `True` to keep the edge.
+
+    :return: Instance of :class:`Subgraph` with fields `graph`, the new
+      graph; `vertex_to_new`, array giving the new index of each old vertex,
+      or `-1` if the vertex is not used; `vertex_to_old`, array giving the
+      old index of each new vertex; `edge_to_new` and `edge_to_old`, the same
+      for edges.
+    """
+    compiled = compile_graph(graph)
+    edge_mask = _np.asarray(edge_mask, dtype=bool).ravel()
+    if len(edge_mask) != compiled.number_edges:
+        raise ValueError("Expected a mask of length {} but got {}".format(
+            compiled.number_edges, len(edge_mask)))
+    edge_to_old = _np.nonzero(edge_mask)[0]
+    edge_to_new = _np.full(len(edge_mask), -1, dtype=_np.int64)
+    edge_to_new[edge_to_old] = _np.arange(len(edge_to_old))
+
+    ends = compiled.edge_vertices[edge_to_old]
+    used = _np.zeros(len(compiled.keys), dtype=bool)
+    used[ends.ravel()] = True
+    vertex_to_old = _np.nonzero(used)[0]
+    vertex_to_new = _np.full(len(used), -1, dtype=_np.int64)
+    vertex_to_new[vertex_to_old] = _np.arange(len(vertex_to_old))
+
+    keys = _np.empty(len(compiled.keys), dtype=object)
+    keys[:] = compiled.keys
+    edges = list(zip(keys[ends[:,0]].tolist(), keys[ends[:,1]].tolist()))
+    new_keys = keys[vertex_to_old].tolist()
+    if compiled.coords is not None:
+        xs, ys = compiled.coords[vertex_to_old].T.tolist()
+        new_graph = _network.PlanarGraph(list(zip(new_keys, xs, ys)), edges)
+    else:
+        new_graph = _network.Graph(new_keys, edges, compiled.lengths[edge_to_old].tolist())
+    return Subgraph(new_graph, vertex_to_new, vertex_to_old, edge_to_new, edge_to_old)
+
+
 class LimitedNetworkDistance():
     """Helper class to (repeatedly) compute distances between locations on
     edges in a graph.  Features a cut-off which speeds up execution; but
     note that for vertices whose distance from the starting point is much
     more than `maximum_distance`, the resulting data may be incorrect.
 
-    :param graph: Graph to use
+    If the graph has parallel edges, then stepping between two vertices
+    always uses the length of the edge which `find_edge` returns, and not the
+    shortest of the parallel edges.
+
+    The distances are always the shortest distances, but when two routes
+    have exactly the same length, the route recorded in :attr:`paths` may
+    differ from the one found by earlier versions.  The choice is
+    deterministic: a vertex keeps the first route found, where after the end
+    points of the starting edge, vertices are explored in order of distance,
+    and then in order of vertex index.
+
+    :param graph: Graph to use, or a :class:`CompiledGraph`
     :param edge: The edge index into `graph`
     :parma t: Distance (between 0 and 1) along that edge
     :param maximum_distance: The maximum distance we are interested in.
     """
     def __init__(self, graph, edge, t, maximum_distance):
         self._graph = graph
+        self._compiled = compile_graph(graph)
         self._source_edge = edge
         self._source_t = t
         self._max = maximum_distance
         self._walk()
 
     def _walk(self):
-        distances = dict()
-        v1, v2 = self._graph.edges[self._source_edge]
-        edge_length = self._graph.lengths[self._source_edge]
-        distances[v1] = self._source_t * edge_length
-        distances[v2] = (1 - self._source_t) * edge_length
-        paths = {v1:v1, v2:v2}
-        vertices_to_visit = {v1, v2}
-        while len(vertices_to_visit) > 0:
-            v = vertices_to_visit.pop()
-            for u in self._graph.neighbours(v):
-                e, _ = self._graph.find_edge(v, u)
-                d = distances[v] + self._graph.lengths[e]
-                if u not in distances or d < distances[u]:
-                    distances[u] = d
-                    if d <= self._max:
-                        vertices_to_visit.add(u)
-                    paths[u] = v
-        self._vertex_distances = distances
-        self._paths = paths
+        cg = self._compiled
+        i1, i2 = cg._edge_vertices_list[self._source_edge]
+        edge_length = cg._lengths_list[self._source_edge]
+        distances = {i1 : self._source_t * edge_length}
+        distances[i2] = (1 - self._source_t) * edge_length
+        paths = {i1:i1, i2:i2}
+
+        # The end points of the starting edge are always explored, whatever
+        # their distance, and then we run Dijkstra's algorithm, never
+        # queueing a vertex which is further away than the cut-off.
+        heap = []
+        for v in [i1, i2]:
+            self._relax(v, distances[v], distances, paths, heap)
+        while len(heap) > 0:
+            d, v = _heapq.heappop(heap)
+            if d > distances[v]:
+                continue
+            self._relax(v, d, distances, paths, heap)
+        self._index_distances = distances
+        self._index_paths = paths
+        self._paths = None
+
+    def _relax(self, v, dist, distances, paths, heap):
+        cg = self._compiled
+        neighbours, lengths = cg._neighbours_list, cg._slot_lengths_list
+        for slot in range(cg._offsets_list[v], cg._offsets_list[v + 1]):
+            u = neighbours[slot]
+            d = dist + lengths[slot]
+            if u not in distances or d < distances[u]:
+                distances[u] = d
+                paths[u] = v
+                if d <= self._max:
+                    _heapq.heappush(heap, (d, u))
 
     @property
     def graph(self):
@@ -62,9 +418,21 @@ class LimitedNetworkDistance():
     @property
     def paths(self):
         """Dictionary from vertex to vertex giving the shortest path back to
-        the starting edge."""
+        the starting edge.  Where there are several shortest paths, one is
+        chosen as described in the class documentation."""
+        if self._paths is None:
+            keys = self._compiled.keys
+            self._paths = {keys[u] : keys[v] for u, v in self._index_paths.items()}
         return self._paths
 
+    @property
+    def vertex_distances(self):
+        """Dictionary from vertex to the distance from the starting point.
+        Vertices much further away than `maximum_distance` are not included.
+        """
+        keys = self._compiled.keys
+        return {keys[v] : d for v, d in self._index_distances.items()}
+
     def distance(self, edge, t):
         """Find the distance to this location.  Raises `ValueError` if the edge
         is not connected to the starting edge, or the edge is too distant.
@@ -72,15 +440,16 @@ class LimitedNetworkDistance():
         :param edge: The edge index into :attr:`graph`
         :parma t: Distance (between 0 and 1) along that edge
         """
+        cg = self._compiled
         if self._source_edge == edge:
-            return self._graph.lengths[edge] * abs(self._source_t - t)
-        v1, v2 = self._graph.edges[edge]
+            return cg._lengths_list[edge] * abs(self._source_t - t)
+        v1, v2 = cg._edge_vertices_list[edge]
         d1, d2 = None, None
-        edge_length = self._graph.lengths[edge]
-        if v1 in self._vertex_distances:
-            d1 = self._vertex_distances[v1] + t * edge_length
-        if v2 in self._vertex_distances:
-            d2 = self._vertex_distances[v2] + (1 - t) * edge_length
+        edge_length = cg._lengths_list[edge]
+        if v1 in self._index_distances:
+            d1 = self._index_distances[v1] + t * edge_length
+        if v2 in self._index_distances:
+            d2 = self._index_distances[v2] + (1 - t) * edge_length
         if d1 is None:
             if d2 is None:
                 raise ValueError("Starting location is not connected to this point, or is too distant.")
@@ -94,12 +463,14 @@ class NetworkDistance():
     """Helper class to (repeatedly) compute distances between locations on
     edges in a graph.  Rather slow for large graphs.
 
-    :param graph: Graph to use
+    :param graph: Graph to use, or a :class:`CompiledGraph`
     :param edge: The edge index into `graph`
     :parma t: Distance (between 0 and 1) along that edge
     """
     def __init__(self, graph, edge, t):
         self._graph = graph
+        if isinstance(graph, CompiledGraph):
+            graph = graph.graph
         self._lengths, self._prevs = _network.shortest_edge_paths(graph, edge, t)
         self._source_edge = edge
         self._source_t = t
@@ -128,6 +499,35 @@ class NetworkDistance():
             raise ValueError("Starting location is not connected to this point.")
         
 
+def _close_pairs(graph, graph_points, tolerance, indices, all_choices):
+    """For each `i` in `indices` and each `j` in the matching list of
+    `all_choices`, find if `j` is within `tolerance` network distance of `i`.
+
+    :return: List of pairs `(i, j)`
+    """
+    pairs = []
+    for i, choices in zip(indices, all_choices):
+        edge, t = graph_points[i]
+        dist = LimitedNetworkDistance(graph, edge, t, tolerance)
+        for j in choices:
+            try:
+                if i != j and dist.distance(*graph_points[j]) <= tolerance:
+                    pairs.append((i, j))
+            except ValueError:
+                pass
+    return pairs
+
+_worker_state = None
+
+def _init_aggregate_worker(graph, graph_points, tolerance):
+    global _worker_state
+    _worker_state = (graph, graph_points, tolerance)
+
+def _aggregate_worker_task(task):
+    graph, graph_points, tolerance = _worker_state
+    return _close_pairs(graph, graph_points, tolerance, *task)
+
+
 class NetworkProjectAggregate():
     """Supports projecting points onto a network and aggregating close points
     by network distance.  Proceeds by forming a graph whose vertices are the
@@ -136,15 +536,24 @@ class NetworkProjectAggregate():
     find the vertex closest to the centroid of the component, and use this
     vertex as a "merged point".
 
-    :param graph: Graph, conforming to interface of :mod:`open_cp.network`
+    :param graph: Graph, conforming to interface of :mod:`open_cp.network`,
+      or a :class:`CompiledGraph`
     :param points: Array of points of shape `(n,2)` to project to the network
     :param tolerance: Distance at which to aggregate.  Set to be `<=0` to skip
       the aggregation step.
     :param initial_tolerance: If not `None`, then initially group points up to
       this tolerance, ignoring the graph.
+    :param processes: The number of worker processes to use to compute network
+      distances when aggregating, or `None` to use one per CPU.  The graph is
+      sent to each worker once.
+    :param chunk_size: The number of points in each task sent to a worker.
     """
-    def __init__(self, graph, points, tolerance=0.1, initial_tolerance=None):
+    def __init__(self, graph, points, tolerance=0.1, initial_tolerance=None, processes=1,
+            chunk_size=1000):
         self._graph = graph
+        self._compiled = compile_graph(graph)
+        self._processes = processes
+        self._chunk_size = chunk_size
         points = _np.asarray(points)
         self._points = points
         self._tolerance = tolerance
@@ -163,48 +572,41 @@ class NetworkProjectAggregate():
         if tolerance > 0:
             self._aggregate(points)
         if agg is not None:
-            lookup = []
-            for pt in self._points:
-                i = agg.index(pt)
-                lookup.append(self._lookup[i])
-            self._lookup = lookup
+            lookup = _np.asarray(self._lookup, dtype=_np.int64)
+            self._lookup = lookup[agg.indices(self._points)].tolist()
 
     def _aggregate(self, points):
         _logger.debug("Performing aggregation")
         pl = _ocp_logger.ProgressLogger(points.shape[0], _datetime.timedelta(seconds=15), _logger)
-        builder = _network.GraphBuilder()
-        for i, choices in enumerate(self._initial_aggregate()):
-            edge, t = self._graph_points[i]
-            dist = LimitedNetworkDistance(self._graph, edge, t, self._tolerance)
-            for j in choices:
-                try:
-                    if i != j and dist.distance(*self._graph_points[j]) <= self._tolerance:
-                        builder.add_edge(i, j)
-                except ValueError:
-                    pass
-            pl.increase_count()
-
-        builder.remove_duplicate_edges()
-        builder.vertices.update(range(points.shape[0]))
-        g = builder.build()
+        components = _disjoint_set.DisjointSet(points.shape[0])
+        all_choices = self._initial_aggregate()
+        tasks = [(range(start, min(start + self._chunk_size, len(all_choices))),
+                all_choices[start : start + self._chunk_size])
+            for start in range(0, len(all_choices), self._chunk_size)]
+        all_pairs = []
+        for (indices, _), pairs in zip(tasks, self._close_pairs(tasks)):
+            all_pairs.extend(pairs)
+            pl.add_to_count(len(indices))
+        components.union_pairs(all_pairs)
+
         _logger.debug("Performing final aggregation...")
-        pl = _ocp_logger.ProgressLogger(points.shape[0], _datetime.timedelta(seconds=15), _logger)
-        agg_points = []
-        lookup = dict()
-        agged_graph_points = []
-        for com in _network.connected_components(g):
-            com = list(com)
-            pts = self._agg_points[com]
-            centroid = _np.mean(pts, axis=0)
-            i = _np.argmin( _np.sum((pts - centroid)**2, axis=1) )
-            agg_points.append(pts[i])
-            agged_graph_points.append(self._graph_points[com[i]])
-            for j in com:
-                lookup[j] = len(agg_points) - 1
-            pl.add_to_count(len(com))
-        self._agg_points = _np.asarray(agg_points)
-        self._lookup = [lookup[i] for i in range(points.shape[0])]
-        self._graph_points = agged_graph_points
+        labels = components.labels()
+        representatives = _geometry.closest_to_centroids(self._agg_points, labels)
+        self._agg_points = self._agg_points[representatives]
+        self._lookup = labels.tolist()
+        self._graph_points = [self._graph_points[i] for i in representatives]
+
+    def _close_pairs(self, tasks):
+        """Yields, for each task, the list of pairs which are close."""
+        if self._processes == 1:
+            for indices, all_choices in tasks:
+                yield _close_pairs(self._compiled, self._graph_points,
+                    self._tolerance, indices, all_choices)
+            return
+        initargs = (self._compiled, self._graph_points, self._tolerance)
+        with _futures.ProcessPoolExecutor(self._processes,
+                initializer=_init_aggregate_worker, initargs=initargs) as executor:
+            yield from executor.map(_aggregate_worker_task, tasks)
 
     def _initial_aggregate(self):
         _logger.debug("Performing initial aggregation...")
@@ -250,12 +652,15 @@ class NetworkProjectAggregate():
         return self._graph_points
 
     def _project_to_graph(self, points):
+        if self._compiled.coords is not None:
+            edges, ts, projected_points = self._compiled.project_points(points)
+            return list(zip(edges.tolist(), ts.tolist())), projected_points
         edges = []
         projected_points = []
         for pt in points:
             edge, t = self._graph.project_point_to_graph(*pt)
-            projected_points.append(self._graph.edge_to_coords(*edge, t))
-            ei, orient = self._graph.find_edge(*edge)
+            projected_points.append(self._compiled.edge_to_coords(*edge, t))
+            ei, orient = self._compiled.find_edge(*edge)
             if orient < 0:
                 t = 1 - t
             edges.append((ei, t))
@@ -272,7 +677,7 @@ class FlowPoints():
       point is encountered.  (We do not consider all paths, so for a very
       multiply connected graph, this might behave a bit strangely.)
 
-    :param graph: The graph to use.
+    :param graph: The graph to use, or a :class:`CompiledGraph`.
     :param points: The input points, as pairs `(edge, t)` where `edge` is an
       edge index in `graph`, and `t` between 0 and 1 is the distance along
       `edge`.
@@ -282,6 +687,7 @@ class FlowPoints():
     """
     def __init__(self, graph, points, min_distance, max_distance):
         self._graph = graph
+        self._compiled = compile_graph(graph)
         self._points = points
         self._min_distance = min_distance
         self._max_distance = max_distance
@@ -312,18 +718,20 @@ class FlowPoints():
         
         :param index: Into :attr:`input_points`.
         """
+        # We work with vertex indices of the compiled graph, not vertex keys
+        cg = self._compiled
         edge, t = self._points[index]
-        dist = LimitedNetworkDistance(self._graph, edge, t, self._max_distance)
+        dist = LimitedNetworkDistance(cg, edge, t, self._max_distance)
         inverse_paths = dict()
-        for target, source in dist.paths.items():
+        for target, source in dist._index_paths.items():
             if source not in inverse_paths:
                 inverse_paths[source] = set()
             inverse_paths[source].add(target)
-        flower = Flower(self._graph, self._min_distance, self._max_distance, self._used_edges)
-        v1, v2 = self._graph.edges[edge]
+        flower = Flower(cg, self._min_distance, self._max_distance, self._used_edges)
+        v1, v2 = cg._edge_vertices_list[edge]
         states, parts = [], []
         for start in [Flower.State(v1, v2, t, 0, False), Flower.State(v2, v1, 1-t, 0, False)]:
-            p, s = flower.from_current_position(start, True)
+            p, s = flower._from_index_position(start, True)
             parts.append(p)
             if s is not None:
                 states.append(s)
@@ -338,7 +746,7 @@ class FlowPoints():
                 if v2 == state.v1:
                     continue
                 s = Flower.State(state.v1, v2, state.t, state.distance, state.blocked)
-                p, s = flower.from_current_position(s)
+                p, s = flower._from_index_position(s)
                 parts.append(p)
                 if s is not None:
                     states.append(s)
@@ -436,7 +844,7 @@ class Flower():
     Factored out to allow testing, as the code is _horrible_.
     """
     def __init__(self, graph, min_distance, max_distance, used_edges):
-        self._graph = graph
+        self._graph = compile_graph(graph)
         self._min_distance = min_distance
         self._max_distance = max_distance
         self._used_edges = used_edges
@@ -448,11 +856,19 @@ class Flower():
         consider how far we can travel, supposing we have already travelled
         `distance` and are `blocked` or not.
         """
+        edge, orient = self._graph.find_edge(state.v1, state.v2)
+        return self._from_edge(state, edge, orient, ignore_initial_t)
+
+    def _from_index_position(self, state, ignore_initial_t=False):
+        """As :meth:`from_current_position` but with `v1` and `v2` being
+        vertex indices into the :class:`CompiledGraph`."""
+        edge, orient = self._graph.find_edge_by_index(state.v1, state.v2)
+        return self._from_edge(state, edge, orient, ignore_initial_t)
+
+    def _from_edge(self, state, edge, orient, ignore_initial_t):
         if state.blocked:
             assert state.distance < self._min_distance
-
-        edge, orient = self._graph.find_edge(state.v1, state.v2)
-        edge_length = self._graph.lengths[edge]
+        edge_length = self._graph._lengths_list[edge]
 
         blocks = self.points_on_edge(edge, orient, state.t, 1)
         if ignore_initial_t:
@@ -511,7 +927,7 @@ class Flower():
 class GraphSubSet():
     """Represents a subset of a graph.
     
-    :param graph: The graph
+    :param graph: The graph, or a :class:`CompiledGraph`
     :param edges: The edges in the subset, a list of pairs `(edge, parts)` where
       `edge` is the edge in `graph`, and `parts` is either `None` to indicate the
       whole edge, or an iterable of pairs `(s,t)` where `s <= t` is the subinterval
@@ -521,7 +937,35 @@ class GraphSubSet():
         self._graph = graph
         self._edges = list(edges)
         self._edges_dict = {e : v for (e,v) in self._edges}
-        self._p = None
+        self._flatten_parts()
+        self._cumulative = None
+
+    def _flatten_parts(self):
+        """Form arrays with one entry for each part of each edge."""
+        part_edges, starts, ends = [], [], []
+        for edge, parts in self._edges:
+            if parts is None:
+                parts = [(0, 1)]
+            for a, b in parts:
+                part_edges.append(edge)
+                starts.append(a)
+                ends.append(b)
+        self._part_edges = _np.asarray(part_edges, dtype=_np.int64)
+        self._part_starts = _np.asarray(starts, dtype=_np.float64)
+        self._part_ends = _np.asarray(ends, dtype=_np.float64)
+        self._part_order = _np.argsort(self._part_edges, kind="stable")
+        self._sorted_part_edges = self._part_edges[self._part_order]
+
+    def _cumulative_lengths(self):
+        """Array of shape `(p+1,)` of the cumulative lengths of the parts,
+        starting at 0."""
+        if self._cumulative is None:
+            lengths = _np.asarray(self._graph.lengths, dtype=_np.float64)[self._part_edges]
+            lengths = lengths * (self._part_ends - self._part_starts)
+            self._cumulative = _np.concatenate([[0], _np.cumsum(lengths)])
+            if not self._cumulative[-1] > 0:
+                raise ValueError("Lengths of segments is zero!", self._edges)
+        return self._cumulative
 
     @property
     def graph(self):
@@ -543,6 +987,29 @@ class GraphSubSet():
                 return True
         return False
 
+    def contains_many(self, edges, ts):
+        """As :meth:`contains` but for many points at once.
+
+        :param edges: Array of shape `(n,)` of edge indices.
+        :param ts: Array of shape `(n,)` of positions along each edge.
+
+        :return: Boolean array of shape `(n,)`.
+        """
+        edges = _np.asarray(edges, dtype=_np.int64)
+        ts = _np.asarray(ts, dtype=_np.float64)
+        lows = _np.searchsorted(self._sorted_part_edges, edges, side="left")
+        highs = _np.searchsorted(self._sorted_part_edges, edges, side="right")
+        # Form one pair (point, part) for each part on the edge of each point
+        counts = highs - lows
+        points = _np.repeat(_np.arange(len(edges)), counts)
+        offsets = _np.arange(len(points)) - _np.repeat(_np.cumsum(counts) - counts, counts)
+        parts = self._part_order[_np.repeat(lows, counts) + offsets]
+        t = ts[points]
+        hits = (self._part_starts[parts] <= t) & (t <= self._part_ends[parts])
+        out = _np.zeros(len(edges), dtype=bool)
+        out[points[hits]] = True
+        return out
+
     @staticmethod
     def distribute_into_parts(t, parts):
         """Find the absolute location given by fraction `t` into
@@ -562,33 +1029,26 @@ class GraphSubSet():
         
         :return: List of pairs `(edge, t)` in the usual format.
         """
-        if self._p is None:
-            lengths = []
-            for edge, parts in self._edges:
-                if parts is None:
-                    lengths.append(self._graph.lengths[edge])
-                else:
-                    lengths.append(sum(b-a for a,b in parts) * self._graph.lengths[edge])
-            lengths = _np.asarray(lengths)
-            norm = _np.sum(lengths)
-            if norm <= 0:
-                raise ValueError("Lengths of segments is zero!", self._edges)
-            self._p = lengths / norm
-
-        indicies = _np.random.choice(len(self._p), size, p=self._p)
-        ts = _np.random.random(size)
-
-        out = []        
-        for i, t in zip(indicies, ts):
-            edge, parts = self._edges[i]
-            if parts is not None:
-                t = self.distribute_into_parts(t, parts)
-            out.append((edge, t))
-
+        indicies, ts = self.sample_arrays(size)
+        out = [(edge, t) for edge, t in zip(indicies.tolist(), ts.tolist())]
         if size == 1:
             return out[0]
         return out
 
+    def sample_arrays(self, size=1):
+        """As :meth:`sample` but return arrays.
+
+        :return: Pair `(edges, ts)` of arrays of shape `(size,)`.
+        """
+        cumulative = self._cumulative_lengths()
+        targets = _np.random.random(size) * cumulative[-1]
+        # As `targets < cumulative[-1]`, never chooses a part of zero length
+        parts = _np.searchsorted(cumulative, targets, side="right") - 1
+        fractions = (targets - cumulative[parts]) / (cumulative[parts + 1] - cumulative[parts])
+        starts, ends = self._part_starts[parts], self._part_ends[parts]
+        ts = _np.minimum(starts + fractions * (ends - starts), ends)
+        return self._part_edges[parts], ts
+
     def as_lines(self):
         """As `graph.as_lines()` but only for the subset represented."""
         try:
@@ -616,7 +1076,7 @@ class Redistributor():
     - Construct a :class:`FlowPoints` instance
     - Abstract away (and speed up) the task of redistributing points
 
-    :param graph: The graph to use
+    :param graph: The graph to use, or a :class:`CompiledGraph`
     :param points: Array of shape `(n,2)` giving the original points
     :param min_distance: When moving points around the network, the distance to
       always travel up to.
@@ -626,9 +1086,13 @@ class Redistributor():
       Set to be `<=0` to skip the aggregation step.
     :param initial_tolerance: If not `None`, then initially group points up to
       this tolerance, ignoring the graph.
+    :param processes: Passed to :class:`NetworkProjectAggregate`.
     """
-    def __init__(self, graph, points, min_distance, max_distance, tolerance=10, initial_tolerance=0.5):
-        self._agg = NetworkProjectAggregate(graph, points, tolerance, initial_tolerance)
+    def __init__(self, graph, points, min_distance, max_distance, tolerance=10,
+            initial_tolerance=0.5, processes=1):
+        self._compiled = compile_graph(graph)
+        self._agg = NetworkProjectAggregate(graph, points, tolerance,
+            initial_tolerance, processes)
         self._flow = FlowPoints(graph, self._agg.graph_points, min_distance, max_distance)
         self._cache = dict()
         self._point_lookup = None
@@ -658,8 +1122,35 @@ class Redistributor():
         """Return a new location for the point, which should have been in the
         input data."""
         if self._point_lookup is None:
-            self._point_lookup = {tuple(pt) : i for i, pt in enumerate(self._agg.points)}
-        pt = tuple(pt)
-        if pt not in self._point_lookup:
+            self._point_lookup = _geometry.PointLookup(self._agg.points)
+        index = self._point_lookup.indices([pt])[0]
+        if index < 0:
             raise ValueError("Point was not in original collection.")
-        return self.redistribute(self._point_lookup[pt])
+        return self.redistribute(int(index))
+
+    def redistribute_many(self, indices):
+        """Return new locations for many points at once.  Points are grouped
+        by aggregated point, so that each flow is computed once, and all the
+        samples needed from it are drawn together.  Does not use, or change,
+        the cache used by :meth:`redistribute`.
+
+        :param indices: Array of shape `(n,)` of indices into the original
+          input list.
+
+        :return: Array of shape `(n,2)` of new locations.
+        """
+        lookup = _np.asarray(self._agg.to_projected_lookup, dtype=_np.int64)
+        projected = lookup[_np.asarray(indices, dtype=_np.int64)]
+        if len(projected) == 0:
+            return _np.empty((0, 2))
+        unique, inverse = _np.unique(projected, return_inverse=True)
+        inverse = inverse.ravel()
+        order = _np.argsort(inverse, kind="stable")
+        counts = _np.bincount(inverse)
+        starts = _np.concatenate([[0], _np.cumsum(counts)])
+        edges = _np.empty(len(projected), dtype=_np.int64)
+        ts = _np.empty(len(projected))
+        for i, start, end in zip(unique.tolist(), starts[:-1].tolist(), starts[1:].tolist()):
+            subset = self._flow.flow(i)
+            edges[order[start:end]], ts[order[start:end]] = subset.sample_arrays(end - start)
+        return self._compiled.edges_to_coords(edges, ts)
@@ -13,13 +13,13 @@ will share the same `incident` code.
 
 import csv as _csv
 import collections as _collections
-import datetime as _datetime
 import geopandas as _gpd
 import pandas as _pd
 import numpy as _np
 import fiona as _fiona
 import shapely.geometry as _geometry
 import pyproj as _pyproj
+from . import timestamps as _timestamps
 
 def projector():    
     """:class:`pyproj.Proj` instance suitable for this data,
@@ -50,7 +50,7 @@ def load(filename):
         lookup = [header.index(x.upper()) for x in _HEADER]
         for row in reader:
             row = [row[x] for x in lookup]
-            dt = _datetime.datetime.strptime(row[4] + " " + row[5], "%m/%d/%Y %H:%M")
+            dt = _timestamps.parser(_timestamps.MDY_HM)(row[4] + " " + row[5])
             x, y = float(row[9]), float(row[10])
             if abs(y-90) < 1e-5:
                 continue
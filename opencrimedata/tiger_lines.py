@@ -11,7 +11,16 @@ import numpy as _np
 import collections as _collections
 import geopandas as _gpd
 import open_cp.network as _network
+import pandas as _pd
+import shapely as _shapely
 import shapely.geometry as _shapelygeometry
+import scipy.spatial as _spatial
+from . import network as _network_ocd
+from . import geometry as _geometry
+import itertools as _itertools
+import hashlib as _hashlib
+import json as _json
+import os as _os
 import logging as _logging
 
 _logger = _logging.getLogger(__name__)
@@ -44,17 +53,24 @@ def load_roads_zip(zip_filename, zip_path=""):
     with _fiona.open(zip_path, vfs="zip://" + zip_filename) as shapefile:
         yield from _yield_road_data(shapefile)
 
-def project_roads(roads, proj):
-    """Helper function to project road data.
+def project_roads(roads, proj, batch_size=10000):
+    """Helper function to project road data.  Projects `batch_size` roads at
+    once, see :func:`geometry.project_lines`.
 
     :param roads: Iterable of `(name, geo)`
     :param proj: A `pyproj.Proj` instance, or similar callable object
-      which takes `(long, lat)` and returns `(x, y)`.
+      which takes arrays of longitudes and latitudes and returns `(xs, ys)`.
 
     :return: Iterable of `(name, geo)`
     """
-    for name, geo in roads:
-        yield name, _np.asarray([proj(*pt) for pt in geo])
+    roads = iter(roads)
+    while True:
+        batch = list(_itertools.islice(roads, batch_size))
+        if len(batch) == 0:
+            return
+        lines = _geometry.project_lines([geo for _, geo in batch], proj)
+        for (name, _), geo in zip(batch, lines):
+            yield name, geo
 
 
 Edge = _collections.namedtuple("edge", "fullname left_address_from left_address_to right_address_from right_address_to line")
@@ -98,19 +114,17 @@ def load_edges_zip(zip_filename, zip_path=""):
     with _fiona.open(zip_path, vfs="zip://" + zip_filename) as shapefile:
         yield from _yield_edge_data(shapefile)
 
-def project_edges(edges, proj):
-    """Helper function to project edge data.
+def project_edges(edges, proj, batch_size=10000):
+    """Helper function to project edge data.  Projects `batch_size` edges at
+    once, see :func:`geometry.project_streets`.
 
     :param roads: Iterable of `edge` objects
     :param proj: A `pyproj.Proj` instance, or similar callable object
-      which takes `(long, lat)` and returns `(x, y)`.
+      which takes arrays of longitudes and latitudes and returns `(xs, ys)`.
 
     :return: Iterable of `edge` objects
     """
-    for edge in edges:
-        geo = _np.asarray([proj(*pt) for pt in edge.line])
-        r = tuple(edge)[:-1] + (geo,)
-        yield Edge(*r)
+    yield from _geometry.project_streets(edges, proj, batch_size)
 
 def filter_edge_names(edges):
     """Remove "edges" which have no name, or which are an "alley" or which are
@@ -135,9 +149,25 @@ def filter_names(name):
         return False
     return True
 
+def filter_names_many(names):
+    """Vectorised version of :func:`filter_names`.
+
+    :param names: Array or list of names, with `None` (or `NaN`) for a
+      missing name.
+
+    :return: Boolean array.
+    """
+    names = _np.asarray(names, dtype=object).ravel()
+    present = ~_pd.isna(names)
+    upper = _np.char.upper(_np.where(present, names, "").astype(str))
+    return (present & (upper != "ALLEY") & ~_np.char.endswith(upper, " RR")
+        & ~_np.char.endswith(upper, " RLWY"))
+
 def roads_to_graph(roads):
     """Construct an `open_cp.network` style graph from a "roads" input.
-    Merges very close vertices (<0.1 meters) and repeated edges.
+    Merges very close vertices (<0.1 meters) and repeated edges.  The input
+    is streamed, see :class:`geometry.StreamingGraphBuilder` for how vertices
+    are merged.
 
     :param roads: Iterable of `(name, geo)`
 
@@ -145,57 +175,46 @@ def roads_to_graph(roads):
       index to the set of road names which make use of that edge (in
       either direction).
     """
-    roads = list(roads)
-    all_nodes = []
-    for _, geo in roads:
-        for pt in geo:
-            all_nodes.append(pt)
-
-    b = _network.PlanarGraphNodeOneShot(all_nodes)
-    name_lookup = _collections.defaultdict(set)
+    builder = _geometry.StreamingGraphBuilder()
+    road_names = []
     for name, geo in roads:
-        for e in b.add_path(geo):
-            name_lookup[e].add(name)
-
-    b.remove_duplicate_edges()
-    graph = b.build()
+        builder.add_line(geo)
+        road_names.append(name)
+    graph, edges, lines, _ = builder.build()
     names = _collections.defaultdict(set)
-    for e, ns in name_lookup.items():
-        index, _ = graph.find_edge(*e)
-        names[index].update(ns)
+    for index, line in zip(edges.tolist(), lines.tolist()):
+        names[index].add(road_names[line])
     return graph, dict(names)
 
 def edges_to_graph(edges):
     """Construct an `open_cp.network` style graph from an "edges" input.
     Merges very close vertices (<0.1 meters).  From "edges" data there should
-    not be repeated edges.
+    not be repeated edges: an edge traversed in both directions raises an
+    exception, as does an edge with differing data.  The input is streamed,
+    see :class:`geometry.StreamingGraphBuilder` for how vertices are merged.
 
     :param roads: Iterable of `(name, geo)`
 
     :return: `(graph, names)` where `names` is a dictionary from the edge
       index to an instance of `EdgeNoLine`.
     """
-    edges = list(edges)
-    all_nodes = []
-    for edge in edges:
-        for pt in edge.line:
-            all_nodes.append(pt)
-
-    b = _network.PlanarGraphNodeOneShot(all_nodes)
-    name_lookup = _collections.defaultdict(set)
+    builder = _geometry.StreamingGraphBuilder()
+    edge_data = []
     for edge in edges:
-        for e in b.add_path(edge.line):
-            name_lookup[e].add(_to_edge_noline(edge))
-
-    graph = b.build()
-    names = dict()
-    for e, ns in name_lookup.items():
-        index, _ = graph.find_edge(*e)
+        builder.add_line(edge.line)
+        edge_data.append(_to_edge_noline(edge))
+    graph, segment_edges, lines, orientations = builder.build()
+    names, first_orientation = dict(), dict()
+    for index, line, orient in zip(segment_edges.tolist(), lines.tolist(), orientations.tolist()):
+        data = edge_data[line]
         if index in names:
-            raise Exception("Repeated edge: {}".format(e))
-        if len(ns) > 1:
-            raise Exception("Edge {} has multiple data: {}".format(e, ns))
-        names[index] = list(ns)[0]
+            if first_orientation[index] != orient:
+                raise Exception("Repeated edge: {}".format(graph.edges[index]))
+            if names[index] != data:
+                raise Exception("Edge {} has multiple data: {}".format(
+                    graph.edges[index], {names[index], data}))
+        names[index] = data
+        first_orientation[index] = orient
     return graph, names
 
 def merge_graphs(roads_graph, edges_graph):
@@ -207,14 +226,45 @@ def merge_graphs(roads_graph, edges_graph):
       giving the corresponding edge index in `edges_graph`.
     """
     vertex_lookup = _merge_vertices(edges_graph, roads_graph)
-    edge_lookup = []
-    for edge in roads_graph.edges:
-        try:
-            index, _ = edges_graph.find_edge(*[vertex_lookup[k] for k in edge])
-            edge_lookup.append(index)
-        except KeyError:
-            raise ValueError("Edge {} missing from `edges` graph".format(edge))
-    return edge_lookup
+    compiled = _network_ocd.compile_graph(edges_graph)
+    index = compiled.key_to_index
+    ends = _np.asarray([[index[vertex_lookup[k]] for k in edge]
+        for edge in roads_graph.edges], dtype=_np.int64).reshape(-1, 2)
+    edge_lookup, _ = compiled.find_edges(ends[:,0], ends[:,1])
+    missing = _np.nonzero(edge_lookup < 0)[0]
+    if len(missing) > 0:
+        raise ValueError("Edge {} missing from `edges` graph".format(roads_graph.edges[missing[0]]))
+    return edge_lookup.tolist()
+
+VertexMismatch = _collections.namedtuple("VertexMismatch", "key point nearest distance")
+
+def match_vertices(super_graph, sub_graph, tolerance=0.1):
+    """Match each vertex in `sub_graph` to the closest vertex in
+    `super_graph`, using a single `cKDTree` query.
+
+    :return: Pair `(lookup, mismatches)` where `lookup` is a dictionary from
+      the vertex keys of `sub_graph` to vertex keys in `super_graph`, and
+      `mismatches` is a list of :class:`VertexMismatch` instances, one for
+      each vertex of `sub_graph` whose closest vertex is further away than
+      `tolerance`.  These vertices are missing from `lookup`.
+    """
+    super_keys = list(super_graph.vertices)
+    super_points = _np.asarray([super_graph.vertices[k] for k in super_keys],
+        dtype=_np.float64).reshape(-1, 2)
+    keys = list(sub_graph.vertices)
+    points = _np.asarray([sub_graph.vertices[k] for k in keys], dtype=_np.float64).reshape(-1, 2)
+    if len(super_points) == 0:
+        distances = _np.full(len(points), _np.inf)
+        nearest = _np.full(len(points), -1, dtype=_np.int64)
+    else:
+        distances, nearest = _spatial.cKDTree(super_points).query(points, workers=-1)
+    ok = distances <= tolerance
+    lookup = {keys[i] : super_keys[j] for i, j in
+        zip(_np.nonzero(ok)[0].tolist(), nearest[ok].tolist())}
+    mismatches = [VertexMismatch(keys[i], tuple(points[i].tolist()),
+            super_keys[nearest[i]] if nearest[i] >= 0 else None, float(distances[i]))
+        for i in _np.nonzero(~ok)[0].tolist()]
+    return lookup, mismatches
 
 def _merge_vertices(super_graph, sub_graph, tolerance=0.1):
     """Attempt to match each vertex in `sub_graph` to a vertex in
@@ -223,15 +273,12 @@ def _merge_vertices(super_graph, sub_graph, tolerance=0.1):
     :return: A dictionary from the vertex keys of `sub_graph` to vertex keys
       in `super_graph`.
     """
-    tolerance = tolerance ** 2
-    lookup = dict()
-    for key, (x,y) in sub_graph.vertices.items():
-        (v1,v2), t = super_graph.project_point_to_graph(x, y)
-        v = v1 if t < 0.5 else v2
-        xx, yy = super_graph.vertices[v]
-        if (x-xx)**2 + (y-yy)**2 > tolerance:
-            raise ValueError("Vertices do not match up to tolerance.")
-        lookup[key] = v
+    lookup, mismatches = match_vertices(super_graph, sub_graph, tolerance)
+    if len(mismatches) > 0:
+        report = "\n".join("  vertex {} at {}: closest is {} at distance {}".format(*m)
+            for m in mismatches)
+        raise ValueError("Vertices do not match up to tolerance; {} mismatches:\n{}".format(
+            len(mismatches), report))
     return lookup
 
 def compute_all_names(roads_graph, roads_names, edges_graph, edges_names, roads_edges_to_edges_edges=None):
@@ -271,44 +318,159 @@ def all_names_to_frame(edges_graph, all_names):
     :param all_names: As from :func:`compute_all_names`
     """
     all_names = list(all_names)
-    frame = _gpd.GeoDataFrame({"left_add_from" : [e.left_address_from for e, _ in all_names],
-        "left_add_to" : [e.left_address_to for e, _ in all_names],
-        "right_add_from" : [e.right_address_from for e, _ in all_names],
-        "right_add_to" : [e.right_address_to for e, _ in all_names],
-        "edge_number" : [i for i,_ in enumerate(all_names)],
-        })
-    
-    all_name_options = [list(names) for _, names in all_names]
-    maxlen = max(len(names) for names in all_name_options)
-    for i in range(maxlen):
-        name = "name{}".format(i)
-        data = []
-        for names in all_name_options:
-            if len(names) > i:
-                data.append(names[i])
-            else:
-                data.append(None)
-        frame[name] = data
-
-    geo = []
-    for edge in edges_graph.edges:
-        line = [edges_graph.vertices[x] for x in edge]
-        geo.append(_shapelygeometry.LineString(line))
-    frame.geometry = geo
-
-    return frame
+    columns = dict()
+    fields = list(zip(*[e for e, _ in all_names])) or [()] * len(EdgeNoLine._fields)
+    for column, field in [("left_add_from", 1), ("left_add_to", 2),
+            ("right_add_from", 3), ("right_add_to", 4)]:
+        values = _np.empty(len(all_names), dtype=object)
+        values[:] = fields[field]
+        columns[column] = values
+    columns["edge_number"] = _np.arange(len(all_names))
+
+    flat, rows, positions = _geometry.flatten_lists(names for _, names in all_names)
+    for i in range(int(_np.max(positions, initial=-1)) + 1):
+        data = _np.full(len(all_names), None, dtype=object)
+        m = positions == i
+        data[rows[m]] = flat[m]
+        columns["name{}".format(i)] = data
+
+    vertices = edges_graph.vertices
+    coords = _np.asarray([(vertices[a], vertices[b]) for a, b in edges_graph.edges],
+        dtype=_np.float64).reshape(-1, 2, 2)
+    if hasattr(_shapely, "linestrings"):
+        geo = _shapely.linestrings(coords)
+    else:
+        geo = [_shapelygeometry.LineString(line) for line in coords]
+    return _gpd.GeoDataFrame(columns, geometry=geo)
+
+
+# Increase when the graphs built change, so old cache files are not used
+_CACHE_VERSION = 2
+
+def _hash_input(hasher, filename):
+    """Add the contents of the input files to the `hashlib` object."""
+    zf = TigerLines._zip_filename(filename)
+    if zf is not None:
+        paths = [zf[0]]
+        hasher.update(zf[1].encode("utf8"))
+    elif _os.path.isdir(filename):
+        paths = [_os.path.join(filename, x) for x in sorted(_os.listdir(filename))]
+    else:
+        # A ".shp" file and its sibling files
+        stem = _os.path.splitext(filename)[0]
+        directory = _os.path.dirname(filename) or "."
+        paths = [_os.path.join(directory, x) for x in sorted(_os.listdir(directory))
+            if _os.path.splitext(_os.path.join(directory, x))[0] == stem]
+    for path in paths:
+        if not _os.path.isfile(path):
+            continue
+        hasher.update(_os.path.basename(path).encode("utf8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda : f.read(1 << 20), b""):
+                hasher.update(block)
+
+def cache_key(roads_filename, edges_filename, proj):
+    """The key used by :class:`TigerLines` to cache the graphs built from
+    these inputs: a hash of the contents of the input files, and the
+    projection parameters.
+
+    :return: The key, a string, or `None` if `proj` has no `srs` attribute
+      (as `pyproj.Proj` objects do) and so cannot be identified.
+    """
+    srs = getattr(proj, "srs", None)
+    if not isinstance(srs, str):
+        return None
+    hasher = _hashlib.sha256()
+    hasher.update("version={}\nsrs={}\n".format(_CACHE_VERSION, srs).encode("utf8"))
+    for filename in [roads_filename, edges_filename]:
+        hasher.update(b"\n--\n")
+        _hash_input(hasher, filename)
+    return hasher.hexdigest()
+
+def _graph_to_arrays(graph):
+    keys = list(graph.vertices)
+    index = {k : i for i, k in enumerate(keys)}
+    coords = _np.asarray([graph.vertices[k] for k in keys], dtype=_np.float64).reshape(-1, 2)
+    edges = _np.asarray([(index[a], index[b]) for a, b in graph.edges], dtype=_np.int64).reshape(-1, 2)
+    return _np.asarray(keys), coords, edges
+
+def _graph_from_arrays(keys, coords, edges):
+    keys = keys.tolist()
+    vertices = [(k, x, y) for k, (x, y) in zip(keys, coords.tolist())]
+    return _network.PlanarGraph(vertices, [(keys[a], keys[b]) for a, b in edges.tolist()])
+
+def _json_to_array(data):
+    return _np.frombuffer(_json.dumps(data).encode("utf8"), dtype=_np.uint8)
+
+def _json_from_array(array):
+    return _json.loads(array.tobytes().decode("utf8"))
+
+def _save_cache(filename, roads_graph, roads_names, edges_graph, edges_names, roads_to_edges):
+    """Write the graphs and lookups as a single `.npz` file, atomically."""
+    arrays = dict()
+    for prefix, graph in [("roads", roads_graph), ("edges", edges_graph)]:
+        keys, coords, edges = _graph_to_arrays(graph)
+        arrays[prefix + "_keys"] = keys
+        arrays[prefix + "_coords"] = coords
+        arrays[prefix + "_edges"] = edges
+    arrays["roads_names"] = _json_to_array([[i, list(names)] for i, names in roads_names.items()])
+    arrays["edges_names"] = _json_to_array([[i, list(edge)] for i, edge in edges_names.items()])
+    arrays["roads_to_edges"] = _np.asarray(roads_to_edges, dtype=_np.int64)
+    temporary = filename + ".tmp"
+    with open(temporary, "wb") as f:
+        _np.savez(f, **arrays)
+    _os.replace(temporary, filename)
+
+def _load_cache(filename):
+    """Inverse of :func:`_save_cache`."""
+    with _np.load(filename) as data:
+        roads_graph = _graph_from_arrays(data["roads_keys"], data["roads_coords"], data["roads_edges"])
+        edges_graph = _graph_from_arrays(data["edges_keys"], data["edges_coords"], data["edges_edges"])
+        roads_names = {i : set(names) for i, names in _json_from_array(data["roads_names"])}
+        edges_names = {i : EdgeNoLine(*edge) for i, edge in _json_from_array(data["edges_names"])}
+        roads_to_edges = data["roads_to_edges"].tolist()
+    return roads_graph, roads_names, edges_graph, edges_names, roads_to_edges
 
 
 class TigerLines():
     """Encapsulates the process of loading TIGER/Lines data.
 
+    Building the graphs is slow, so if `cache_dir` is given, the graphs, name
+    lookups and :attr:`from_roads_to_edges` are saved to, and later loaded
+    from, a file in that directory.  The file name is given by
+    :func:`cache_key`, so a change to the input files, or to the projection,
+    causes a rebuild.
+
     :param roads_filename: The path to the directory containing the shapefile
       of the "roads" data.  To load from a zip file, use the filename
       "zip://{filename_of_zip}:{path_in_zipfile}"
     :param edges_filename: Same for the "edges" data.
     :param proj: A projection object, for example from `pyproj`.
+    :param cache_dir: Optional directory to use as a cache.
     """
-    def __init__(self, roads_filename, edges_filename, proj):
+    def __init__(self, roads_filename, edges_filename, proj, cache_dir=None):
+        key = None
+        if cache_dir is not None:
+            key = cache_key(roads_filename, edges_filename, proj)
+            if key is None:
+                _logger.warning("Cannot identify projection %s, so not caching", proj)
+        if key is not None:
+            cache_filename = _os.path.join(cache_dir, "tigerlines-{}.npz".format(key))
+            if _os.path.exists(cache_filename):
+                _logger.info("Loading graphs from cache file %s", cache_filename)
+                (self._roads_graph, self._roads_name_lookup, self._edges_graph,
+                    self._edges_name_lookup, self._roads_edges_to_edges_edges) = _load_cache(cache_filename)
+            else:
+                self._build(roads_filename, edges_filename, proj)
+                _logger.info("Saving graphs to cache file %s", cache_filename)
+                _os.makedirs(cache_dir, exist_ok=True)
+                _save_cache(cache_filename, self._roads_graph, self._roads_name_lookup,
+                    self._edges_graph, self._edges_name_lookup, self._roads_edges_to_edges_edges)
+        else:
+            self._build(roads_filename, edges_filename, proj)
+        self._compute_names()
+
+    def _build(self, roads_filename, edges_filename, proj):
         zf = self._zip_filename(roads_filename)
         if zf is None:
             _logger.debug("Attempting to open %s to read roads data", roads_filename)
@@ -333,6 +495,8 @@ class TigerLines():
 
         _logger.info("Merging graphs")
         self._roads_edges_to_edges_edges = merge_graphs(self._roads_graph, self._edges_graph)
+
+    def _compute_names(self):
         self._all_names_data = list(compute_all_names(self._roads_graph,
             self._roads_name_lookup, self._edges_graph, self._edges_name_lookup,
             self._roads_edges_to_edges_edges))
@@ -405,30 +569,30 @@ class TigerLines():
         Only contains rows where some name passes the "filter".
         """
         frame = self.to_geodataframe()
-        maxlen = len([x for x in frame.columns if x.startswith("name")])
-        mask = []
-        for i, row in frame.iterrows():
-            want = any(filter_names(row["name{}".format(i)]) for i in range(maxlen))
-            mask.append(want)
-        mask = _np.asarray(mask)
+        mask = _np.zeros(len(frame), dtype=bool)
+        for column in frame.columns:
+            if column.startswith("name"):
+                mask |= filter_names_many(frame[column].to_numpy(dtype=object))
         return _gpd.GeoDataFrame(frame[mask])
 
+    def edge_name_mask(self):
+        """Boolean array, for each edge in `edges_graph`, which is `True` if
+        some name of the edge passes the "filter"."""
+        flat, rows, _ = _geometry.flatten_lists(names for _, names in self._all_names_data)
+        accepted = _np.bincount(rows[filter_names_many(flat)],
+            minlength=len(self._all_names_data))
+        return accepted > 0
+
     def make_reduced_graph(self):
         """Compute the "edges" graph, where we remove any edge which has a name
-        which is "filtered".
+        which is "filtered".  See :func:`network.edge_subgraph` to also obtain
+        the vertex index maps.
 
         :return: `(graph, edge_list)` where `graph` is the new graph, and
           `edge_list` is a list (in order) of the edges of `edges_graph` used.
         """
-        builder = _network.PlanarGraphBuilder()
-        builder.vertices.update(self.edges_graph.vertices)
-        edge_list = []
-        for i, (edge, (address, names)) in enumerate(zip(self.edges_graph.edges, self.merged_names)):
-            if any(filter_names(x) for x in names):
-                builder.add_edge(*edge)
-                edge_list.append(i)
-        builder.remove_unused_vertices()
-        return builder.build(), edge_list
+        subgraph = _network_ocd.edge_subgraph(self.edges_graph, self.edge_name_mask())
+        return subgraph.graph, subgraph.edge_to_old.tolist()
 
     @staticmethod
     def _zip_filename(filename):
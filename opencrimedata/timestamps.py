@@ -0,0 +1,147 @@
+"""
+timestamps
+~~~~~~~~~~
+
+Fast parsing of the fixed layout timestamps used by the city data sets.
+Gives exactly the same results as `datetime.datetime.strptime`, which is
+used as a fallback for any string not in the expected layout (so that, for
+example, the same exceptions are raised).
+"""
+
+import datetime as _datetime
+import functools as _functools
+import re as _re
+import numpy as _np
+
+#: Format used by Chicago and Dallas, e.g. "10/12/2006 10:58:00 AM"
+MDY_IMS_P = "%m/%d/%Y %I:%M:%S %p"
+#: Format used by San Francisco (after joining date and time), e.g.
+#: "01/19/2015 14:00"
+MDY_HM = "%m/%d/%Y %H:%M"
+
+# For each format: the regular expression; an example string with every
+# digit replaced by "0"; the positions of the fields month, day, year, hour,
+# minute, second (or `None` if missing); the position of "AM"/"PM" (or `None`).
+_LAYOUTS = {
+    MDY_IMS_P : (r"(\d\d)/(\d\d)/(\d\d\d\d) (\d\d):(\d\d):(\d\d) ([AaPp][Mm])",
+        "00/00/0000 00:00:00 AM", [(0,2), (3,5), (6,10), (11,13), (14,16), (17,19)], 20),
+    MDY_HM : (r"(\d\d)/(\d\d)/(\d\d\d\d) (\d\d):(\d\d)",
+        "00/00/0000 00:00", [(0,2), (3,5), (6,10), (11,13), (14,16), None], None),
+    }
+
+
+class Parser():
+    """Parse timestamps in a fixed format.  Repeated strings, which are very
+    common in per-day data, are remembered.
+
+    :param format: One of the supported formats, :data:`MDY_IMS_P` or
+      :data:`MDY_HM`.
+    :param memo_size: The maximum number of strings to remember.
+    """
+    def __init__(self, format, memo_size=100000):
+        if format not in _LAYOUTS:
+            raise ValueError("Unsupported format: {}".format(format))
+        self._format = format
+        regex, self._layout, self._fields, self._ampm = _LAYOUTS[format]
+        self._regex = _re.compile(regex, _re.ASCII)
+        self._parse_memo = _functools.lru_cache(maxsize=memo_size)(self._parse)
+
+    @property
+    def format(self):
+        """The `strptime` format string."""
+        return self._format
+
+    def __call__(self, string):
+        """Parse the string to a `datetime.datetime` instance."""
+        return self._parse_memo(string)
+
+    def _parse(self, string):
+        match = self._regex.fullmatch(string)
+        if match is not None:
+            fields = [int(x) for x in match.groups()[:5]]
+            month, day, year, hour, minute = fields
+            second = int(match.group(6)) if self._fields[5] is not None else 0
+            if self._ampm is not None:
+                if 1 <= hour <= 12:
+                    hour = hour % 12 + (12 if match.group(7).upper() == "PM" else 0)
+                else:
+                    hour = -1
+            if 0 <= hour <= 23 and minute <= 59 and second <= 59:
+                return _datetime.datetime(year, month, day, hour, minute, second)
+        return _datetime.datetime.strptime(string, self._format)
+
+    def parse_many(self, strings, allow_empty=False):
+        """Parse an array of strings at once, using vectorised operations for
+        strings in the usual layout.
+
+        :param strings: Array or list of strings.
+        :param allow_empty: If `True` then the empty string is mapped to
+          "NaT"; otherwise, as for `strptime`, an exception is raised.
+
+        :return: Array of `datetime64[s]`.
+        """
+        strings = _np.asarray(strings, dtype=str).ravel()
+        out = _np.empty(len(strings), dtype="datetime64[s]")
+        fast = _np.zeros(len(strings), dtype=bool)
+        if strings.dtype.itemsize // 4 == len(self._layout) and len(strings) > 0:
+            fast, values = self._parse_fixed(strings)
+            out[fast] = values
+        for i in _np.nonzero(~fast)[0]:
+            if allow_empty and strings[i] == "":
+                out[i] = _np.datetime64("NaT")
+            else:
+                out[i] = _np.datetime64(self._parse_memo(str(strings[i])), "s")
+        return out
+
+    def _parse_fixed(self, strings):
+        """Parse strings of exactly the expected length.
+
+        :return: Pair `(mask, values)` where `mask` indicates which strings were
+          in the usual layout, and `values` are the timestamps of these.
+        """
+        chars = strings.view(_np.uint32).reshape(len(strings), len(self._layout))
+        digits = chars.astype(_np.int64) - ord("0")
+        layout = _np.asarray(list(self._layout)).view(_np.uint32)
+        is_digit = (digits >= 0) & (digits <= 9)
+        # Keep the fields of strings not in the layout small, to avoid overflow
+        digits[~is_digit] = 0
+        expected_digit = layout == ord("0")
+        mask = _np.all(is_digit[:, expected_digit], axis=1)
+        separators = ~expected_digit
+        if self._ampm is not None:
+            separators[self._ampm : self._ampm + 2] = False
+        mask &= _np.all(chars[:, separators] == layout[separators], axis=1)
+        def field(position):
+            if position is None:
+                return _np.zeros(len(strings), dtype=_np.int64)
+            start, end = position
+            value = _np.zeros(len(strings), dtype=_np.int64)
+            for i in range(start, end):
+                value = value * 10 + digits[:,i]
+            return value
+        month, day, year, hour, minute, second = [field(p) for p in self._fields]
+        if self._ampm is not None:
+            first = chars[:, self._ampm] | 0x20
+            second_char = chars[:, self._ampm + 1] | 0x20
+            pm = first == ord("p")
+            mask &= ((first == ord("a")) | pm) & (second_char == ord("m"))
+            mask &= (hour >= 1) & (hour <= 12)
+            hour = hour % 12 + 12 * pm
+        mask &= (hour <= 23) & (minute <= 59) & (second <= 59)
+        mask &= (month >= 1) & (month <= 12) & (day >= 1) & (year >= 1)
+        month_start = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+        days_in_month = ((month_start + 1).astype("datetime64[D]")
+            - month_start.astype("datetime64[D]")).astype(_np.int64)
+        mask &= day <= days_in_month
+        values = (month_start.astype("datetime64[D]") + (day - 1)).astype("datetime64[s]")
+        values = values + (hour * 3600 + minute * 60 + second)
+        return mask, values[mask]
+
+
+def parser(format):
+    """Return a shared :class:`Parser` for the format."""
+    if format not in _parsers:
+        _parsers[format] = Parser(format)
+    return _parsers[format]
+
+_parsers = dict()
@@ -104,6 +104,16 @@ class Voroni(_BaseVoroni):
         which must have been a point in the input data."""
         return self._agg_points[pt]
 
+    def map_to_merged_points(self, points):
+        """As :meth:`map_to_merged_point` but for an array of points at once.
+
+        :param points: Array of shape `(n,2)` of points, each of which must
+          have been in the input data.
+
+        :return: Array of shape `(n,2)` of merged points.
+        """
+        return self._agg_points.merged_points[self._agg_points.indices(points)]
+
 
 class VoroniMergedCells(_BaseVoroni):
     """Construct a Voroni diagram where we merge (set-theoretic union) some
@@ -1,6 +1,7 @@
 import pytest
 import unittest.mock as mock
 import os
+import numpy as np
 
 import opencrimedata.address as address
 
@@ -50,3 +51,42 @@ def test_AddressMatch_zip(zipfile):
     proj = mock.Mock()
     proj.return_value = [0, 1]
     address.AddressMatch.from_zip(zipfile, "il", "cook", proj)
+
+def test_AddressMatch_save_load(tmpdir):
+    match = address.AddressMatch(os.path.join("tests/data/test.csv"), lambda x, y : (x, y))
+    match._addresses = match._addresses.astype("<U20")
+    match._addresses[3] = ["12", "Ünïcode Street"]
+    dirname = str(tmpdir.join("index"))
+    match.save(dirname)
+    loaded = address.AddressMatch.load(dirname)
+
+    np.testing.assert_array_equal(loaded.address_points, match.address_points)
+    pt = match.address_points[3] + 0.0001
+    a1, p1 = match.closest(pt)
+    a2, p2 = loaded.closest(pt)
+    assert list(a2) == ["12", "Ünïcode Street"]
+    assert list(a1) == list(a2)
+    np.testing.assert_array_equal(p1, p2)
+
+    a1, p1 = match.all_in_disc(pt, 1)
+    a2, p2 = loaded.all_in_disc(pt, 1)
+    np.testing.assert_array_equal(a1, a2)
+    np.testing.assert_array_equal(p1, p2)
+    assert a2.shape == (9, 2)
+
+    np.testing.assert_array_equal(loaded.addresses, match.addresses)
+
+    # The addresses are a lazy view, which is not decoded by accessing it
+    addresses = loaded.addresses
+    assert addresses is loaded.addresses
+    assert not isinstance(addresses, np.ndarray)
+    assert addresses.shape == match.addresses.shape
+    assert list(addresses[3]) == ["12", "Ünïcode Street"]
+    np.testing.assert_array_equal(addresses[[3, 1]], match.addresses[[3, 1]])
+    np.testing.assert_array_equal(addresses[2:5], match.addresses[2:5])
+    assert [list(a) for a in addresses] == match.addresses.tolist()
+
+    # Saving a loaded index copies the encoded strings
+    loaded.save(str(tmpdir.join("index2")))
+    again = address.AddressMatch.load(str(tmpdir.join("index2")))
+    np.testing.assert_array_equal(again.addresses, match.addresses)
@@ -88,3 +88,38 @@ def test_row_with_new_position():
     
     assert tuple(row)[:-1] == tuple(row1)[:-1]
     assert row1.point == pytest.approx((12.64552, -32.27471))
+
+def test_load_columns(filename):
+    rows = list(chicago.load(filename))
+    frame = chicago.load_columns(filename, chunk_size=4)
+    assert list(frame.columns) == ["id", "crime_type", "crime_subtype", "location",
+        "address", "datetime", "lon", "lat"]
+    assert list(frame.id) == [row.id for row in rows]
+    assert list(frame.crime_type) == [row.crime_type for row in rows]
+    assert list(frame.address) == [row.address for row in rows]
+    assert list(frame.datetime.dt.to_pydatetime()) == [row.datetime for row in rows]
+    assert frame.lon[0] == pytest.approx(-87.531655723)
+    assert frame.lat[0] == pytest.approx(41.698387427)
+
+def test_load_columns_filters(filename):
+    rows = list(chicago.load(filename))
+    frame = chicago.load_columns(filename, crime_type="THEFT")
+    assert list(frame.id) == [row.id for row in rows if row.crime_type == "THEFT"]
+    frame = chicago.load_columns(filename, crime_type=["THEFT", "BURGLARY"])
+    assert list(frame.id) == [row.id for row in rows if row.crime_type in {"THEFT", "BURGLARY"}]
+
+    start, end = datetime.datetime(2006, 11, 1), datetime.datetime(2006, 12, 17, 12)
+    frame = chicago.load_columns(filename, start=start, end=end)
+    assert list(frame.id) == [row.id for row in rows if start <= row.datetime < end]
+
+    frame = chicago.load_columns(filename, only_with_point=True)
+    assert list(frame.id) == [row.id for row in chicago.load_only_with_point(filename)]
+
+    frame = chicago.load_columns(filename, crime_type="NOT A CRIME")
+    assert len(frame) == 0
+
+def test_to_geoframe_with_crime_type(filename):
+    frame = chicago.to_geoframe(filename, crime_type="THEFT")
+    rows = [row for row in chicago.load(filename) if row.crime_type == "THEFT"]
+    assert len(frame) == len(rows)
+    assert frame.geometry[0].coords[0] == pytest.approx(rows[0].point)
@@ -1,4 +1,5 @@
 import pytest
+import collections
 
 import opencrimedata.dallas as dallas
 
@@ -60,6 +61,145 @@ def test_load_full(filename):
     assert out[index].lonlat == pytest.approx((-96.807131, 32.953948))
     assert out[index].xy == pytest.approx((2487549.90103337*1200 / 3937, 7034119.57307657*1200 / 3937))
 
+def _out_of_order_file(filename):
+    import csv, io
+    with open(filename, "rt") as f:
+        rows = list(csv.reader(f))
+    header, base = rows[0], rows[1]
+    index = [x.strip().upper() for x in header].index("SERVICE NUMBER ID")
+    address = [x.strip().upper() for x in header].index("INCIDENT ADDRESS")
+    ids = ["1-2016-01", "1-2016-02", "2-2016-01", "3-2016-01", "2-2016-02",
+           "4-2016-01", "4-2016-02", "5-2016-01", "1-2016-03", "6-2016-01",
+           "7-2016-02", "6-2016-02", "7-2016-01", "8-2016-01", "9-2016-01", "2-2016-03"]
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(header)
+    for i, idd in enumerate(ids):
+        row = list(base)
+        row[index] = idd
+        row[address] = "" if idd.endswith("01") else "ADDRESS {}".format(idd[0])
+        writer.writerow(row)
+    return out.getvalue()
+
+def test_load_full_streaming(filename):
+    import io
+    data = _out_of_order_file(filename)
+    expected = list(dallas._load_full_in_memory(dallas._read_rows(io.StringIO(data))))
+    assert [row.code[0] for row in expected] == list("123456789")
+    assert expected[0].address == "ADDRESS 1"
+    for max_pending in [1, 2, 100]:
+        assert list(dallas.load_full(io.StringIO(data), max_pending)) == expected
+
+    class Unseekable(io.StringIO):
+        def seekable(self):
+            return False
+    assert list(dallas.load_full(Unseekable(data))) == expected
+
+def test_load_full_streaming_is_lazy(filename):
+    import io
+    data = _out_of_order_file(filename)
+    rows = dallas._read_rows(io.StringIO(data))
+    groups = dallas._GroupStore(10)
+    captured = dallas._collect_split_groups(dallas._read_rows(io.StringIO(data)), groups)
+    assert captured == [[4,4], [8,8], [11,11], [12,12], [15,15]]
+    assert len(groups) == 4
+    assert [s for s, _ in groups.pop("7-2016")] == [1]
+    consumed = []
+    def tracking():
+        for row in rows:
+            consumed.append(row)
+            yield row
+    out = dallas._load_full_streaming(tracking(), [], dallas._GroupStore(10))
+    assert next(out).code == "1-2016"
+    assert len(consumed) == 3
+
+def test_load_full_hash_collision(filename, monkeypatch):
+    import io
+    data = _out_of_order_file(filename)
+    expected = list(dallas._load_full_in_memory(dallas._read_rows(io.StringIO(data))))
+    # Every code "seen" already, so every run is captured by the first pass
+    class HashSet(dallas._HashSet):
+        def __contains__(self, value):
+            return True
+    monkeypatch.setattr(dallas, "_HashSet", HashSet)
+    assert list(dallas.load_full(io.StringIO(data))) == expected
+
+def test_HashSet():
+    hashes = dallas._HashSet(batch_size=3)
+    values = [5, -7, 2**62, 0, 11, 3, -2**63]
+    for i, v in enumerate(values):
+        assert v not in hashes
+        hashes.add(v)
+        assert all(u in hashes for u in values[:i+1])
+    assert len(hashes._sorted) == 6
+    assert 4 not in hashes
+
+Record = collections.namedtuple("Record", "code")
+
+def test_GroupStore():
+    store = dallas._GroupStore(2)
+    for i in range(5):
+        store.add(1, Record(i))
+    store.add(2, Record(0))
+    store.add(2, Record(4))
+    assert len(store) == 5
+    assert store.codes_in_memory == 2
+    assert store.pop(0) == [(1, Record(0)), (2, Record(0))]
+    assert store.pop(4) == [(1, Record(4)), (2, Record(4))]
+    assert [store.pop(i) for i in [1, 2, 3]] == [[(1, Record(i))] for i in [1, 2, 3]]
+    assert len(store) == 0
+    assert store._file is None
+    store.close()
+
+def _early_incident_file(filename, size=200):
+    import csv, io
+    with open(filename, "rt") as f:
+        rows = list(csv.reader(f))
+    header, base = rows[0], rows[1]
+    index = [x.strip().upper() for x in header].index("SERVICE NUMBER ID")
+    address = [x.strip().upper() for x in header].index("INCIDENT ADDRESS")
+    ids = ["1-2016-01"] + ["{}-2016-01".format(i) for i in range(2, size)]
+    ids.insert(len(ids) - 1, "1-2016-02")
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(header)
+    for idd in ids:
+        row = list(base)
+        row[index] = idd
+        row[address] = "" if idd == "1-2016-01" else "ADDRESS {}".format(idd[:-3])
+        writer.writerow(row)
+    return out.getvalue()
+
+def test_load_full_early_incident_finished_late(filename, monkeypatch):
+    import io
+    data = _early_incident_file(filename)
+    expected = list(dallas._load_full_in_memory(dallas._read_rows(io.StringIO(data))))
+    assert expected[0].code == "1-2016"
+    assert expected[0].address == "ADDRESS 1-2016"
+    assert list(dallas.load_full(io.StringIO(data), 1)) == expected
+
+    # Only the out-of-order record is stored, and the first incident is
+    # returned after the scan and two rows of the second pass.
+    stored = []
+    class Store(dallas._GroupStore):
+        def add(self, subid, record):
+            stored.append(record.code)
+            super().add(subid, record)
+    monkeypatch.setattr(dallas, "_GroupStore", Store)
+    read_rows = dallas._read_rows
+    consumed = []
+    def tracking(file):
+        for row in read_rows(file):
+            consumed.append(row)
+            yield row
+    monkeypatch.setattr(dallas, "_read_rows", tracking)
+    out = dallas.load_full(io.StringIO(data), 1)
+    assert next(out) == expected[0]
+    assert stored == ["1-2016"]
+    rows = len(expected) + 1
+    assert len(consumed) == rows + 2
+    assert next(out) == expected[1]
+
 def test_to_geoframe(filename):
     frame = dallas.to_geoframe(filename)
     assert len(frame) == 3
@@ -0,0 +1,94 @@
+import pytest
+import time
+import numpy as np
+
+import opencrimedata.disjoint_set as disjoint_set
+
+def test_DisjointSet_union():
+    ds = disjoint_set.DisjointSet(6)
+    assert ds.size == 6
+    assert ds.union(0, 1)
+    assert ds.union(3, 4)
+    assert ds.union(1, 4)
+    assert not ds.union(0, 3)
+    assert ds.find(0) == ds.find(4)
+    assert ds.find(2) == 2
+    assert ds.find(5) != ds.find(0)
+    assert list(ds.labels()) == [0, 0, 1, 0, 0, 2]
+
+def test_DisjointSet_union_pairs():
+    ds = disjoint_set.DisjointSet(7)
+    ds.union_pairs([])
+    ds.union_pairs([[5, 6], [6, 3], [1, 2]])
+    assert list(ds.labels()) == [0, 1, 1, 2, 3, 2, 2]
+    ds.union(0, 4)
+    ds.union_pairs(np.asarray([[4, 3]]))
+    assert list(ds.labels()) == [0, 1, 1, 0, 0, 0, 0]
+    roots = ds.roots()
+    assert roots[0] == roots[6]
+
+def _components(size, pairs):
+    neighbours = {i : set() for i in range(size)}
+    for a, b in pairs:
+        neighbours[a].add(b)
+        neighbours[b].add(a)
+    label = dict()
+    for i in range(size):
+        if i in label:
+            continue
+        label[i] = i
+        stack = [i]
+        while stack:
+            for j in neighbours[stack.pop()]:
+                if j not in label:
+                    label[j] = i
+                    stack.append(j)
+    return [label[i] for i in range(size)]
+
+def test_DisjointSet_random():
+    rng = np.random.RandomState(3)
+    for _ in range(10):
+        pairs = rng.randint(500, size=(400, 2))
+        expected = _components(500, pairs)
+        ds = disjoint_set.DisjointSet(500)
+        ds.union_pairs(pairs)
+        ds_stream = disjoint_set.DisjointSet(500)
+        for i, j in pairs:
+            ds_stream.union(i, j)
+        for got in [ds.roots(), ds_stream.roots()]:
+            for i in range(500):
+                for j in [0, i // 2, 499]:
+                    assert (got[i] == got[j]) == (expected[i] == expected[j])
+        assert list(ds.labels()) == list(ds_stream.labels())
+
+def test_DisjointSet_union_pairs_in_chunks():
+    rng = np.random.RandomState(5)
+    pairs = rng.randint(1000, size=(800, 2))
+    ds = disjoint_set.DisjointSet(1000)
+    ds.union_pairs(pairs)
+    chunked = disjoint_set.DisjointSet(1000)
+    for start in range(0, len(pairs), 7):
+        chunked.union_pairs(pairs[start : start + 7])
+    np.testing.assert_array_equal(ds.labels(), chunked.labels())
+    expected = np.unique(_components(1000, pairs), return_inverse=True)[1]
+    np.testing.assert_array_equal(chunked.labels(), expected)
+
+def test_DisjointSet_union_pairs_only_touches_pairs():
+    ds = disjoint_set.DisjointSet(100)
+    ds.union_pairs([[1, 2], [2, 3]])
+    parent = ds._parent.copy()
+    ds.union_pairs([[50, 51]])
+    changed = np.nonzero(ds._parent != parent)[0]
+    assert set(changed) <= {50, 51}
+
+def test_DisjointSet_union_pairs_long_chain():
+    size = 200000
+    chain = np.stack([np.arange(size - 1), np.arange(1, size)], axis=1)
+    for pairs in [chain, chain[::-1], chain[:,::-1]]:
+        ds = disjoint_set.DisjointSet(size)
+        start = time.perf_counter()
+        ds.union_pairs(pairs)
+        assert time.perf_counter() - start < 10
+        parent = ds._parent
+        assert np.array_equal(parent[parent], parent)
+        assert np.all(ds.labels() == 0)
@@ -42,6 +42,33 @@ def test_Redistributor_find(rd1):
     assert rd1.find_containing_polygon(0.2, 0.1) == [0]
     assert rd1.find_containing_polygon(2.2, 1) == [1]
 
+def test_Redistributor_find_containing_polygons(rd1):
+    pts = [(0,1), (0,0), (0.2,0.1), (2.2,1), (5,5), (1,0.5)]
+    expected = [-1, 0, 0, 1, -1, 0]
+    np.testing.assert_array_equal(rd1.find_containing_polygons(pts), expected)
+    assert len(rd1.find_containing_polygons(np.empty((0,2)))) == 0
+
+    pts = np.random.random(size=(1000,2)) * 3
+    expected = [(rd1.find_containing_polygon(x, y) + [-1])[0] for x, y in pts]
+    np.testing.assert_array_equal(rd1.find_containing_polygons(pts), expected)
+
+def test_Redistributor_find_containing_polygons_overlap():
+    polygons = [shapely.geometry.box(0,0,2,2), shapely.geometry.box(1,1,3,3)]
+    rd = geometry.Redistributor(polygons)
+    np.testing.assert_array_equal(rd.find_containing_polygons([(2.5,2.5), (1.5,1.5), (0.5,0.5)]),
+        [1, 0, 0])
+    assert rd._find_prepared(2.5, 2.5) == 1
+    assert rd._find_prepared(1.5, 1.5) == 0
+    assert rd._find_prepared(5, 5) == -1
+
+def test_Redistributor_redistribute_many(rd1):
+    pts = np.asarray([(0.2,0.1), (0,1), (2.2,1), (0.5,0.2), (2.1,0.5)])
+    out = rd1.redistribute_many(pts)
+    assert out.shape == (5,2)
+    assert np.all(np.isnan(out[1]))
+    for i, poly in [(0,0), (2,1), (3,0), (4,1)]:
+        assert rd1.polygons[poly].intersects(shapely.geometry.Point(out[i]))
+
 def test_Redistributor_redistribute(rd1):
     assert rd1.redistribute(0, 1) == []
     
@@ -62,6 +89,34 @@ def test_Redistributor_redistribute(rd1):
         pt = shapely.geometry.Point(x, y)
         assert pt.intersects(rd1.polygons[1])
 
+def test_triangulate():
+    polygon = shapely.geometry.Polygon([[0,0], [4,0], [4,4], [2,1], [0,4]],
+        [[[1,0.2], [1.5,0.2], [1.5,0.5]]])
+    triangles = geometry.triangulate(polygon)
+    assert triangles.shape[1:] == (3,2)
+    pieces = [shapely.geometry.Polygon(t) for t in triangles]
+    assert sum(p.area for p in pieces) == pytest.approx(polygon.area)
+    for p in pieces:
+        assert p.difference(polygon).area == pytest.approx(0)
+    multi = shapely.geometry.MultiPolygon([polygon, shapely.geometry.box(5,5,6,7)])
+    assert sum(shapely.geometry.Polygon(t).area for t in geometry.triangulate(multi)) == pytest.approx(multi.area)
+
+def test_PolygonSampler():
+    polygon = shapely.geometry.Polygon([[0,0], [4,0], [4,4], [2,1], [0,4]])
+    sampler = geometry.PolygonSampler(polygon)
+    assert sampler.area == pytest.approx(polygon.area)
+    pts = sampler.sample(10000)
+    assert pts.shape == (10000,2)
+    assert all(polygon.intersects(shapely.geometry.Point(pt)) for pt in pts[:1000])
+    np.testing.assert_allclose(np.mean(pts, axis=0), polygon.centroid.coords[0], atol=0.05)
+
+    with pytest.raises(ValueError):
+        geometry.PolygonSampler(shapely.geometry.Polygon()).sample(1)
+
+def test_Redistributor_caches_sampler(rd1):
+    assert rd1.sampler(1) is rd1.sampler(1)
+    assert rd1.redistribute_from_poly(1, 5).shape == (5,2)
+
 @pytest.fixture
 def crd1():
     p1 = shapely.geometry.Polygon([[0,0], [1,0], [1,1]])
@@ -75,6 +130,31 @@ def test_CachingRedistributor(crd1):
         pt = shapely.geometry.Point(x, y)
         assert pt.intersects(crd1.polygons[1])
 
+def test_CachingRedistributor_cache(crd1):
+    out = crd1.redistribute_from_poly(0, 1)
+    assert out.shape == (1,2)
+    assert crd1.cache_info() == (0, 1, 0, 1, 2)
+    crd1.redistribute_from_poly(0, 1)
+    assert crd1.cache_info() == (1, 1, 0, 1, 2)
+    crd1.redistribute_from_poly(0, 3)
+    assert crd1.cache_info() == (1, 2, 0, 1, 4)
+    crd1.redistribute_from_poly(0, 1)
+    assert crd1.cache_info().hits == 2
+
+def test_CachingRedistributor_evicts():
+    polygons = [shapely.geometry.box(i, 0, i+1, 1) for i in range(10)]
+    crd = geometry.CachingRedistributor(polygons, max_points=60, block_size=32)
+    for _ in range(3):
+        for i in range(10):
+            pts = crd.redistribute_from_poly(i, 5)
+            assert np.all((pts[:,0] >= i) & (pts[:,0] <= i+1))
+    info = crd.cache_info()
+    assert info.points <= 60
+    assert info.evictions > 0
+    assert info.hits + info.misses == 30
+    # Most recently used polygon is still cached
+    assert 9 in crd._cache
+
 def test_CachingRedistributor_redistribute_within_radius(crd1):
     assert crd1.redistribute_within_radius(0, 1, 10) is None
     
@@ -83,6 +163,75 @@ def test_CachingRedistributor_redistribute_within_radius(crd1):
     assert pt.intersects(crd1.polygons[0])
     assert x*x+y*y <= 0.3**2
 
+def test_CachingRedistributor_redistribute_within_radius_many(crd1):
+    assert crd1.redistribute_within_radius(0, 1, 10, size=5) is None
+
+    pts = crd1.redistribute_within_radius(0.9, 0.1, 0.05, size=1000)
+    assert pts.shape == (1000, 2)
+    assert np.all(np.sum((pts - [0.9, 0.1])**2, axis=1) <= 0.05**2)
+    assert np.all(pts[:,1] <= pts[:,0])
+    assert len(crd1._disc_samplers) == 1
+    crd1.redistribute_within_radius(0.9, 0.1, 0.05)
+    assert len(crd1._disc_samplers) == 1
+
+    pts = crd1.redistribute_within_radius(0.5, 0.2, 0, size=3)
+    np.testing.assert_allclose(pts, [[0.5, 0.2]] * 3)
+
+def test_CachingRedistributor_disc_cache_bounded():
+    polygons = [shapely.geometry.box(0, 0, 1, 1)]
+    crd = geometry.CachingRedistributor(polygons, max_discs=5)
+    for i in range(10):
+        x, y = crd.redistribute_within_radius(0.5, 0.5, 0.01 * (i+1))
+    assert len(crd._disc_samplers) == 5
+    assert (0, 0.1, 40, 40) in crd._disc_samplers
+
+def test_CachingRedistributor_disc_cache_buckets_centres():
+    polygons = [shapely.geometry.box(0, 0, 1, 1)]
+    crd = geometry.CachingRedistributor(polygons)
+    centres = 0.5 + np.random.random(size=(50, 2)) * 0.001
+    for x, y in centres:
+        pts = crd.redistribute_within_radius(x, y, 0.04, size=20)
+        assert np.all(np.sum((pts - [x, y])**2, axis=1) <= 0.04**2)
+    assert len(crd._disc_samplers) <= 4
+
+def test_CachingRedistributor_within_radius_uses_rejection_for_large_discs():
+    polygons = [shapely.geometry.box(0, 0, 1, 1)]
+    crd = geometry.CachingRedistributor(polygons)
+    pts = crd.redistribute_within_radius(0.5, 0.5, 0.4, size=1000)
+    assert len(crd._disc_samplers) == 0
+    assert crd.cache_info().misses > 0
+    assert np.all(np.sum((pts - [0.5, 0.5])**2, axis=1) <= 0.4**2)
+    # Uniform in the disc: about 1/4 of the points within half the radius
+    inner = np.mean(np.sum((pts - [0.5, 0.5])**2, axis=1) <= 0.2**2)
+    assert inner == pytest.approx(0.25, abs=0.06)
+
+def test_CachingRedistributor_within_radius_zero_area():
+    polygons = [shapely.geometry.box(0, 0, 1, 1), shapely.geometry.LineString([(2,0), (3,0)])]
+    crd = geometry.CachingRedistributor(polygons)
+    assert crd.redistribute_within_radius(0.5, 0.2, 0) == (0.5, 0.2)
+    np.testing.assert_allclose(crd.redistribute_within_radius(2.5, 0, 0.1, size=2), [[2.5, 0]] * 2)
+
+def test_CachingRedistributor_within_radius_barely_touching(monkeypatch):
+    polygons = [shapely.geometry.box(0, 0, 1, 1), shapely.geometry.box(1, 0, 2, 1)]
+    crd = geometry.CachingRedistributor(polygons)
+    # Centred on the corner, only a quarter of the disc is in the polygon
+    points = crd.redistribute_within_radius(1, 1, 1e-6, size=50)
+    assert np.all(np.sum((points - [1, 1])**2, axis=1) <= 1e-12)
+    assert np.all(points <= 1)
+
+    # If the intersection vanishes, fall back to sampling from the polygon
+    monkeypatch.setattr(geometry, "_disc_polygon", lambda x, y, r : shapely.geometry.Polygon())
+    points = crd.redistribute_within_radius(0.5, 0.5, 0.15, size=20)
+    assert np.all(np.sum((points - [0.5, 0.5])**2, axis=1) <= 0.15**2)
+    with pytest.raises(ValueError):
+        crd.redistribute_within_radius(1, 1, 2e-6)
+    monkeypatch.undo()
+
+    # Below the floating point resolution of the coordinates
+    crd = geometry.CachingRedistributor([shapely.geometry.box(1e6, 1e6, 1e6+1, 1e6+1)])
+    with pytest.raises(ValueError):
+        crd.redistribute_within_radius(1e6+1, 1e6+1, 1e-11, size=5)
+
 def test_ClosestPoint():
     cl = geometry.ClosestPoint([[0,0], [0,1], [1,1], [1,0]], 0.01)
 
@@ -105,3 +254,239 @@ def test_ClosestPoint():
     indices, points = cl.all_in_disc([0.1, 0.1], 1)
     np.testing.assert_allclose(indices, [0,1,3])
     np.testing.assert_allclose(points, [[0,0], [0,1], [1,0]])
+
+def test_ClosestPoint_closest_many():
+    pts = np.random.random(size=(1000,2))
+    cl = geometry.ClosestPoint(pts)
+    queries = np.random.random(size=(100,2))
+    indices = cl.closest_many(queries)
+    assert indices.shape == (100,)
+    assert list(indices) == [cl.closest(pt)[0] for pt in queries]
+
+    indices = cl.closest_many(queries, k=3)
+    assert indices.shape == (100,3)
+    for pt, ind in zip(queries, indices):
+        distsq = np.sum((pts - pt)**2, axis=1)
+        assert list(ind) == list(np.argsort(distsq)[:3])
+
+    indices = cl.closest_many([[0.5, 0.5], [5, 5]], max_distance=1)
+    assert indices[1] == -1 and indices[0] >= 0
+    assert list(geometry.ClosestPoint([[0,0], [1,0]]).closest_many([[0,0]], k=3)[0]) == [0,1,-1]
+
+def test_ClosestPoint_all_in_disc_many():
+    pts = np.random.random(size=(1000,2))
+    cl = geometry.ClosestPoint(pts)
+    queries = np.random.random(size=(100,2))
+    queries[0] = [10, 10]
+    offsets, indices = cl.all_in_disc_many(queries, 0.05)
+    assert offsets.shape == (101,)
+    assert offsets[0] == 0 and offsets[1] == 0
+    for i, pt in enumerate(queries):
+        expected, _ = cl.all_in_disc(pt, 0.05)
+        assert list(indices[offsets[i]:offsets[i+1]]) == list(expected)
+        assert list(expected) == list(np.nonzero(np.sum((pts - pt)**2, axis=1) <= 0.05**2)[0])
+
+def _brute_force_project(starts, ends, pt):
+    d = ends - starts
+    normsq = np.sum(d * d, axis=1)
+    t = np.clip(np.sum((pt - starts) * d, axis=1) / normsq, 0, 1)
+    distsq = np.sum((starts + d * t[:,None] - pt)**2, axis=1)
+    i = np.argmin(distsq)
+    return i, t[i], distsq[i]
+
+def test_LineProjector():
+    starts = np.asarray([[0,0], [10,0], [10,10]])
+    ends = np.asarray([[10,0], [10,10], [0,10]])
+    lp = geometry.LineProjector(starts, ends)
+    segments, ts, projected = lp.project([[0.1, 0], [3, 1], [9, 7], [5, 20]])
+    assert list(segments) == [0, 0, 1, 2]
+    np.testing.assert_allclose(ts, [0.01, 0.3, 0.7, 0.5])
+    np.testing.assert_allclose(projected, [[0.1,0], [3,0], [10,7], [5,10]])
+    assert lp.project_point(9, 7) == (1, pytest.approx(0.7))
+
+def test_LineProjector_random():
+    rng = np.random.RandomState(7)
+    starts = rng.random_sample(size=(200, 2)) * 100
+    ends = starts + rng.standard_normal(size=(200, 2)) * rng.choice([1, 30], size=(200,1))
+    lp = geometry.LineProjector(starts, ends, neighbours=2)
+    points = rng.random_sample(size=(500, 2)) * 120 - 10
+    segments, ts, projected = lp.project(points, chunk_size=77)
+    for pt, seg, t, proj in zip(points, segments, ts, projected):
+        i, tt, distsq = _brute_force_project(starts, ends, pt)
+        assert np.sum((proj - pt)**2) == pytest.approx(distsq)
+        assert np.sum((starts[seg] + (ends[seg] - starts[seg]) * t - proj)**2) == pytest.approx(0)
+
+def _quadratic_aggregate(pts, tolerance):
+    # The original algorithm, for comparison
+    import open_cp.network
+    all_nodes = np.asarray(sorted(set((x,y) for x,y in pts)))
+    builder = open_cp.network.GraphBuilder()
+    idx = np.arange(all_nodes.shape[0])
+    for i, pt in enumerate(all_nodes):
+        builder.vertices.add(i)
+        distsq = np.sum((all_nodes[i+1:] - pt)**2, axis=1)
+        for j in idx[i+1:][distsq <= tolerance**2]:
+            builder.add_edge(i, j)
+    merged = dict()
+    for com in open_cp.network.connected_components(builder.build()):
+        com = sorted(com)
+        p = all_nodes[com]
+        i = np.argmin(np.sum((p - np.mean(p, axis=0))**2, axis=1))
+        for j in com:
+            merged[tuple(all_nodes[j])] = tuple(p[i])
+    return merged
+
+def test_AggregatePointsViaGraph_matches_quadratic():
+    rng = np.random.RandomState(5)
+    centres = rng.random_sample(size=(50, 2)) * 10
+    pts = centres[rng.randint(50, size=2000)] + rng.standard_normal(size=(2000, 2)) * 0.05
+    pts = np.concatenate([pts, pts[:100]])
+    expected = _quadratic_aggregate(pts, 0.1)
+    ap = geometry.AggregatePointsViaGraph(pts, 0.1)
+    assert set(tuple(pt) for pt in ap.merged_points) == set(expected.values())
+    assert len(ap.merged_points) == len(set(expected.values()))
+    for pt in pts:
+        assert tuple(ap[pt]) == expected[tuple(pt)]
+
+    ap = geometry.AggregatePointsViaGraphFast(pts, 0.1)
+    merged = set(tuple(pt) for pt in ap.merged_points)
+    for pt in pts:
+        assert tuple(ap[pt]) in merged
+
+def test_closest_to_centroids():
+    points = np.asarray([[0,0], [5,5], [1,0], [2,0], [6,5], [9,9]])
+    labels = [0, 1, 0, 0, 1, 2]
+    assert list(geometry.closest_to_centroids(points, labels)) == [2, 1, 5]
+    assert len(geometry.closest_to_centroids(points[:0], [])) == 0
+
+def test_AggregatePointsViaGraph_missing_point():
+    ap = geometry.AggregatePointsViaGraph([(1,1), (0,0), (0.01,0)])
+    assert ap.index((1,1)) == 1
+    with pytest.raises(KeyError):
+        ap.index((1,0))
+    with pytest.raises(KeyError):
+        ap.index((2,2))
+
+def test_PointLookup():
+    pts = [(1,1), (0,0), (1,1), (0.01,0), (-0.0,2)]
+    lookup = geometry.PointLookup(pts)
+    np.testing.assert_array_equal(lookup.indices([(0,0), (1,1), (0.01,0), (0,2), (1,0), (5,5)]),
+        [1, 0, 3, 4, -1, -1])
+    assert lookup.index((0.01,0)) == 3
+    with pytest.raises(KeyError):
+        lookup.index((0,1))
+    assert list(geometry.PointLookup(np.empty((0,2))).indices([(0,0)])) == [-1]
+
+def test_AggregatePointsViaGraph_indices():
+    pts = np.random.random(size=(1000,2))
+    ap = geometry.AggregatePointsViaGraph(pts, 0.02)
+    indices = ap.indices(pts)
+    assert list(indices) == [ap.index(pt) for pt in pts]
+    with pytest.raises(KeyError):
+        ap.indices([pts[0], (2,2)])
+
+def test_AggregatePoints_indices():
+    pts = np.random.random(size=(100,2))
+    ap = geometry.AggregatePoints(pts)
+    merged = np.asarray(ap.merged_points)[ap.indices(pts)]
+    np.testing.assert_array_equal(merged, [ap[pt] for pt in pts])
+
+def test_project_lines():
+    import pyproj
+    proj = pyproj.Proj({"init":"epsg:2790"})
+    lines = [np.asarray([[-87.5, 41.65], [-87.6, 41.7]]), np.empty((0,2)),
+        [[-87.7, 41.8]], np.asarray([[-87.5, 41.6], [-87.55, 41.62], [-87.6, 41.64]])]
+    out = geometry.project_lines(lines, proj)
+    assert [len(x) for x in out] == [2, 0, 1, 3]
+    for line, projected in zip(lines, out):
+        assert projected.shape == (len(line), 2)
+        for pt, expected in zip(line, projected):
+            assert proj(*pt) == pytest.approx(tuple(expected))
+    assert geometry.project_lines([], proj) == []
+    assert geometry.project_lines([np.empty((0,2))], proj)[0].shape == (0,2)
+
+def test_project_streets():
+    import collections
+    Street = collections.namedtuple("Street", "name line")
+    streets = [Street(str(i), np.random.random(size=(i+1, 2))) for i in range(25)]
+    proj = lambda x, y : (x + 1, y * 2)
+    out = list(geometry.project_streets(iter(streets), proj, batch_size=7))
+    assert len(out) == 25
+    for street, projected in zip(streets, out):
+        assert projected.name == street.name
+        np.testing.assert_allclose(projected.line, street.line * [1, 2] + [1, 0])
+
+def test_street_edge_mask():
+    streets = [("A", [(0,0), (1,0), (1,1)]), ("B", [(1,1), (0,1)]), ("C", [(1,0), (1,1)])]
+    graph, names = geometry.graph_from_streets(streets, lambda s : s[1])
+    calls = []
+    def accept(street):
+        calls.append(street)
+        return street[0] != "A"
+    mask = geometry.street_edge_mask(graph, names, accept)
+    for i in range(len(graph.edges)):
+        assert mask[i] == any(s[0] != "A" for s in names[i])
+    assert len(calls) == 3
+
+def test_StreamingGraphBuilder():
+    builder = geometry.StreamingGraphBuilder(tolerance=0.1)
+    assert builder.add_line([(0,0), (10,0), (10,5)]) == 0
+    assert builder.add_line(np.asarray([(10,5.05), (0,0.01), (10,0), (10,0.02)])) == 1
+    assert builder.add_line([(20,20)]) == 2
+    assert builder.add_line(np.empty((0,2))) == 3
+    assert builder.add_line([(10,5), (10,0)]) == 4
+    graph, edges, lines, orientations = builder.build()
+    assert graph.vertices[0] in {(0,0), (0,0.01)}
+    assert graph.vertices[1] in {(10,0), (10,0.02)}
+    assert graph.vertices[2] in {(10,5), (10,5.05)}
+    assert graph.vertices[3] == (20,20)
+    assert list(graph.edges) == [(0,1), (1,2), (2,0)]
+    assert edges.tolist() == [0, 1, 2, 0, 1]
+    assert lines.tolist() == [0, 0, 1, 1, 4]
+    assert orientations.tolist() == [1, 1, 1, 1, -1]
+
+def test_StreamingGraphBuilder_empty():
+    graph, edges, lines, _ = geometry.StreamingGraphBuilder().build()
+    assert len(graph.vertices) == 0
+    assert len(graph.edges) == 0
+    assert len(edges) == 0 and len(lines) == 0
+
+def test_GrowableArray():
+    array = geometry._GrowableArray(2, np.float64, capacity=1)
+    for i in range(5):
+        array.extend([[i, i+1], [i, i+2]])
+    assert len(array) == 10
+    np.testing.assert_allclose(array.to_array()[-2:], [[4, 5], [4, 6]])
+
+def test_graph_from_streets_drops_lines():
+    import collections
+    Street = collections.namedtuple("Street", "name line")
+    streets = [Street("A", np.asarray([(0,0), (1,0)])), Street("B", np.asarray([(1,0), (1,1)]))]
+    graph, names = geometry.graph_from_streets(iter(streets), lambda s : s.line, keep_lines=False)
+    assert sorted(s.name for ns in names.values() for s in ns) == ["A", "B"]
+    assert all(s.line is None for ns in names.values() for s in ns)
+    for keep in [{}, {"keep_lines" : True}]:
+        graph, names = geometry.graph_from_streets(streets, lambda s : s.line, **keep)
+        assert {id(s) for ns in names.values() for s in ns} == {id(s) for s in streets}
+
+def test_flatten_lists():
+    flat, rows, positions = geometry.flatten_lists([["a", "b"], [], ("c",), iter([(1, 2)])])
+    assert flat.dtype == object
+    assert flat.tolist() == ["a", "b", "c", (1, 2)]
+    assert rows.tolist() == [0, 0, 2, 3]
+    assert positions.tolist() == [0, 1, 0, 0]
+    flat, rows, positions = geometry.flatten_lists([])
+    assert len(flat) == len(rows) == len(positions) == 0
+
+def test_AggregatePointsViaGraph_merged_order():
+    # Groups are numbered in order of their smallest point, in (x, y) order,
+    # and each is represented by its point closest to the centroid.
+    pts = [(5, 5), (3, 0), (0, 1), (3, 0.05), (0, 1.05), (0, 1.1), (5.05, 5), (2, 2),
+        (5.1, 5), (3, 0.1)]
+    for cls in [geometry.AggregatePointsViaGraph, geometry.AggregatePointsViaGraphFast]:
+        ap = cls(pts, 0.06)
+        np.testing.assert_allclose(ap.merged_points, [(0, 1.05), (2, 2), (3, 0.05), (5.05, 5)])
+        assert ap.indices(pts).tolist() == [3, 2, 0, 2, 0, 0, 3, 1, 3, 2]
+    # Points exactly at the tolerance are merged
+    ap = geometry.AggregatePointsViaGraph([(0, 0), (0.5, 0)], 0.5)
+    assert len(ap.merged_points) == 1
@@ -14,6 +14,58 @@ def graph():
     b.add_path([(0,10), (0,0)])
     return b.build()
 
+def test_CompiledGraph(graph):
+    cg = network.CompiledGraph(graph)
+    assert cg.graph is graph
+    assert cg.keys == [0, 1, 2, 3]
+    np.testing.assert_allclose(cg.coords, [[0,0], [10,0], [10,10], [0,10]])
+    np.testing.assert_allclose(cg.lengths, [10, 10, 10, 10])
+    assert cg.number_edges == 4
+    for v in range(4):
+        assert set(cg.neighbours(v)) == set(graph.neighbours(v))
+    for k1, k2 in graph.edges:
+        assert cg.find_edge(k1, k2) == graph.find_edge(k1, k2)
+        assert cg.find_edge(k2, k1) == graph.find_edge(k2, k1)
+    with pytest.raises(KeyError):
+        cg.find_edge(0, 2)
+    edges, orients = cg.find_edges([0, 1, 0, 2], [1, 0, 2, 3])
+    assert list(edges) == [0, 0, -1, 2]
+    assert list(orients) == [1, -1, 0, 1]
+    assert cg.edge_to_coords(0, 1, 0.2) == pytest.approx((2, 0))
+    assert network.compile_graph(cg) is cg
+    assert network.compile_graph(graph) is network.compile_graph(graph)
+
+def test_compile_graph_cache(graph, graph1):
+    import gc, pickle, weakref
+    compiled, compiled1 = network.compile_graph(graph), network.compile_graph(graph1)
+    assert network.compile_graph(graph) is compiled
+    assert network.compile_graph(graph1) is compiled1
+    copy = pickle.loads(pickle.dumps(graph))
+    assert network.compile_graph(copy) is not compiled
+    assert network.compile_graph(copy).keys == compiled.keys
+    # The compiled graph lives exactly as long as the graph
+    ref = weakref.ref(network.compile_graph(open_cp.network.Graph([0,1], [(0,1)], [1])))
+    gc.collect()
+    assert ref() is None
+
+def test_CompiledGraph_project_points(graph):
+    cg = network.CompiledGraph(graph)
+    edges, ts, projected = cg.project_points([[0.1,0], [3,1], [9,7]])
+    assert list(edges) == [0, 0, 1]
+    np.testing.assert_allclose(ts, [0.01, 0.3, 0.3])
+    np.testing.assert_allclose(projected, [[0.1,0], [3,0], [10,7]])
+
+def test_CompiledGraph_accepted(graph2):
+    cg = network.CompiledGraph(graph2)
+    points = [(1, 0.2), (1, 0.9), (6, 0.5)]
+    expected = network.FlowPoints(graph2, points, 0.5, 2).flow(0)
+    got = network.FlowPoints(cg, points, 0.5, 2).flow(0)
+    assert dict(got.edges) == dict(expected.edges)
+    assert got.graph is cg
+
+    dist = network.LimitedNetworkDistance(cg, 1, 0.2, 2)
+    assert dist.paths == network.LimitedNetworkDistance(graph2, 1, 0.2, 2).paths
+
 def test_NetworkProjectAggregate_noagg(graph):
     points = [[0.1,0], [3,1], [9,7]]
     agg = network.NetworkProjectAggregate(graph, points, 0)
@@ -60,6 +112,21 @@ def test_NetworkProjectAggregate1(graph):
     assert agg.to_projected_lookup == [0,0,0,1]
     assert agg.graph_points == [(0,0.32), (0,0.5)]
 
+def test_NetworkProjectAggregate_processes():
+    graph = grid_graph(10)
+    b = open_cp.network.PlanarGraphBuilder()
+    for k in graph.vertices:
+        b.set_vertex(k, *k)
+    for e in graph.edges:
+        b.add_edge(*e)
+    graph = b.build()
+    points = np.random.RandomState(3).random_sample(size=(1500, 2)) * 9
+    expected = network.NetworkProjectAggregate(graph, points, 0.05)
+    agg = network.NetworkProjectAggregate(graph, points, 0.05, processes=2)
+    assert agg.to_projected_lookup == expected.to_projected_lookup
+    assert agg.graph_points == expected.graph_points
+    np.testing.assert_allclose(agg.projected_points, expected.projected_points)
+
 def test_shortest_edge_paths(graph):
     assert graph.vertices == {0:(0,0), 1:(10,0), 2:(10,10), 3:(0,10)}
     
@@ -130,6 +197,82 @@ def test_LimitedNetworkDistance1(graph1):
     del p[5]
     assert p == {0:0, 1:0, 2:2, 3:2, 4:2, 6:0}
 
+def _label_correcting_walk(graph, edge, t, maximum_distance):
+    # The original, unordered, search
+    distances = dict()
+    v1, v2 = graph.edges[edge]
+    edge_length = graph.lengths[edge]
+    distances[v1] = t * edge_length
+    distances[v2] = (1 - t) * edge_length
+    paths = {v1:v1, v2:v2}
+    vertices_to_visit = {v1, v2}
+    while len(vertices_to_visit) > 0:
+        v = vertices_to_visit.pop()
+        for u in graph.neighbours(v):
+            e, _ = graph.find_edge(v, u)
+            d = distances[v] + graph.lengths[e]
+            if u not in distances or d < distances[u]:
+                distances[u] = d
+                if d <= maximum_distance:
+                    vertices_to_visit.add(u)
+                paths[u] = v
+    return distances, paths
+
+def grid_graph(size, seed=1):
+    b = open_cp.network.GraphBuilder()
+    for x in range(size):
+        for y in range(size):
+            if x + 1 < size:
+                b.add_edge((x,y), (x+1,y))
+            if y + 1 < size:
+                b.add_edge((x,y), (x,y+1))
+    b.lengths = np.random.RandomState(seed).random_sample(len(b.edges)) + 0.5
+    return b.build()
+
+def test_LimitedNetworkDistance_matches_unordered_search():
+    graph = grid_graph(15)
+    for edge, t, maxd in [(0, 0.2, 3), (100, 0.7, 5.5), (250, 0.5, 0.1), (17, 0, 100)]:
+        expected_distances, expected_paths = _label_correcting_walk(graph, edge, t, maxd)
+        dist = network.LimitedNetworkDistance(graph, edge, t, maxd)
+        assert dist.paths == expected_paths
+        assert dist.vertex_distances == expected_distances
+
+def test_LimitedNetworkDistance_equal_lengths():
+    graph = grid_graph(12)
+    graph = open_cp.network.Graph(graph.vertices, graph.edges, np.ones(graph.number_edges))
+    cg = network.CompiledGraph(graph)
+    for edge, t, maxd in [(0, 0, 100), (50, 0.5, 4), (131, 0.25, 7)]:
+        expected_distances, _ = _label_correcting_walk(graph, edge, t, maxd)
+        dist = network.LimitedNetworkDistance(graph, edge, t, maxd)
+        assert dist.vertex_distances == expected_distances
+        assert dist.paths == network.LimitedNetworkDistance(cg, edge, t, maxd).paths
+        # Each step back is along an edge, and one of the shortest routes
+        for u, v in dist.paths.items():
+            if u != v:
+                e, _ = graph.find_edge(u, v)
+                assert dist.vertex_distances[u] == dist.vertex_distances[v] + graph.lengths[e]
+    # Ties are broken towards the vertex explored first
+    dist = network.LimitedNetworkDistance(graph, 0, 0, 100)
+    assert graph.edges[0] == ((0,0), (1,0))
+    assert dist.paths[(1,1)] == (1,0)
+    assert dist.paths[(2,2)] == (1,2)
+
+def test_LimitedNetworkDistance_parallel_edges():
+    # Edges 1 and 2, and edges 3 and 4, are parallel; `find_edge` returns the
+    # first, which is the longer, of each pair.
+    edges = [(0,1), (1,2), (1,2), (2,3), (2,3), (3,0)]
+    graph = open_cp.network.Graph([0,1,2,3], edges, [1, 5, 2, 4, 0.5, 20])
+    assert graph.find_edge(1, 2) == (1, 1)
+    cg = network.CompiledGraph(graph)
+    assert cg.find_edge(2, 1) == (1, -1)
+    assert cg.find_edges([1,2,2], [2,1,3])[0].tolist() == [1,1,3]
+    expected_distances, expected_paths = _label_correcting_walk(graph, 0, 0, 100)
+    assert expected_distances == {0:0, 1:1, 2:6, 3:10}
+    for g in [graph, cg]:
+        dist = network.LimitedNetworkDistance(g, 0, 0, 100)
+        assert dist.vertex_distances == expected_distances
+        assert dist.paths == expected_paths
+
 def test_GraphSubSet(graph1):
     edges = [(0, None), (2,None), (3,[(0,0.4), (0.7,0.7)]) ]
     ss = network.GraphSubSet(graph1, edges)
@@ -149,6 +292,26 @@ def test_GraphSubSet(graph1):
     with pytest.raises(ValueError):
         lines = ss.as_lines()
 
+def test_GraphSubSet_contains_many(graph1):
+    edges = [(0, None), (2,None), (3,[(0.7,0.9), (0,0.4), (0.7,0.7)]) ]
+    ss = network.GraphSubSet(graph1, edges)
+    es = np.random.randint(5, size=1000)
+    ts = np.random.random(1000)
+    ts[:5] = [0, 0.4, 0.7, 0.9, 1]
+    es[:5] = 3
+    expected = [ss.contains(e, t) for e, t in zip(es, ts)]
+    assert list(ss.contains_many(es, ts)) == expected
+    assert len(ss.contains_many([], [])) == 0
+
+def test_GraphSubSet_sample_arrays_distribution(graph1):
+    edges = [(0, None), (3,[(0,0.4), (0.6,0.8)]) ]
+    ss = network.GraphSubSet(graph1, edges)
+    e, t = ss.sample_arrays(100000)
+    assert np.all(ss.contains_many(e, t))
+    expected = graph1.lengths[0] / (graph1.lengths[0] + 0.6 * graph1.lengths[3])
+    assert np.mean(e == 0) == pytest.approx(expected, abs=0.01)
+    assert np.mean(t[e==3] < 0.4) == pytest.approx(2/3, abs=0.01)
+
 def test_GraphSubSet_distribute_into_parts():
     ss = network.GraphSubSet(None, [])
     parts = [(0,0.4), (0.7,0.9)]
@@ -165,6 +328,15 @@ def test_GraphSubSet_sample(graph1):
     samples = ss.sample(10)
     assert len(samples) == 10
 
+def test_GraphSubSet_sample_arrays(graph1):
+    edges = [(0, None), (3,[(0,0.4), (0.7,0.7)]) ]
+    ss = network.GraphSubSet(graph1, edges)
+    e, t = ss.sample_arrays(1000)
+    assert e.shape == (1000,) and t.shape == (1000,)
+    assert set(e) == {0, 3}
+    assert np.all(t[e==3] <= 0.7)
+    assert np.all((t[e==3] <= 0.4) | (t[e==3] == 0.7))
+
 @pytest.fixture
 def graph_small_builder():
     b = open_cp.network.GraphBuilder()
@@ -390,4 +562,74 @@ def test_Redistributor(geograph):
     x, y = redist.redistribute_from_point([0,0])
     with pytest.raises(ValueError):
         redist.redistribute_from_point([0.1,0])
-        
\ No newline at end of file
+    assert redist.aggregator.graph is geograph
+    assert redist.flow.graph is geograph
+
+def test_Redistributor_redistribute_many(geograph):
+    points = [[0,0], [0.5, 0.1], [2, 0.5], [1, 1.5]]
+    redist = network.Redistributor(geograph, points, 0.2, 0.5, tolerance=0)
+    indices = np.random.randint(4, size=100)
+    out = redist.redistribute_many(indices)
+    assert out.shape == (100, 2)
+    compiled = network.compile_graph(geograph)
+    for index, pt in zip(indices, out):
+        subset = redist.flow.flow(redist.aggregator.to_projected_lookup[index])
+        edge, t, _ = compiled.project_points([pt])
+        assert subset.contains(edge[0], t[0]) or subset.contains(edge[0], 1 - t[0])
+    assert redist.redistribute_many([]).shape == (0, 2)
+
+def test_CompiledGraph_edges_to_coords(geograph):
+    compiled = network.compile_graph(geograph)
+    edges = [0, 1, 2, 3, 2]
+    ts = [0, 0.5, 0.25, 1, 0.9]
+    expected = [compiled.edge_to_coords(*compiled.edges[e], t) for e, t in zip(edges, ts)]
+    np.testing.assert_allclose(compiled.edges_to_coords(edges, ts), expected)
+        
+def test_edge_subgraph(graph):
+    sub = network.edge_subgraph(graph, [True, True, False, False])
+    assert set(sub.graph.vertices) == {0, 1, 2}
+    for k in sub.graph.vertices:
+        assert sub.graph.vertices[k] == graph.vertices[k]
+    assert list(sub.graph.edges) == list(graph.edges)[:2]
+    np.testing.assert_allclose(sub.graph.lengths, [10, 10])
+    np.testing.assert_array_equal(sub.vertex_to_new, [0, 1, 2, -1])
+    np.testing.assert_array_equal(sub.vertex_to_old, [0, 1, 2])
+    np.testing.assert_array_equal(sub.edge_to_new, [0, 1, -1, -1])
+    np.testing.assert_array_equal(sub.edge_to_old, [0, 1])
+
+    sub = network.edge_subgraph(graph, [False, False, True, False])
+    assert list(sub.graph.edges) == [list(graph.edges)[2]]
+    np.testing.assert_array_equal(sub.vertex_to_new, [-1, -1, 0, 1])
+    np.testing.assert_array_equal(sub.edge_to_old, [2])
+
+    sub = network.edge_subgraph(graph, np.zeros(4, dtype=bool))
+    assert len(sub.graph.edges) == 0
+    with pytest.raises(ValueError):
+        network.edge_subgraph(graph, [True])
+
+def test_CompiledGraph_pickles_only_arrays(graph):
+    import pickle
+    cg = network.CompiledGraph(graph)
+    state = cg.__getstate__()
+    assert "_graph" not in state and "_keys" not in state and "_index" not in state
+    copy = pickle.loads(pickle.dumps(cg))
+    assert copy.graph is None
+    np.testing.assert_array_equal(copy.edge_vertices, cg.edge_vertices)
+    np.testing.assert_allclose(copy.coords, cg.coords)
+    assert copy.find_edge_by_index(0, 1) == cg.find_edge_by_index(0, 1)
+    np.testing.assert_array_equal(copy.find_edges([0, 2], [1, 0])[0], [0, -1])
+    dist = network.LimitedNetworkDistance(copy, 0, 0.5, 100)
+    assert dist.distance(2, 0.5) == pytest.approx(20)
+
+def test_NetworkProjectAggregate_chunk_size():
+    graph = grid_graph(5)
+    b = open_cp.network.PlanarGraphBuilder()
+    for k in graph.vertices:
+        b.set_vertex(k, *k)
+    for e in graph.edges:
+        b.add_edge(*e)
+    graph = b.build()
+    points = np.random.RandomState(7).random_sample(size=(300, 2)) * 4
+    expected = network.NetworkProjectAggregate(graph, points, 0.05)
+    agg = network.NetworkProjectAggregate(graph, points, 0.05, chunk_size=7)
+    assert agg.to_projected_lookup == expected.to_projected_lookup
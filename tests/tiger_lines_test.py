@@ -3,6 +3,7 @@ import pytest
 import opencrimedata.tiger_lines as tiger_lines
 import os, sys
 import numpy as np
+import pandas as pd
 
 def test_load_roads():
     filename = os.path.join("tests", "data", "test_lines")
@@ -97,3 +98,218 @@ def test_edges_to_graph():
     assert out[(8,5, 10,0)] == two
     assert out[(10,0, 5,-1)] == two
     assert len(out) == 5
+
+def test_merge_graphs():
+    roads = [("one", [[0,0], [10,0], [10,5]])]
+    edges = [
+        tiger_lines.Edge("one", "a", "b", "c", "d", [[10,5], [10,0]]),
+        tiger_lines.Edge("two", "a1", "b1", "c1", "d1", [[5,-1], [0,0.01], [10,0]]),
+        ]
+    roads_graph, _ = tiger_lines.roads_to_graph(roads)
+    edges_graph, _ = tiger_lines.edges_to_graph(edges)
+    lookup = tiger_lines.merge_graphs(roads_graph, edges_graph)
+    assert len(lookup) == 2
+    for (v1, v2), e in zip(roads_graph.edges, lookup):
+        expected = {roads_graph.vertices[v1], roads_graph.vertices[v2]}
+        u1, u2 = edges_graph.edges[e]
+        got = {edges_graph.vertices[u1], edges_graph.vertices[u2]}
+        assert len(got) == 2
+        for pt in got:
+            assert min(np.sum((np.asarray(pt) - q)**2) for q in expected) < 0.1**2
+
+    roads = [("one", [[0,0], [10,5]])]
+    roads_graph, _ = tiger_lines.roads_to_graph(roads)
+    with pytest.raises(ValueError):
+        tiger_lines.merge_graphs(roads_graph, edges_graph)
+
+def test_project_roads_and_edges():
+    proj = lambda x, y : (x * 2, y - 1)
+    roads = [("A", np.asarray([[0, 0], [1, 1]])), (None, np.asarray([[2, 3]]))]
+    out = list(tiger_lines.project_roads(roads, proj, batch_size=1))
+    assert [name for name, _ in out] == ["A", None]
+    np.testing.assert_allclose(out[0][1], [[0, -1], [2, 0]])
+    np.testing.assert_allclose(out[1][1], [[4, 2]])
+
+    edges = [tiger_lines.Edge("A", 1, 2, 3, 4, np.asarray([[0, 0], [1, 1]]))]
+    out = list(tiger_lines.project_edges(edges, proj))
+    assert tuple(out[0])[:-1] == ("A", 1, 2, 3, 4)
+    assert isinstance(out[0], tiger_lines.Edge)
+    np.testing.assert_allclose(out[0].line, [[0, -1], [2, 0]])
+
+class _Proj():
+    def __init__(self, srs):
+        self.srs = srs
+
+    def __call__(self, x, y):
+        return x, y
+
+def test_TigerLines_cache(tmpdir, monkeypatch):
+    roads_dir, edges_dir = str(tmpdir.mkdir("roads")), str(tmpdir.mkdir("edges"))
+    for d in [roads_dir, edges_dir]:
+        with open(os.path.join(d, "data.shp"), "wb") as f:
+            f.write(b"abc")
+    calls = []
+    def load_roads(filename):
+        calls.append(filename)
+        return [("one", np.asarray([[0,0], [10,0], [10,5]]))]
+    def load_edges(filename):
+        return [tiger_lines.Edge("one", "a", "b", "c", "d", np.asarray([[10,5], [10,0]])),
+            tiger_lines.Edge("two", "a1", "b1", "c1", "d1", np.asarray([[5,-1], [0,0.01], [10,0]]))]
+    monkeypatch.setattr(tiger_lines, "load_roads", load_roads)
+    monkeypatch.setattr(tiger_lines, "load_edges", load_edges)
+
+    cache_dir = str(tmpdir.join("cache"))
+    first = tiger_lines.TigerLines(roads_dir, edges_dir, _Proj("+proj=a"), cache_dir)
+    assert len(calls) == 1
+    assert len(os.listdir(cache_dir)) == 1
+    second = tiger_lines.TigerLines(roads_dir, edges_dir, _Proj("+proj=a"), cache_dir)
+    assert len(calls) == 1
+    assert second.roads_graph.vertices == first.roads_graph.vertices
+    assert second.roads_graph.edges == first.roads_graph.edges
+    assert second.edges_graph.edges == first.edges_graph.edges
+    assert second.from_roads_to_edges == first.from_roads_to_edges
+    assert second._edges_name_lookup == first._edges_name_lookup
+    assert second._roads_name_lookup == first._roads_name_lookup
+
+    tiger_lines.TigerLines(roads_dir, edges_dir, _Proj("+proj=b"), cache_dir)
+    assert len(calls) == 2
+    with open(os.path.join(edges_dir, "data.shp"), "wb") as f:
+        f.write(b"abd")
+    tiger_lines.TigerLines(roads_dir, edges_dir, _Proj("+proj=a"), cache_dir)
+    assert len(calls) == 3
+    assert len(os.listdir(cache_dir)) == 3
+
+    tiger_lines.TigerLines(roads_dir, edges_dir, lambda x, y : (x, y), cache_dir)
+    assert len(calls) == 4
+    assert len(os.listdir(cache_dir)) == 3
+
+def test_match_vertices():
+    roads_graph, _ = tiger_lines.roads_to_graph([("one", [[0,0], [10,0], [10,5], [20,20]])])
+    edges_graph, _ = tiger_lines.edges_to_graph([
+        tiger_lines.Edge("one", "a", "b", "c", "d", [[10,5], [10,0], [0,0.01]]),
+        tiger_lines.Edge("two", "a", "b", "c", "d", [[19,20], [20,30]]) ])
+    lookup, mismatches = tiger_lines.match_vertices(edges_graph, roads_graph)
+    assert len(lookup) == 3
+    for k, v in lookup.items():
+        np.testing.assert_allclose(roads_graph.vertices[k], edges_graph.vertices[v], atol=0.1)
+    assert len(mismatches) == 1
+    m = mismatches[0]
+    assert m.point == (20, 20)
+    assert edges_graph.vertices[m.nearest] == (19, 20)
+    assert m.distance == pytest.approx(1)
+
+    with pytest.raises(ValueError) as err:
+        tiger_lines.merge_graphs(roads_graph, edges_graph)
+    assert "1 mismatches" in str(err.value)
+
+def test_filter_names_many():
+    names = [None, "Bob", "alley", "Dave", "CA RR", "X rlwy", "", float("nan")]
+    expected = [tiger_lines.filter_names(n) for n in names[:-1]] + [False]
+    assert tiger_lines.filter_names_many(names).tolist() == expected
+
+def test_all_names_to_frame():
+    edges_graph, edges_names = tiger_lines.edges_to_graph([
+        tiger_lines.Edge("one", "a", "b", "c", "d", [[0,0], [10,0], [10,5]]),
+        tiger_lines.Edge("two", "a1", "b1", "c1", "d1", [[10,5], [8,5]]) ])
+    names = [{"one"}, {"one", "x"}, set()]
+    all_names = [(edges_names[i], n) for i, n in enumerate(names)]
+    frame = tiger_lines.all_names_to_frame(edges_graph, all_names)
+    assert list(frame["edge_number"]) == [0, 1, 2]
+    assert [frame["left_add_from"][i] for i in range(3)] == [edges_names[i].left_address_from for i in range(3)]
+    assert frame["name0"][0] == "one"
+    assert {frame["name0"][1], frame["name1"][1]} == {"one", "x"}
+    assert pd.isna(frame["name1"][0])
+    assert pd.isna(frame["name0"][2])
+    for i, (v1, v2) in enumerate(edges_graph.edges):
+        np.testing.assert_allclose(frame.geometry[i].coords,
+            [edges_graph.vertices[v1], edges_graph.vertices[v2]])
+
+    lines = tiger_lines.TigerLines.__new__(tiger_lines.TigerLines)
+    lines._edges_graph = edges_graph
+    lines._all_names_data = [(edges_names[i], n) for i, n in enumerate([{"Alley"}, {"alley", "x"}, {None}])]
+    assert list(lines.to_reduced_geodataframe()["edge_number"]) == [1]
+
+def test_make_reduced_graph():
+    edges_graph, edges_names = tiger_lines.edges_to_graph([
+        tiger_lines.Edge("one", "a", "b", "c", "d", [[0,0], [10,0], [10,5]]),
+        tiger_lines.Edge("two", "a1", "b1", "c1", "d1", [[10,5], [8,5]]) ])
+    lines = tiger_lines.TigerLines.__new__(tiger_lines.TigerLines)
+    lines._edges_graph = edges_graph
+    lines._all_names_data = [(edges_names[i], n) for i, n in enumerate([{"Alley", "x"}, {"alley"}, {None, "y"}])]
+    assert lines.edge_name_mask().tolist() == [True, False, True]
+    graph, edge_list = lines.make_reduced_graph()
+    assert edge_list == [0, 2]
+    assert list(graph.edges) == [edges_graph.edges[0], edges_graph.edges[2]]
+    assert set(graph.vertices) == set(edges_graph.edges[0]) | set(edges_graph.edges[2])
+
+def _previous_roads_to_graph(roads):
+    # The implementation before `geometry.StreamingGraphBuilder` was used
+    import open_cp.network
+    import collections
+    roads = list(roads)
+    b = open_cp.network.PlanarGraphNodeOneShot([pt for _, geo in roads for pt in geo])
+    name_lookup = collections.defaultdict(set)
+    for name, geo in roads:
+        for e in b.add_path(geo):
+            name_lookup[e].add(name)
+    b.remove_duplicate_edges()
+    graph = b.build()
+    names = collections.defaultdict(set)
+    for e, ns in name_lookup.items():
+        if e[0] == e[1]:
+            continue
+        index, _ = graph.find_edge(*e)
+        names[index].update(ns)
+    return graph, dict(names)
+
+def _edges_with_names(graph, names):
+    out = []
+    for i, (a, b) in enumerate(graph.edges):
+        out.append((np.asarray(graph.vertices[a]), np.asarray(graph.vertices[b]), names[i]))
+    return out
+
+def test_roads_to_graph_matches_previous_builder():
+    roads = [
+        ("one", [[0,0], [10,0], [10,0], [10,5]]),
+        ("two", [[10,5.05], [8,5], [10,0.03], [0.02,-0.04], [5,-1]]),
+        ("three", [[8,5], [8,5.01]]),
+        ("four", [[20,20]]),
+        ("five", [[5,-1], [0,0]]),
+        ]
+    graph, names = tiger_lines.roads_to_graph(roads)
+    expected_graph, expected_names = _previous_roads_to_graph(roads)
+    got = _edges_with_names(graph, names)
+    expected = _edges_with_names(expected_graph, expected_names)
+    assert len(got) == len(expected) == 5
+    for a, b, ns in expected:
+        matches = [n for aa, bb, n in got
+            if (np.sum((a-aa)**2) < 0.1**2 and np.sum((b-bb)**2) < 0.1**2)
+            or (np.sum((a-bb)**2) < 0.1**2 and np.sum((b-aa)**2) < 0.1**2)]
+        assert matches == [ns]
+
+def test_roads_to_graph_merges_transitively():
+    roads = [("one", [[0,0], [0.08,0], [0.16,0], [5,0]])]
+    graph, names = tiger_lines.roads_to_graph(roads)
+    assert len(graph.vertices) == 2
+    assert graph.vertices[0] == (0.08, 0)
+    assert names == {0 : {"one"}}
+
+def test_edges_to_graph_repeated_edge():
+    edges = [tiger_lines.Edge("one", "a", "b", "c", "d", [[0,0], [10,0]]),
+        tiger_lines.Edge("one", "a", "b", "c", "d", [[10,0], [0,0]])]
+    with pytest.raises(Exception, match="Repeated edge"):
+        tiger_lines.edges_to_graph(edges)
+    edges[1] = tiger_lines.Edge("two", "a", "b", "c", "d", [[0,0], [10,0]])
+    with pytest.raises(Exception, match="multiple data"):
+        tiger_lines.edges_to_graph(edges)
+
+def test_all_names_to_frame_without_vectorised_shapely(monkeypatch):
+    edges_graph, edges_names = tiger_lines.edges_to_graph([
+        tiger_lines.Edge("one", "a", "b", "c", "d", [[0,0], [10,0], [10,5]]) ])
+    all_names = [(edges_names[i], {"one"}) for i in range(2)]
+    expected = tiger_lines.all_names_to_frame(edges_graph, all_names)
+    # As for shapely 1.x, which has no vectorised constructors
+    import types
+    monkeypatch.setattr(tiger_lines, "_shapely", types.SimpleNamespace())
+    frame = tiger_lines.all_names_to_frame(edges_graph, all_names)
+    assert all(a.equals(b) for a, b in zip(frame.geometry, expected.geometry))
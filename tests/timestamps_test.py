@@ -0,0 +1,81 @@
+import pytest
+
+import opencrimedata.timestamps as timestamps
+import datetime
+import numpy as np
+
+@pytest.fixture
+def parser():
+    return timestamps.Parser(timestamps.MDY_IMS_P)
+
+def test_Parser(parser):
+    assert parser("10/12/2006 10:58:00 AM") == datetime.datetime(2006, 10, 12, 10, 58, 0)
+    assert parser("10/12/2006 10:58:07 PM") == datetime.datetime(2006, 10, 12, 22, 58, 7)
+    assert parser("10/12/2006 12:00:00 AM") == datetime.datetime(2006, 10, 12, 0, 0, 0)
+    assert parser("10/12/2006 12:00:00 pm") == datetime.datetime(2006, 10, 12, 12, 0, 0)
+    # Not in the fixed layout, but accepted by strptime
+    assert parser("1/2/2006 1:00:00 PM") == datetime.datetime(2006, 1, 2, 13, 0, 0)
+    for bad in ["", "02/30/2006 10:58:00 AM", "10/12/2006 00:58:00 AM",
+            "10/12/2006 13:58:00 AM", "10/12/2006 10:58:60 AM", "10/12/2006 10:58:00 XM"]:
+        with pytest.raises(ValueError):
+            datetime.datetime.strptime(bad, timestamps.MDY_IMS_P)
+        with pytest.raises(ValueError):
+            parser(bad)
+
+def test_Parser_MDY_HM():
+    parser = timestamps.parser(timestamps.MDY_HM)
+    assert parser is timestamps.parser(timestamps.MDY_HM)
+    assert parser("01/19/2015 14:00") == datetime.datetime(2015, 1, 19, 14, 0)
+    assert parser("02/29/2016 00:59") == datetime.datetime(2016, 2, 29, 0, 59)
+    with pytest.raises(ValueError):
+        parser("02/29/2015 00:59")
+    with pytest.raises(ValueError):
+        parser("02/20/2015 24:00")
+
+def _random_strings(count, format):
+    choices = ["{:02}/{:02}/{} {:02}:{:02}:{:02} {}".format(
+        np.random.randint(14), np.random.randint(33), np.random.choice([1900, 2000, 2015, 2016]),
+        np.random.randint(25), np.random.randint(61), np.random.randint(61),
+        np.random.choice(["AM", "PM", "am", "XM"])) for _ in range(count)]
+    if format == timestamps.MDY_HM:
+        choices = [x[:16] for x in choices]
+    return choices
+
+@pytest.mark.parametrize("format", [timestamps.MDY_IMS_P, timestamps.MDY_HM])
+def test_Parser_matches_strptime(format):
+    parser = timestamps.Parser(format)
+    for string in _random_strings(2000, format):
+        try:
+            expected = datetime.datetime.strptime(string, format)
+        except ValueError:
+            with pytest.raises(ValueError):
+                parser(string)
+            continue
+        assert parser(string) == expected
+
+@pytest.mark.parametrize("format", [timestamps.MDY_IMS_P, timestamps.MDY_HM])
+def test_Parser_parse_many(format):
+    parser = timestamps.Parser(format)
+    strings = []
+    for string in _random_strings(2000, format):
+        try:
+            datetime.datetime.strptime(string, format)
+            strings.append(string)
+        except ValueError:
+            pass
+    out = parser.parse_many(strings)
+    assert out.dtype == np.dtype("datetime64[s]")
+    expected = [np.datetime64(datetime.datetime.strptime(s, format), "s") for s in strings]
+    np.testing.assert_array_equal(out, expected)
+
+def test_Parser_parse_many_fallback(parser):
+    out = parser.parse_many(["1/2/2006 1:00:00 PM", "10/12/2006 12:00:00 AM"])
+    np.testing.assert_array_equal(out, np.asarray(["2006-01-02T13:00:00", "2006-10-12T00:00:00"],
+        dtype="datetime64[s]"))
+    out = parser.parse_many(["10/12/2006 12:00:00 AM", ""], allow_empty=True)
+    assert np.isnat(out[1])
+    with pytest.raises(ValueError):
+        parser.parse_many(["10/12/2006 12:00:00 AM", ""])
+    with pytest.raises(ValueError):
+        parser.parse_many(["10/12/2006 12:00:00 AM", "02/30/2006 10:58:00 AM"])
+    assert len(parser.parse_many([])) == 0
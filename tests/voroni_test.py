@@ -35,6 +35,14 @@ def test_Voroni_map_to_merged(vor, agmock):
     assert vor.map_to_merged_point((1,4)) == ag.__getitem__.return_value
     ag.__getitem__.assert_called_with((1,4))
 
+def test_Voroni_map_to_merged_points(vor, agmock):
+    ag = agmock.return_value
+    ag.merged_points = np.asarray([[1,2], [3,4]])
+    ag.indices.return_value = np.asarray([1,0,1])
+    np.testing.assert_array_equal(vor.map_to_merged_points([[5,6], [7,8], [9,10]]),
+        [[3,4], [1,2], [3,4]])
+    ag.indices.assert_called_with([[5,6], [7,8], [9,10]])
+
 def test_Voroni_all_polys(vor, voronimock):
     v = voronimock.return_value
     v.points = list(range(10))